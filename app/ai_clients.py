@@ -0,0 +1,91 @@
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, Iterable, Optional, Set
+import httpx
+from openai import AsyncOpenAI
+
+from app.database.session import settings
+
+logger = logging.getLogger(__name__)
+
+# Rejestr długo żyjących klientów OpenRouter (klucz = token API)
+_clients: Dict[str, AsyncOpenAI] = {}
+# Liczba odpowiedzi w toku na kliencie - klient wycofany z rejestru zamykamy dopiero po ostatniej
+_in_use: Dict[AsyncOpenAI, int] = {}
+# Klienci nieużywanych kluczy czekający na koniec odpowiedzi w toku (klient -> końcówka tokena do logów)
+_retired: Dict[AsyncOpenAI, str] = {}
+_closing: Set[asyncio.Task] = set()
+
+def _build_client(token: str) -> AsyncOpenAI:
+    http_client = httpx.AsyncClient(
+        http2=settings.AI_HTTP2,
+        limits=httpx.Limits(
+            max_connections=settings.AI_MAX_CONNECTIONS,
+            max_keepalive_connections=settings.AI_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=settings.AI_KEEPALIVE_EXPIRY,
+        ),
+        timeout=httpx.Timeout(settings.AI_TIMEOUT, connect=10.0),
+    )
+    return AsyncOpenAI(api_key=token, base_url=settings.AI_BASE_URL, http_client=http_client)
+
+def get_ai_client(token: Optional[str] = None) -> AsyncOpenAI:
+    """Zwraca współdzielonego klienta dla tokena persony (lub domyślnego z .env)."""
+    token = token or settings.OPENROUTER_KEY
+    client = _clients.get(token)
+    if client is None:
+        client = _build_client(token)
+        _clients[token] = client
+    return client
+
+@asynccontextmanager
+async def client_in_use(client: AsyncOpenAI) -> AsyncIterator[AsyncOpenAI]:
+    """Obejmuje odpowiedź (wszystkie próby modeli) - wycofany w jej trakcie klient zostanie zamknięty po jej końcu."""
+    _in_use[client] = _in_use.get(client, 0) + 1
+    try:
+        yield client
+    finally:
+        _in_use[client] -= 1
+        if not _in_use[client]:
+            del _in_use[client]
+            hint = _retired.pop(client, None)
+            if hint is not None: _schedule_close(hint, client)
+
+async def _close(token_hint: str, client: AsyncOpenAI):
+    try:
+        await client.close()
+    except Exception as e:
+        logger.error(f"Error closing AI client {token_hint}: {e}")
+
+def _schedule_close(token_hint: str, client: AsyncOpenAI):
+    task = asyncio.get_running_loop().create_task(_close(token_hint, client))
+    _closing.add(task)
+    task.add_done_callback(_closing.discard)
+
+def retire_unused_clients(tokens: Iterable[Optional[str]]):
+    """
+    Po przeładowaniu person: klienci kluczy, których nie używa już żadna aktywna persona, wypadają z rejestru
+    i są zamykani - od razu albo po ostatniej odpowiedzi w toku (client_in_use).
+    """
+    used = {token or settings.OPENROUTER_KEY for token in tokens}
+    for token in [t for t in _clients if t not in used]:
+        client = _clients.pop(token)
+        hint = f"...{token[-4:]}"
+        if client in _in_use:
+            logger.info(f"Closing AI client for unused key {hint} after {_in_use[client]} replies in progress")
+            _retired[client] = hint
+        else:
+            logger.info(f"Closing AI client for unused key {hint}")
+            _schedule_close(hint, client)
+
+async def close_ai_clients():
+    """Zamyka wszystkie klienty i ich pule połączeń, także wycofane, na których trwają jeszcze odpowiedzi (shutdown)."""
+    clients = list(_clients.values()) + list(_retired)
+    _clients.clear()
+    _retired.clear()
+    await asyncio.gather(*list(_closing), return_exceptions=True)
+    for client in clients:
+        try:
+            await client.close()
+        except Exception as e:
+            logger.error(f"Error closing AI client: {e}")
@@ -1,10 +1,12 @@
+import hashlib
 import logging
+from typing import Dict, Iterable, Optional
 from aiogram import Bot, Dispatcher
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
 from aiogram.fsm.storage.redis import RedisStorage
 from redis.asyncio import Redis
-from sqlalchemy import select
-from app.database.session import settings, AsyncSessionLocal
+from app.database.session import settings
 from app.database.models import Persona
 
 # --- Konfiguracja Logera ---
@@ -14,50 +16,125 @@ logger = logging.getLogger(__name__)
 redis = Redis.from_url(settings.REDIS_URL)
 dp = Dispatcher(storage=RedisStorage(redis=redis))
 
-# Globalna instancja bota
-bot: Bot = None
+# Rejestr botów aktywnych person (persona_id -> Bot). Wszystkie boty dzielą jedną sesję HTTP (pulę połączeń).
+_bots: Dict[int, Bot] = {}
+# Poprzedni bot persony po zmianie tokena - obsługuje update'y zaadresowane jeszcze do starego tokena
+_retiring: Dict[int, Bot] = {}
+_session: Optional[AiohttpSession] = None
 
-async def init_bot():
+def persona_token(persona: Persona) -> str:
+    return persona.telegram_token or settings.BOT_TOKEN
+
+def webhook_secret(token: str) -> str:
+    """secret_token webhooka (nagłówek X-Telegram-Bot-Api-Secret-Token) - wskazuje, do którego tokena był update."""
+    return hashlib.sha256(token.encode()).hexdigest()
+
+def webhook_url(persona_id: int) -> str:
+    return f"{settings.WEBHOOK_URL}/webhook/{persona_id}"
+
+def _shared_session() -> AiohttpSession:
+    global _session
+    if _session is None:
+        _session = AiohttpSession()
+    return _session
+
+def sync_bots(personas: Iterable[Persona]):
     """
-    Zarządza cyklem życia instancji bota (Hot Reload).
-    Zamyka starą sesję, czyści webhooki i uruchamia nową konfigurację.
+    Dopasowuje rejestr do listy aktywnych person (bez wywołań API Telegrama).
+    Bot persony z niezmienionym tokenem zostaje ten sam, więc update'y w toku nie są przerywane.
+    """
+    global _bots, _retiring
+    bots: Dict[int, Bot] = {}
+    retiring: Dict[int, Bot] = {}
+    owners: Dict[str, int] = {}
+    for persona in sorted(personas, key=lambda p: p.id):
+        token = persona_token(persona)
+        if token in owners:
+            # Jeden token = jeden webhook; druga persona nadpisałaby webhook pierwszej
+            logger.error(f"Persona {persona.name} uses the same Telegram token as persona {owners[token]}, skipped")
+            continue
+        owners[token] = persona.id
+        current = _bots.get(persona.id)
+        if current is not None and current.token == token:
+            # Zmiana promptu, modelu czy limitów - ten sam bot, bez wywołań do Telegrama
+            bots[persona.id] = current
+            if persona.id in _retiring: retiring[persona.id] = _retiring[persona.id]
+            continue
+        try:
+            bots[persona.id] = Bot(token=token, session=_shared_session(), default=DefaultBotProperties(parse_mode="HTML"))
+        except Exception as e:
+            logger.error(f"Invalid Telegram token for persona {persona.name}: {e}")
+            continue
+        if current is not None:
+            retiring[persona.id] = current
+    added = bots.keys() - _bots.keys()
+    removed = _bots.keys() - bots.keys()
+    # Podmiana bez await - webhook widzi stary albo nowy rejestr, nigdy stan pośredni
+    _bots, _retiring = bots, retiring
+    if added or removed:
+        logger.info(f"--- BOTS ONLINE: {sorted(bots)} (added {sorted(added)}, removed {sorted(removed)}) ---")
+
+async def register_webhook(persona_id: int):
+    """Ustawia webhook persony. Oczekujące update'y zostają u Telegrama i przyjdą na nowy adres."""
+    bot = _bots.get(persona_id)
+    if bot is None: return
+    try:
+        await bot.set_webhook(url=webhook_url(persona_id), secret_token=webhook_secret(bot.token), drop_pending_updates=False)
+    except Exception as e:
+        logger.error(f"Failed to set webhook for persona {persona_id}: {e}")
+
+async def unregister_webhook(persona_id: int):
+    """Usuwa webhook wyłączanej persony (przed usunięciem jej z rejestru). Update'y czekają na ponowną aktywację."""
+    bot = _bots.get(persona_id)
+    if bot is None: return
+    try:
+        await bot.delete_webhook(drop_pending_updates=False)
+    except Exception as e:
+        logger.error(f"Failed to delete webhook for persona {persona_id}: {e}")
+
+async def swap_webhook(persona_id: int):
     """
-    global bot
-    async with AsyncSessionLocal() as db:
-        active_persona = await db.scalar(select(Persona).where(Persona.is_active == True).limit(1))
-        
-        # 1. Sprzątanie po poprzednim bocie
-        if bot is not None:
-            logger.info("Closing previous bot session...")
-            try:
-                # WAŻNE: Usuwamy webhook starego bota, żeby Telegram nie słał update'ów
-                # do starego tokena (błąd Conflict).
-                await bot.delete_webhook(drop_pending_updates=True)
-                await bot.session.close()
-            except Exception as e:
-                logger.error(f"Error closing bot: {e}")
-            finally:
-                bot = None
-
-        # 2. Inicjalizacja nowego bota
-        if active_persona:
-            token = active_persona.telegram_token if active_persona.telegram_token else settings.BOT_TOKEN
-            
-            try:
-                # Tworzymy nową instancję
-                new_bot = Bot(token=token, default=DefaultBotProperties(parse_mode="HTML"))
-                
-                # Ustawiamy webhook dla nowego tokena
-                webhook_url = f"{settings.WEBHOOK_URL}/webhook"
-                await new_bot.set_webhook(url=webhook_url, drop_pending_updates=True)
-                
-                bot = new_bot
-                logger.info(f"--- BOT ACTIVE: {active_persona.name} (Model: {active_persona.ai_model}) ---")
-            except Exception as e:
-                logger.error(f"Failed to initialize bot for {active_persona.name}: {e}")
-        else:
-            logger.info("--- ALL MODELS INACTIVE: BOT OFFLINE ---")
-
-async def get_bot():
-    """Pomocnicza funkcja do bezpiecznego pobierania bota w handlerach."""
-    return bot
\ No newline at end of file
+    Zmiana tokena persony (po przeładowaniu rejestru): webhook nowego bota, potem zdjęcie webhooka starego.
+    Update'y w drodze do starego tokena obsługuje stary bot (rozpoznany po secret_token), nic nie jest kasowane.
+    """
+    await register_webhook(persona_id)
+    old, new = _retiring.get(persona_id), _bots.get(persona_id)
+    # Nowy token tego samego bota (rotacja w BotFather) - set_webhook już podmienił adres, a stary token nie działa
+    if old is None or new is None or old.id == new.id: return
+    try:
+        await old.delete_webhook(drop_pending_updates=False)
+    except Exception as e:
+        logger.error(f"Failed to delete old webhook for persona {persona_id}: {e}")
+
+async def register_webhooks():
+    """Start procesu: webhooki wszystkich aktywnych person."""
+    for persona_id in list(_bots):
+        await register_webhook(persona_id)
+
+async def get_bot(persona_id: Optional[int] = None) -> Optional[Bot]:
+    """Bot danej persony (None, gdy nieaktywna). Bez persony - bot domyślny (najstarsza aktywna persona)."""
+    if persona_id is None:
+        return _bots[min(_bots)] if _bots else None
+    return _bots.get(persona_id)
+
+def resolve_bot(persona_id: int, secret: Optional[str]) -> Optional[Bot]:
+    """
+    Bot, do którego Telegram zaadresował update webhooka persony (po secret_token).
+    None = brak lub obcy secret, persona nieaktywna albo token jeszcze nieznany temu workerowi.
+    """
+    # Każdy webhook jest rejestrowany z secret_token - update bez nagłówka nie pochodzi od Telegrama
+    if secret is None: return None
+    bot = _bots.get(persona_id)
+    if bot is None or secret == webhook_secret(bot.token): return bot
+    old = _retiring.get(persona_id)
+    if old is not None and secret == webhook_secret(old.token):
+        return bot if old.id == bot.id else old
+    return None
+
+async def close_bots():
+    """Zamyka wspólną sesję HTTP botów (shutdown)."""
+    global _session
+    _bots.clear(); _retiring.clear()
+    if _session is not None:
+        await _session.close()
+        _session = None
@@ -0,0 +1,400 @@
+import asyncio
+import logging
+import time
+from datetime import datetime
+from typing import Dict, List, Optional, Set, Tuple
+
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.types import LabeledPrice
+from sqlalchemy import select, update
+
+from app.database.models import Broadcast, BroadcastLog, MediaContent, User
+from app.database.session import settings, AsyncSessionLocal
+from app.bot_manager import get_bot
+from app.redis_lease import acquire_lease, refresh_lease, release_lease
+
+logger = logging.getLogger(__name__)
+
+# Stany wiersza broadcast_logs (jeden wiersz na odbiorcę, tworzony przy zakładaniu broadcastu):
+# pending -> claimed (w kolejce procesu) -> sending (tuż przed wywołaniem API) -> sent / failed; cancelled po anulowaniu.
+# Po restarcie "claimed" wraca do pending, a "sending" nie jest ponawiany - nie wiemy, czy dotarł, więc oznaczamy go jako failed.
+# W "sending" przechodzą paczki po BROADCAST_SENDERS wierszy, więc po awarii niepewnych jest najwyżej kilka paczek.
+INTERRUPTED_ERROR = "Interrupted during send (delivery unknown)"
+BOT_OFFLINE_ERROR = "Persona bot offline"
+
+# Lease w Redisie - jeden broadcast wysyła naraz tylko jeden proces (rolling deploy, kilka workerów)
+LEASE_TTL = 30
+
+def _lease_key(broadcast_id: int) -> str:
+    return f"broadcast:lease:{broadcast_id}"
+
+# Wyniki wysłanych wiadomości, których nie udało się zapisać na koniec przebiegu - zapisywane przy wznowieniu
+# broadcastu, zanim _recover oznaczy wiszące "sending" jako niepewne
+_unflushed: Dict[int, List[Tuple[int, str, Optional[str]]]] = {}
+
+class TokenBucket:
+    """Limiter wysyłek bota: `rate` tokenów na sekundę, maksymalnie `capacity` naraz."""
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float):
+        """Wstrzymuje wszystkich nadawców (Telegram zwrócił RetryAfter)."""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0.0
+
+    async def acquire(self):
+        # Lock ustawia czekających w kolejce - token dostaje ten, kto czeka najdłużej
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+# Limit Telegrama jest per bot - jeden limiter na token, wspólny dla wszystkich broadcastów i sweepera VIP
+_buckets: Dict[str, TokenBucket] = {}
+
+def bot_bucket(bot) -> TokenBucket:
+    bucket = _buckets.get(bot.token)
+    if bucket is None:
+        bucket = _buckets[bot.token] = TokenBucket(settings.BROADCAST_RATE, settings.BROADCAST_BURST)
+    return bucket
+
+class BroadcastEngine:
+    """
+    Wysyłka jednego broadcastu: N nadawców współdzieli limiter bota (bot_bucket), wywołania do jednego czatu
+    są rozsunięte o BROADCAST_PER_CHAT_INTERVAL. Odbiorcy są pobierane z broadcast_logs paczkami
+    (pending -> claimed), tuż przed wysyłką przechodzą w "sending" paczkami po BROADCAST_SENDERS,
+    a wyniki zapisywane są przyrostowo razem z success_count/fail_count. Odbiorcy oddani do puli
+    w trakcie (np. błąd zapisu "sending") są wysyłani w kolejnym przebiegu.
+    Pauza/anulowanie w panelu lub utrata lease zatrzymuje wysyłkę po bieżących wiadomościach.
+    """
+
+    def __init__(self, broadcast_id: int, text: Optional[str], media: Optional[MediaContent]):
+        self.broadcast_id = broadcast_id
+        self.text = text if text and text.strip() else None
+        self.media = media
+        self.stopping = False
+        self._recipients: asyncio.Queue = asyncio.Queue()
+        # Odbiorcy już w "sending" - nadawcy muszą ich wysłać, także przy zatrzymywaniu
+        self._ready: asyncio.Queue = asyncio.Queue()
+        self._results: asyncio.Queue = asyncio.Queue()
+        self._unsent: List[int] = []
+        self.sent = self.failed = 0
+
+    async def _call(self, bot, method):
+        """Wywołanie API z limitem bota i obsługą RetryAfter (ponawiane, nie liczone jako błąd)."""
+        bucket = bot_bucket(bot)
+        for attempt in range(settings.BROADCAST_MAX_RETRIES + 1):
+            await bucket.acquire()
+            try:
+                return await method()
+            except TelegramRetryAfter as e:
+                if attempt == settings.BROADCAST_MAX_RETRIES: raise
+                logger.warning(f"Broadcast {self.broadcast_id}: flood control, pausing {e.retry_after}s")
+                bucket.pause(e.retry_after)
+
+    async def _send_one(self, bot, uid: int):
+        calls = []
+        if self.text:
+            calls.append(lambda: bot.send_message(chat_id=uid, text=self.text))
+        if self.media:
+            m = self.media
+            calls.append(lambda: bot.send_invoice(chat_id=uid, title=f"Unlock: {m.name} 🔒", description="Exclusive private content. Pay to unlock immediately.", payload=f"ppv_{m.id}", currency="XTR", prices=[LabeledPrice(label="Unlock Content", amount=m.price)], provider_token=""))
+        for i, call in enumerate(calls):
+            if i: await asyncio.sleep(settings.BROADCAST_PER_CHAT_INTERVAL)
+            await self._call(bot, call)
+
+    async def _recover(self):
+        """
+        Porządki po przerwanym procesie: "claimed" (jeszcze niewysłane) wracają do pending,
+        "sending" (wysyłka w toku) oznaczamy jako failed zamiast wysyłać ponownie - chyba że ten proces
+        zna ich wynik (zapis na koniec poprzedniego przebiegu się nie udał), wtedy zapisujemy wynik.
+        """
+        leftover = _unflushed.pop(self.broadcast_id, None)
+        if leftover:
+            try:
+                await self._flush(leftover)
+            except Exception:
+                _unflushed[self.broadcast_id] = leftover
+                raise
+            logger.info(f"Broadcast {self.broadcast_id}: wrote {len(leftover)} results left over from the previous run")
+        async with AsyncSessionLocal() as db:
+            await db.execute(update(BroadcastLog).where(
+                BroadcastLog.broadcast_id == self.broadcast_id, BroadcastLog.status == "claimed"
+            ).values(status="pending"))
+            res = await db.execute(update(BroadcastLog).where(
+                BroadcastLog.broadcast_id == self.broadcast_id, BroadcastLog.status == "sending"
+            ).values(status="failed", error_message=INTERRUPTED_ERROR, timestamp=datetime.utcnow()))
+            if res.rowcount:
+                await db.execute(update(Broadcast).where(Broadcast.id == self.broadcast_id).values(fail_count=Broadcast.fail_count + res.rowcount))
+                logger.warning(f"Broadcast {self.broadcast_id}: {res.rowcount} recipients interrupted mid-send, marked as failed")
+            await db.commit()
+
+    async def _claim(self, last_id: int) -> List[Tuple[int, int, Optional[int]]]:
+        """Przydziela kolejną paczkę odbiorców (pending -> claimed), kursorem po id wiersza. Zwraca (id wiersza, user_id, persona_id)."""
+        async with AsyncSessionLocal() as db:
+            batch = select(BroadcastLog.id).where(
+                BroadcastLog.broadcast_id == self.broadcast_id, BroadcastLog.status == "pending", BroadcastLog.id > last_id
+            ).order_by(BroadcastLog.id).limit(settings.BROADCAST_CLAIM_BATCH)
+            rows = (await db.execute(
+                update(BroadcastLog).where(BroadcastLog.id.in_(batch), BroadcastLog.status == "pending")
+                .values(status="claimed").returning(BroadcastLog.id, BroadcastLog.user_id)
+            )).all()
+            await db.commit()
+            # Każdy odbiorca dostaje wiadomość od bota persony, z którą rozmawia
+            personas = dict((await db.execute(
+                select(User.telegram_id, User.persona_id).where(User.telegram_id.in_([uid for _, uid in rows]))
+            )).all()) if rows else {}
+        return sorted((log_id, uid, personas.get(uid)) for log_id, uid in rows)
+
+    async def _start(self, log_ids: List[int]) -> Set[int]:
+        """claimed -> sending dla paczki tuż przed wysyłką. Zwraca id wierszy do wysłania (bez anulowanych w panelu w międzyczasie)."""
+        async with AsyncSessionLocal() as db:
+            started = (await db.execute(
+                update(BroadcastLog).where(BroadcastLog.id.in_(log_ids), BroadcastLog.status == "claimed")
+                .values(status="sending").returning(BroadcastLog.id)
+            )).scalars().all()
+            await db.commit()
+        return set(started)
+
+    async def _feeder(self):
+        """Dokłada odbiorców, zanim nadawcom skończy się praca; kończy się, gdy nie ma już pending."""
+        last_id = 0
+        while not self.stopping:
+            if self._recipients.qsize() >= settings.BROADCAST_CLAIM_BATCH:
+                await asyncio.sleep(0.1)
+                continue
+            rows = await self._claim(last_id)
+            if not rows: break
+            last_id = rows[-1][0]
+            for row in rows: self._recipients.put_nowait(row)
+
+    async def _starter(self, feeder: asyncio.Task):
+        """Przekazuje nadawcom kolejne paczki odbiorców (claimed -> sending jednym UPDATE), gdy kończy im się praca."""
+        while True:
+            if self.stopping:
+                # Nierozpoczęci wracają do puli przy zamykaniu (feeder może jeszcze dokładać bieżącą paczkę)
+                while not self._recipients.empty(): self._unsent.append(self._recipients.get_nowait()[0])
+                if feeder.done(): return
+                await asyncio.sleep(0.05)
+                continue
+            if self._recipients.empty() or self._ready.qsize() >= settings.BROADCAST_SENDERS:
+                if feeder.done() and self._recipients.empty(): return
+                await asyncio.sleep(0.05)
+                continue
+            rows = [self._recipients.get_nowait() for _ in range(min(settings.BROADCAST_SENDERS, self._recipients.qsize()))]
+            batch = []
+            for log_id, uid, persona_id in rows:
+                bot = await get_bot(persona_id)
+                if bot is None: await self._results.put((log_id, "failed", BOT_OFFLINE_ERROR))
+                else: batch.append((log_id, uid, bot))
+            if not batch: continue
+            try:
+                started = await self._start([log_id for log_id, _, _ in batch])
+            except Exception as e:
+                # Nie zaczęliśmy wysyłki - wiersze wracają do puli przy zamykaniu przebiegu
+                logger.error(f"Broadcast {self.broadcast_id}: failed to mark {len(batch)} recipients as sending: {e}")
+                self._unsent.extend(log_id for log_id, _, _ in batch)
+                continue
+            for row in batch:
+                if row[0] in started: self._ready.put_nowait(row)
+
+    async def _sender(self, starter: asyncio.Task):
+        while True:
+            try:
+                log_id, uid, bot = self._ready.get_nowait()
+            except asyncio.QueueEmpty:
+                if starter.done(): return
+                await asyncio.sleep(0.05)
+                continue
+            try:
+                await self._send_one(bot, uid)
+                await self._results.put((log_id, "sent", None))
+            except Exception as e:
+                await self._results.put((log_id, "failed", str(e)[:250]))
+
+    async def _flush(self, batch: List[Tuple[int, str, Optional[str]]]):
+        """Zapisuje wyniki paczki razem z przyrostem success_count/fail_count (jedna transakcja)."""
+        if not batch: return
+        sent = sum(1 for _, status, _ in batch if status == "sent")
+        failed = len(batch) - sent
+        async with AsyncSessionLocal() as db:
+            now = datetime.utcnow()
+            await db.execute(update(BroadcastLog), [
+                {"id": log_id, "status": status, "error_message": error, "timestamp": now}
+                for log_id, status, error in batch
+            ])
+            await db.execute(update(Broadcast).where(Broadcast.id == self.broadcast_id).values(
+                success_count=Broadcast.success_count + sent, fail_count=Broadcast.fail_count + failed,
+            ))
+            await db.commit()
+        self.sent += sent; self.failed += failed
+
+    async def _check(self):
+        """Odświeża lease i sprawdza, czy broadcast nie został wstrzymany lub anulowany w panelu."""
+        async with AsyncSessionLocal() as db:
+            status = await db.scalar(select(Broadcast.status).where(Broadcast.id == self.broadcast_id))
+        if status != "processing":
+            self.stopping = True
+        elif not await refresh_lease(_lease_key(self.broadcast_id), LEASE_TTL):
+            logger.error(f"Broadcast {self.broadcast_id}: lease lost, stopping")
+            self.stopping = True
+
+    async def _writer(self):
+        """Zbiera wyniki nadawców i zapisuje je co BROADCAST_LOG_CHUNK wierszy lub co BROADCAST_FLUSH_INTERVAL sekund."""
+        batch, finished = [], False
+        deadline = time.monotonic() + settings.BROADCAST_FLUSH_INTERVAL
+        while not finished:
+            try:
+                item = await asyncio.wait_for(self._results.get(), timeout=max(0.0, deadline - time.monotonic()))
+                if item is None: finished = True
+                else: batch.append(item)
+            except asyncio.TimeoutError:
+                pass
+            if len(batch) >= settings.BROADCAST_LOG_CHUNK or time.monotonic() >= deadline or finished:
+                try:
+                    await self._flush(batch)
+                    batch = []
+                except Exception as e:
+                    # Wiersze zostają w paczce i trafią do bazy przy następnym zapisie
+                    logger.error(f"Broadcast {self.broadcast_id}: failed to write {len(batch)} logs: {e}")
+                    if finished: await self._flush_final(batch)
+                try:
+                    await self._check()
+                except Exception as e:
+                    logger.error(f"Broadcast {self.broadcast_id}: status check failed: {e}")
+                deadline = time.monotonic() + settings.BROADCAST_FLUSH_INTERVAL
+
+    async def _flush_final(self, batch: List[Tuple[int, str, Optional[str]]]):
+        """
+        Ostatni zapis przebiegu: wiadomości są już wysłane, więc ponawiamy zapis zamiast zostawiać wiersze w "sending"
+        (po restarcie byłyby failed). Gdy baza nadal nie działa, wyniki czekają w pamięci na wznowienie broadcastu.
+        """
+        for attempt in range(1, settings.BROADCAST_MAX_RETRIES + 1):
+            await asyncio.sleep(settings.BROADCAST_FLUSH_INTERVAL * attempt)
+            try:
+                await self._flush(batch)
+                return
+            except Exception as e:
+                logger.error(f"Broadcast {self.broadcast_id}: retry {attempt} of writing {len(batch)} logs failed: {e}")
+        _unflushed.setdefault(self.broadcast_id, []).extend(batch)
+        raise RuntimeError(f"{len(batch)} broadcast results not written, kept until the broadcast resumes")
+
+    async def _finish(self) -> bool:
+        """
+        Oddaje nierozpoczęte wiersze do puli (lub anuluje) i zamyka broadcast, gdy nie ma już odbiorców.
+        True = zostali odbiorcy pending/claimed, potrzebny kolejny przebieg.
+        """
+        remaining = False
+        async with AsyncSessionLocal() as db:
+            status = await db.scalar(select(Broadcast.status).where(Broadcast.id == self.broadcast_id))
+            if self._unsent:
+                await db.execute(update(BroadcastLog).where(BroadcastLog.id.in_(self._unsent), BroadcastLog.status == "claimed")
+                                 .values(status="cancelled" if status == "cancelled" else "pending"))
+            if not self.stopping:
+                remaining = await db.scalar(select(BroadcastLog.id).where(
+                    BroadcastLog.broadcast_id == self.broadcast_id, BroadcastLog.status.in_(("pending", "claimed"))
+                ).limit(1)) is not None
+                if not remaining:
+                    await db.execute(update(Broadcast).where(Broadcast.id == self.broadcast_id, Broadcast.status == "processing").values(status="completed"))
+            await db.commit()
+        self._unsent = []
+        return remaining
+
+    async def _pass(self):
+        """Jeden przebieg po odbiorcach pending: feeder -> starter -> nadawcy, wyniki przez writer."""
+        feeder = asyncio.create_task(self._feeder())
+        starter = asyncio.create_task(self._starter(feeder))
+        writer = asyncio.create_task(self._writer())
+        senders = [asyncio.create_task(self._sender(starter)) for _ in range(settings.BROADCAST_SENDERS)]
+        try:
+            await feeder
+            await starter
+            await asyncio.gather(*senders)
+            await self._results.put(None)
+            await writer
+        finally:
+            for task in senders + [feeder, starter, writer]: task.cancel()
+
+    async def run(self):
+        if not await get_bot(): return
+        start = time.monotonic()
+        await self._recover()
+        while True:
+            await self._pass()
+            if not await self._finish() or self.stopping: break
+            # Część odbiorców wróciła do puli - kolejny przebieg po chwili (z odświeżeniem lease i statusu)
+            await asyncio.sleep(settings.BROADCAST_POLL_INTERVAL)
+            await self._check()
+            if self.stopping: break
+        state = "stopped" if self.stopping else "completed"
+        logger.info(f"Broadcast {self.broadcast_id} {state}: {self.sent} sent, {self.failed} failed in {time.monotonic() - start:.1f}s")
+
+# --- WORKER (uruchamiany w lifespan) ---
+_wake = asyncio.Event()
+_running: Dict[int, Tuple[BroadcastEngine, asyncio.Task]] = {}
+
+def wake_broadcast_worker():
+    """Natychmiastowe sprawdzenie zadań (nowy lub wznowiony broadcast); inne procesy złapią je przy następnym odpytaniu."""
+    _wake.set()
+
+async def _run_job(broadcast_id: int):
+    try:
+        async with AsyncSessionLocal() as db:
+            broadcast = await db.get(Broadcast, broadcast_id)
+            if not broadcast: return
+            media_item = await db.get(MediaContent, broadcast.media_id) if broadcast.media_id else None
+        engine = BroadcastEngine(broadcast_id, broadcast.message_content, media_item)
+        _running[broadcast_id] = (engine, asyncio.current_task())
+        await engine.run()
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        logger.error(f"Broadcast {broadcast_id} failed: {e}")
+    finally:
+        _running.pop(broadcast_id, None)
+        try:
+            await release_lease(_lease_key(broadcast_id))
+        except Exception: pass
+
+async def broadcast_worker():
+    """Podejmuje niedokończone broadcasty (status processing), także po restarcie lub deployu."""
+    while True:
+        try:
+            async with AsyncSessionLocal() as db:
+                ids = (await db.execute(select(Broadcast.id).where(Broadcast.status == "processing").order_by(Broadcast.id))).scalars().all()
+            for broadcast_id in ids:
+                if broadcast_id in _running: continue
+                if await acquire_lease(_lease_key(broadcast_id), LEASE_TTL):
+                    _running[broadcast_id] = (None, asyncio.create_task(_run_job(broadcast_id)))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Broadcast worker error: {e}")
+        try:
+            await asyncio.wait_for(_wake.wait(), timeout=settings.BROADCAST_POLL_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        _wake.clear()
+
+async def stop_broadcasts(timeout: float):
+    """Przy zamykaniu procesu: kończy wysyłane wiadomości, resztę odbiorców zostawia jako pending."""
+    for engine, _ in list(_running.values()):
+        if engine: engine.stopping = True
+    tasks = [task for _, task in _running.values()]
+    if not tasks: return
+    done, pending = await asyncio.wait(tasks, timeout=timeout)
+    for task in pending: task.cancel()
@@ -0,0 +1,64 @@
+import asyncio
+import logging
+import uuid
+from typing import Awaitable, Callable, Dict
+
+from app.bot_manager import redis
+
+logger = logging.getLogger(__name__)
+
+# Kanał Redis, przez który workery informują się nawzajem o zmianach cache'owanych danych
+CACHE_CHANNEL = "cache:invalidate"
+
+# Identyfikator procesu - pozwala zignorować własne powiadomienia
+_instance_id = uuid.uuid4().hex
+
+# nazwa cache -> funkcja przeładowująca
+_reloaders: Dict[str, Callable[[], Awaitable[None]]] = {}
+
+def register_cache(name: str, reload: Callable[[], Awaitable[None]]):
+    _reloaders[name] = reload
+
+async def publish_change(name: str):
+    """Powiadamia pozostałe workery, że cache `name` jest nieaktualny."""
+    try:
+        await redis.publish(CACHE_CHANNEL, f"{_instance_id}:{name}")
+    except Exception as e:
+        logger.error(f"Failed to publish {name} change: {e}")
+
+async def _reload(name: str):
+    reload = _reloaders.get(name)
+    if reload is None: return
+    try:
+        await reload()
+    except Exception as e:
+        logger.error(f"Failed to reload {name} cache: {e}")
+
+async def listen_cache_changes():
+    """Nasłuchuje zmian z innych workerów (uruchamiane w lifespan)."""
+    reconnect = False
+    while True:
+        pubsub = redis.pubsub()
+        try:
+            await pubsub.subscribe(CACHE_CHANNEL)
+            # Po zerwaniu połączenia mogliśmy przegapić powiadomienia
+            if reconnect:
+                for name in list(_reloaders): await _reload(name)
+            async for msg in pubsub.listen():
+                if msg.get("type") != "message": continue
+                data = msg.get("data")
+                if isinstance(data, bytes): data = data.decode()
+                sender, _, name = data.partition(":")
+                if sender == _instance_id: continue
+                await _reload(name)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Cache listener error: {e}")
+            reconnect = True
+            await asyncio.sleep(5)
+        finally:
+            try:
+                await pubsub.aclose()
+            except Exception:
+                pass
@@ -0,0 +1,76 @@
+import asyncio
+import logging
+from typing import Dict, NamedTuple
+from sqlalchemy import select
+
+from app.database.session import AsyncSessionLocal
+from app.database.models import MediaContent, PromoContent
+from app.bot_manager import redis
+from app.cache_bus import register_cache, publish_change
+
+logger = logging.getLogger(__name__)
+
+# Wersja katalogu (Redis INCR) - rośnie przy każdej zmianie mediów lub promocji
+VERSION_KEY = "catalog:version"
+
+class CatalogSnapshot(NamedTuple):
+    version: int
+    media: Dict[str, MediaContent]     # tag -> PPV (obiekty odłączone od sesji)
+    promos: Dict[str, PromoContent]    # tag -> promo
+    ppv_instructions: str              # gotowy fragment promptu systemowego
+    promo_instructions: str            # "" gdy brak promocji
+
+_snapshot = CatalogSnapshot(-1, {}, {}, "", "")
+_lock = asyncio.Lock()
+
+def _ppv_fragment(items) -> str:
+    if not items:
+        return "\n\n--- AVAILABLE PPV CONTENT ---\nCurrently no PPV content available."
+    media_list_str = "\n".join([f"- [PPV: {m.tag}] (Description: {m.name})" for m in items])
+    return f"\n\n--- AVAILABLE PPV CONTENT ---\nYou can offer these items to the user. Pick a tag that fits the conversation:\n{media_list_str}"
+
+def _promo_fragment(items) -> str:
+    if not items: return ""
+    promo_list_str = "\n".join([f"- [PROMO: {m.tag}] (Description: {m.name})" for m in items])
+    return f"\n\n--- AVAILABLE PROMO CONTENT (FOR TEASING FREE USERS) ---\nSend these blurred/teasing items to make them want to buy VIP:\n{promo_list_str}"
+
+async def _current_version() -> int:
+    try:
+        return int(await redis.get(VERSION_KEY) or 0)
+    except Exception as e:
+        logger.error(f"Catalog version read failed: {e}")
+        return _snapshot.version + 1
+
+async def reload_catalog_cache():
+    """Przebudowuje fragmenty i słowniki tagów. Starszy odczyt nie nadpisze nowszej wersji."""
+    global _snapshot
+    async with _lock:
+        # Wersję czytamy przed danymi - snapshot nigdy nie jest nowszy niż jego numer
+        version = await _current_version()
+        async with AsyncSessionLocal() as db:
+            media = (await db.execute(select(MediaContent).order_by(MediaContent.id))).scalars().all()
+            promos = (await db.execute(select(PromoContent).order_by(PromoContent.id))).scalars().all()
+        if version < _snapshot.version: return
+        _snapshot = CatalogSnapshot(
+            version,
+            {m.tag: m for m in media}, {p.tag: p for p in promos},
+            _ppv_fragment(media), _promo_fragment(promos),
+        )
+    logger.info(f"Catalog cache reloaded: v{version}, {len(media)} media, {len(promos)} promos")
+
+register_cache("catalog", reload_catalog_cache)
+
+async def get_catalog() -> CatalogSnapshot:
+    """Zwraca snapshot katalogu bez odpytywania bazy (poza pierwszym wywołaniem)."""
+    if _snapshot.version < 0:
+        await reload_catalog_cache()
+    return _snapshot
+
+async def notify_catalog_changed():
+    """Podbija wersję katalogu, przeładowuje lokalny snapshot i powiadamia pozostałe workery."""
+    try:
+        await redis.incr(VERSION_KEY)
+    except Exception as e:
+        logger.error(f"Catalog version bump failed: {e}")
+    await reload_catalog_cache()
+    await publish_change("catalog")
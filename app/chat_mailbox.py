@@ -0,0 +1,177 @@
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+
+from app.bot_manager import redis
+from app.database.session import settings
+from app.redis_lease import instance_id, refresh_lease, release_lease
+
+logger = logging.getLogger(__name__)
+
+# Lease odpowiedzi dla rozmowy - odpowiada naraz tylko jeden worker; flaga pending = nowe wiadomości czekają na odpowiedź
+LEASE_TTL = 30
+# Flaga musi przeżyć całą odpowiedź właściciela (z opóźnieniem "pisania" nawet kilka minut)
+PENDING_TTL = 600
+ChatKey = Tuple[int, int]  # (persona_id, chat_id)
+# reply(id ostatniej obsłużonej wiadomości użytkownika lub None) -> id ostatniej wiadomości objętej tą turą
+Reply = Callable[[Optional[int]], Awaitable[Optional[int]]]
+
+def _lease_key(key: ChatKey) -> str:
+    return f"reply:lease:{key[0]}:{key[1]}"
+
+def _pending_key(key: ChatKey) -> str:
+    return f"reply:pending:{key[0]}:{key[1]}"
+
+class _Chat:
+    __slots__ = ("reply", "dirty", "answered", "first_post", "last_post", "task")
+
+    def __init__(self, reply: Reply):
+        self.reply = reply
+        self.dirty = True
+        self.answered: Optional[int] = None
+        # Początek i koniec serii wiadomości czekającej na odpowiedź (time.monotonic)
+        self.first_post = self.last_post = time.monotonic()
+        self.task: Optional[asyncio.Task] = None
+
+class ChatMailbox:
+    """
+    Skrzynka odpowiedzi per rozmowa. Wiadomości są zapisywane od razu (handler), a odpowiedź generuje
+    osobne zadanie: wiadomości, które przyszły w trakcie generowania, trafiają do jednej kolejnej tury
+    (historia z bazy zawiera je wszystkie). Opcjonalny debounce (CHAT_DEBOUNCE_WINDOW) czeka przed turą
+    na koniec serii krótkich wiadomości. Lokalnie wystarcza flaga w pamięci; między workerami
+    lease w Redisie + flaga pending, którą właściciel lease'a sprawdza przed jego zwolnieniem i po nim.
+    Naraz trwa najwyżej CHAT_REPLY_CONCURRENCY tur, pozostałe czekają na wolne miejsce.
+    """
+
+    def __init__(self, concurrency: int):
+        self._chats: Dict[ChatKey, _Chat] = {}
+        self.concurrency = concurrency
+        self._slots = asyncio.Semaphore(concurrency)
+        # --- STATYSTYKI ---
+        self.posted = 0
+        self.replies = 0
+        self.deferred = 0
+        self.replying = 0
+        self.waiting = 0
+
+    def post(self, persona_id: int, chat_id: int, reply: Reply):
+        """Zgłasza nową wiadomość w rozmowie. reply() odpowiada na wszystkie wiadomości późniejsze niż ostatnio obsłużona."""
+        self.posted += 1
+        key = (persona_id, chat_id)
+        chat = self._chats.get(key)
+        if chat is not None:
+            # Odpowiedź w toku w tym procesie - dołączy się kolejna tura, bez pytania Redisa
+            now = time.monotonic()
+            if not chat.dirty: chat.first_post = now
+            chat.last_post = now
+            chat.reply = reply
+            chat.dirty = True
+            return
+        chat = self._chats[key] = _Chat(reply)
+        chat.task = asyncio.create_task(self._run(key, chat))
+
+    async def _acquire(self, key: ChatKey) -> bool:
+        """Flaga pending przed próbą przejęcia lease'a - właściciel zobaczy ją przy zwalnianiu, więc tura nie zginie."""
+        try:
+            async with redis.pipeline(transaction=True) as pipe:
+                pipe.set(_pending_key(key), 1, ex=PENDING_TTL)
+                pipe.set(_lease_key(key), instance_id, nx=True, ex=LEASE_TTL)
+                _, acquired = await pipe.execute()
+            return bool(acquired)
+        except Exception as e:
+            # Bez Redisa zostaje tylko kolejność w obrębie procesu
+            logger.error(f"Reply lease unavailable for {key}: {e}")
+            return True
+
+    async def _take_pending(self, key: ChatKey) -> bool:
+        try:
+            return bool(await redis.getdel(_pending_key(key)))
+        except Exception:
+            return False
+
+    async def _debounce(self, chat: _Chat):
+        """Czeka, aż seria ucichnie na CHAT_DEBOUNCE_WINDOW s, ale nie dłużej niż CHAT_DEBOUNCE_MAX_WAIT od jej początku."""
+        if settings.CHAT_DEBOUNCE_WINDOW <= 0: return
+        deadline = chat.first_post + settings.CHAT_DEBOUNCE_MAX_WAIT
+        while True:
+            wait = min(chat.last_post + settings.CHAT_DEBOUNCE_WINDOW, deadline) - time.monotonic()
+            if wait <= 0: return
+            await asyncio.sleep(wait)
+
+    async def _keep_lease(self, key: ChatKey):
+        while True:
+            await asyncio.sleep(LEASE_TTL / 3)
+            try:
+                if not await refresh_lease(_lease_key(key), LEASE_TTL):
+                    logger.warning(f"Reply lease lost for {key}")
+            except Exception as e:
+                logger.error(f"Reply lease refresh failed for {key}: {e}")
+
+    async def _reply(self, key: ChatKey, chat: _Chat):
+        # Wiadomości, które przyjdą w czasie czekania na miejsce, trafią jeszcze do tej tury
+        self.waiting += 1
+        try:
+            await self._slots.acquire()
+        finally:
+            self.waiting -= 1
+        self.replying += 1
+        try:
+            chat.dirty = False
+            await self._take_pending(key)
+            # Tura, która objęła już wiadomość z flagi, kolejnej nie wywoła (reply sprawdza id)
+            answered = await chat.reply(chat.answered)
+            if answered != chat.answered: self.replies += 1
+            chat.answered = answered
+        except Exception as e:
+            logger.error(f"Reply for {key} failed: {e}", exc_info=True)
+        finally:
+            self.replying -= 1
+            self._slots.release()
+
+    async def _run(self, key: ChatKey, chat: _Chat):
+        try:
+            while chat.dirty:
+                if not await self._acquire(key):
+                    # Odpowiada inny worker - zobaczy flagę pending i odpowie także na tę wiadomość
+                    self.deferred += 1
+                    return
+                keeper = asyncio.create_task(self._keep_lease(key))
+                try:
+                    while chat.dirty:
+                        await self._debounce(chat)
+                        await self._reply(key, chat)
+                        if await self._take_pending(key): chat.dirty = True
+                finally:
+                    keeper.cancel()
+                    try:
+                        await release_lease(_lease_key(key))
+                    except Exception: pass
+                # Wiadomość z innego workera mogła przyjść między sprawdzeniem flagi a zwolnieniem lease'a
+                if await self._take_pending(key): chat.dirty = True
+        finally:
+            self._chats.pop(key, None)
+
+    async def drain(self, timeout: float):
+        """Przy zamykaniu procesu: czeka (maks. timeout s) na odpowiedzi w toku, resztę przerywa."""
+        tasks = [chat.task for chat in self._chats.values() if chat.task]
+        if not tasks: return
+        logger.info(f"Waiting for {len(tasks)} replies in progress...")
+        done, pending = await asyncio.wait(tasks, timeout=timeout)
+        for task in pending: task.cancel()
+        if pending:
+            logger.warning(f"Chat mailbox drain timed out, {len(pending)} replies interrupted")
+            await asyncio.gather(*pending, return_exceptions=True)
+
+    def stats(self) -> dict:
+        return {
+            "active_chats": len(self._chats),
+            "replying": self.replying,
+            "waiting_for_slot": self.waiting,
+            "concurrency": self.concurrency,
+            "messages": self.posted,
+            "replies": self.replies,
+            "deferred_to_other_worker": self.deferred,
+        }
+
+chat_mailbox = ChatMailbox(settings.CHAT_REPLY_CONCURRENCY)
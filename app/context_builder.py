@@ -0,0 +1,102 @@
+import logging
+from functools import lru_cache
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from app.database.session import settings
+
+logger = logging.getLogger(__name__)
+
+# Narzut formatu chat (role, separatory) na każdą wiadomość
+MESSAGE_OVERHEAD_TOKENS = 4
+
+@lru_cache(maxsize=1)
+def _encoding():
+    """Lokalny tokenizer (tiktoken). Gdy niedostępny, liczymy przybliżenie ~4 znaki/token."""
+    try:
+        import tiktoken
+        return tiktoken.get_encoding(settings.AI_TOKENIZER)
+    except Exception as e:
+        logger.warning(f"Tokenizer unavailable, using length estimate: {e}")
+        return None
+
+@lru_cache(maxsize=4096)
+def count_tokens(text: str) -> int:
+    """Liczba tokenów tekstu. Wynik jest cache'owany - stałe fragmenty promptu liczymy raz."""
+    if not text: return 0
+    enc = _encoding()
+    if enc is None: return len(text) // 4 + 1
+    return len(enc.encode(text, disallowed_special=()))
+
+def budget_for_model(model: str) -> int:
+    """Budżet tokenów promptu dla modelu (najdłuższy pasujący prefiks z AI_CONTEXT_TOKENS_BY_MODEL)."""
+    best: Optional[Tuple[int, int]] = None
+    for prefix, budget in settings.AI_CONTEXT_TOKENS_BY_MODEL.items():
+        if model.startswith(prefix) and (best is None or len(prefix) > best[0]):
+            best = (len(prefix), budget)
+    return best[1] if best else settings.AI_CONTEXT_TOKENS
+
+@lru_cache(maxsize=64)
+def _truncate_lines(text: str, max_tokens: int) -> str:
+    """Obcina tekst do max_tokens całymi liniami (nagłówek katalogu zostaje, giną ostatnie pozycje).
+    Katalogi zmieniają się rzadko, więc wynik jest cache'owany per (tekst, limit)."""
+    if count_tokens(text) <= max_tokens: return text
+    kept, used = [], 0
+    for line in text.split("\n"):
+        cost = count_tokens(line + "\n")
+        if used + cost > max_tokens: break
+        kept.append(line); used += cost
+    return "\n".join(kept)
+
+def supports_cache_control(model: str) -> bool:
+    """Czy model przyjmuje jawne punkty cache_control (Anthropic, Gemini przez OpenRouter)."""
+    return any(model.startswith(prefix) for prefix in settings.AI_CACHE_CONTROL_MODELS)
+
+def build_context(model: str, segments: Iterable[Tuple[str, str]], history: List[dict],
+                  truncatable: Iterable[str] = (), cache_until: Optional[str] = None) -> Tuple[List[dict], Dict[str, int]]:
+    """
+    Składa listę wiadomości dla modelu w budżecie tokenów.
+    segments - nazwane fragmenty promptu systemowego, od najstabilniejszego do najbardziej zmiennego
+               (wspólny prefiks wielu użytkowników trafia w cache promptu dostawcy),
+    truncatable - nazwy fragmentów, które można przyciąć do AI_CATALOG_TOKENS (katalogi),
+    cache_until - nazwa ostatniego segmentu stałego prefiksu; dla modeli z cache_control
+                  prompt systemowy dzielony jest w tym miejscu na dwie części,
+    history - ostatnie wiadomości (najstarsza pierwsza); najstarsze wypadają, gdy brakuje miejsca.
+    Zwraca (wiadomości, liczba tokenów per segment).
+    """
+    budget = budget_for_model(model)
+    truncatable = set(truncatable)
+    report: Dict[str, int] = {}
+    parts = []
+    prefix_len = 0
+    for name, text in segments:
+        if text:
+            if name in truncatable:
+                text = _truncate_lines(text, settings.AI_CATALOG_TOKENS)
+            report[name] = count_tokens(text)
+            parts.append(text)
+        if name == cache_until: prefix_len = len(parts)
+    system_tokens = sum(report.values()) + MESSAGE_OVERHEAD_TOKENS
+
+    prefix, rest = "".join(parts[:prefix_len]), "".join(parts[prefix_len:])
+    if prefix and supports_cache_control(model):
+        system_content = [{"type": "text", "text": prefix, "cache_control": {"type": "ephemeral"}}]
+        if rest: system_content.append({"type": "text", "text": rest})
+    else:
+        system_content = prefix + rest
+
+    # Historia od najnowszej - zawsze zostawiamy przynajmniej ostatnią wiadomość
+    remaining = budget - system_tokens
+    kept: List[dict] = []
+    history_tokens = 0
+    for msg in reversed(history):
+        cost = count_tokens(msg["content"]) + MESSAGE_OVERHEAD_TOKENS
+        if kept and cost > remaining: break
+        kept.append(msg); remaining -= cost; history_tokens += cost
+    kept.reverse()
+
+    report["history"] = history_tokens
+    report["history_messages"] = len(kept)
+    report["dropped_messages"] = len(history) - len(kept)
+    report["total"] = system_tokens + history_tokens
+    report["budget"] = budget
+    return [{"role": "system", "content": system_content}] + kept, report
@@ -0,0 +1,130 @@
+import asyncio
+import json
+import logging
+from collections import defaultdict
+from typing import Dict, List, Tuple
+from sqlalchemy import event, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+from redis.exceptions import WatchError
+
+from app.database.session import settings
+from app.database.models import Message
+from app.bot_manager import redis
+
+logger = logging.getLogger(__name__)
+
+# Ostatnie N wiadomości rozmowy użytkownika z personą (lista JSON-ów, najstarsza pierwsza)
+Conversation = Tuple[int, int]  # (user_id, persona_id; 0 = bez persony)
+
+def _key(conversation: Conversation) -> str:
+    user_id, persona_id = conversation
+    return f"ctx:{user_id}:{persona_id}"
+
+def _version_key(conversation: Conversation) -> str:
+    # Licznik zapisów rozmowy - wczytanie bufora z bazy nie nadpisze wiadomości dopisanych w trakcie odczytu
+    user_id, persona_id = conversation
+    return f"ctxv:{user_id}:{persona_id}"
+
+# Zapisy do Redisa w toku - odczyt historii czeka na nie, żeby widzieć świeżo zapisane wiadomości
+_pending: Dict[Conversation, asyncio.Task] = {}
+
+async def _wait_pending(conversation: Conversation):
+    pending = _pending.get(conversation)
+    if pending is not None:
+        await asyncio.gather(pending, return_exceptions=True)
+
+def _entry(role: str, content: str) -> str:
+    return json.dumps({"role": role, "content": content}, ensure_ascii=False)
+
+async def _push(conversation: Conversation, entries: List[str], previous):
+    if previous is not None:
+        # Zachowujemy kolejność zapisów dla jednej rozmowy
+        await asyncio.gather(previous, return_exceptions=True)
+    key, version_key = _key(conversation), _version_key(conversation)
+    try:
+        async with redis.pipeline(transaction=True) as pipe:
+            # RPUSHX dopisuje tylko do istniejącego bufora - zimny użytkownik zostanie wczytany z bazy
+            pipe.rpushx(key, *entries)
+            pipe.ltrim(key, -settings.CONTEXT_CACHE_MESSAGES, -1)
+            pipe.expire(key, settings.CONTEXT_CACHE_TTL)
+            # Także gdy bufora nie ma: trwające właśnie wczytywanie z bazy mogło tej wiadomości nie zobaczyć
+            pipe.incr(version_key)
+            pipe.expire(version_key, settings.CONTEXT_CACHE_TTL)
+            await pipe.execute()
+    except Exception as e:
+        logger.error(f"Context cache write failed for {key}: {e}")
+        try: await redis.delete(key)
+        except Exception: pass
+
+@event.listens_for(Session, "after_flush")
+def _collect_new_messages(session, flush_context):
+    new = [((m.user_id, m.persona_id or 0), m.role, m.content) for m in session.new if isinstance(m, Message)]
+    if new: session.info.setdefault("_ctx_new_messages", []).extend(new)
+
+@event.listens_for(Session, "after_commit")
+def _write_through(session):
+    """Po commicie dopisuje nowe wiadomości do buforów w Redisie (w tle, w kolejności commitów)."""
+    new = session.info.pop("_ctx_new_messages", None)
+    if not new: return
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        return
+    by_conversation = defaultdict(list)
+    for conversation, role, content in new:
+        by_conversation[conversation].append(_entry(role, content))
+    for conversation, entries in by_conversation.items():
+        task = loop.create_task(_push(conversation, entries, _pending.get(conversation)))
+        _pending[conversation] = task
+        task.add_done_callback(lambda t, c=conversation: _pending.pop(c, None) if _pending.get(c) is t else None)
+
+@event.listens_for(Session, "after_rollback")
+def _discard_new_messages(session):
+    session.info.pop("_ctx_new_messages", None)
+
+async def get_history(db: AsyncSession, user_id: int, persona_id: int) -> List[dict]:
+    """
+    Zwraca ostatnie wiadomości rozmowy użytkownika z personą jako listę {"role", "content"} (najstarsza pierwsza).
+    Aktywne rozmowy obsługuje Redis, przy braku bufora historia jest wczytywana z Postgresa.
+    Bufor jest odbudowywany tylko wtedy, gdy od początku odczytu nie przybyło wiadomości (licznik zapisów).
+    """
+    limit = settings.CONTEXT_CACHE_MESSAGES
+    conversation = (user_id, persona_id)
+    key, version_key = _key(conversation), _version_key(conversation)
+    await _wait_pending(conversation)
+    try:
+        async with redis.pipeline(transaction=True) as pipe:
+            pipe.lrange(key, -limit, -1)
+            pipe.get(version_key)
+            cached, version = await pipe.execute()
+        if cached:
+            return [json.loads(item) for item in cached]
+    except Exception as e:
+        logger.error(f"Context cache read failed for {key}: {e}")
+        cached = None
+
+    rows = (await db.execute(
+        select(Message.role, Message.content).where(Message.user_id == user_id, Message.persona_id == persona_id)
+        .order_by(Message.timestamp.desc()).limit(limit)
+    )).all()
+    history = [{"role": role, "content": content} for role, content in reversed(rows)]
+
+    if history and cached is not None:
+        # Zapis z commitu, który odczyt z bazy już widział, ma podbić licznik przed porównaniem (inaczej zdubluje wpis)
+        await _wait_pending(conversation)
+        try:
+            async with redis.pipeline(transaction=True) as pipe:
+                await pipe.watch(version_key)
+                if await pipe.get(version_key) == version:
+                    pipe.multi()
+                    pipe.delete(key)
+                    pipe.rpush(key, *[_entry(m["role"], m["content"]) for m in history])
+                    pipe.expire(key, settings.CONTEXT_CACHE_TTL)
+                    await pipe.execute()
+        except WatchError:
+            # Wiadomość zapisana w trakcie odczytu - bufor zostaje pusty, następna tura wczyta go z bazy
+            pass
+        except Exception as e:
+            logger.error(f"Context cache fill failed for {key}: {e}")
+    return history
@@ -0,0 +1,101 @@
+import re
+from typing import List, NamedTuple, Optional, Tuple, Union
+
+# --- AKCJE WYNIKAJĄCE Z TAGÓW ---
+class CustomRequestAction(NamedTuple):
+    description: str
+
+class PpvAction(NamedTuple):
+    tag: str
+
+class PromoAction(NamedTuple):
+    tag: str
+
+class MemoryAction(NamedTuple):
+    key: str
+    value: str
+
+TagAction = Union[CustomRequestAction, PpvAction, PromoAction, MemoryAction]
+
+# Tagi sterujące, które model wstawia do odpowiedzi
+TAG_NAMES = ("CUSTOM_REQ", "PPV", "PROMO", "MEM")
+_TAG_PREFIXES = tuple(f"[{name}:" for name in TAG_NAMES)
+_PREFIX_LEN = max(len(p) for p in _TAG_PREFIXES)
+_TAG_RE = re.compile(r"\[(CUSTOM_REQ|PPV|PROMO|MEM):[ \t]*([^\]\n]*?)\]", re.IGNORECASE)
+
+# Dłuższy "tag" bez zamknięcia traktujemy jako zwykły tekst
+MAX_TAG_LENGTH = 500
+
+def _to_action(name: str, value: str) -> Optional[TagAction]:
+    name = name.upper()
+    if name == "CUSTOM_REQ": return CustomRequestAction(value.strip())
+    if name == "PPV": return PpvAction(value.strip().lower())
+    if name == "PROMO": return PromoAction(value.strip().lower())
+    if "=" not in value: return None
+    k, v = value.split("=", 1)
+    k, v = k.strip().lower(), v.strip()
+    return MemoryAction(k, v) if k and v else None
+
+def parse_control_tags(text: str) -> Tuple[str, List[TagAction]]:
+    """
+    Jednoprzebiegowy parser gotowej odpowiedzi.
+    Zwraca tekst bez tagów (ze znormalizowanymi spacjami) i listę akcji w kolejności wystąpienia.
+    """
+    actions: List[TagAction] = []
+    if "[" in text:
+        def collect(m: "re.Match") -> str:
+            action = _to_action(m.group(1), m.group(2))
+            if action: actions.append(action)
+            return " "
+        text = _TAG_RE.sub(collect, text)
+    return " ".join(text.split()), actions
+
+def _could_be_tag(candidate: str) -> bool:
+    """Czy początek bufora (od '[') może jeszcze okazać się tagiem sterującym."""
+    head = candidate[:_PREFIX_LEN].upper()
+    return any(p.startswith(head) or head.startswith(p) for p in _TAG_PREFIXES)
+
+class TagStreamParser:
+    """
+    Przyrostowy parser tagów dla odpowiedzi strumieniowanych.
+    feed() przyjmuje kolejne fragmenty i zwraca (tekst bez tagów, akcje z zamkniętych tagów).
+    Niedomknięty tag czeka w buforze na następny fragment.
+    """
+    def __init__(self):
+        self._buf = ""
+
+    def feed(self, chunk: str) -> Tuple[str, List[TagAction]]:
+        if not self._buf and "[" not in chunk:
+            return chunk, []
+        data = self._buf + chunk
+        self._buf = ""
+        out: List[str] = []
+        actions: List[TagAction] = []
+        pos = 0
+        while True:
+            start = data.find("[", pos)
+            if start == -1:
+                out.append(data[pos:]); break
+            out.append(data[pos:start])
+            end = data.find("]", start)
+            newline = data.find("\n", start)
+            candidate = data[start:end + 1] if end != -1 else data[start:]
+            if not _could_be_tag(candidate) or (newline != -1 and (end == -1 or newline < end)):
+                out.append("["); pos = start + 1; continue
+            if end == -1:
+                if len(candidate) > MAX_TAG_LENGTH:
+                    out.append("["); pos = start + 1; continue
+                self._buf = candidate; break
+            match = _TAG_RE.fullmatch(candidate)
+            if match:
+                action = _to_action(match.group(1), match.group(2))
+                if action: actions.append(action)
+            else:
+                out.append(candidate)
+            pos = end + 1
+        return "".join(out), actions
+
+    def finish(self) -> str:
+        """Zwraca resztę bufora (niedomknięty nawias) jako zwykły tekst."""
+        rest, self._buf = self._buf, ""
+        return rest
@@ -0,0 +1,34 @@
+import asyncio
+from sqlalchemy import text
+from app.database.session import engine
+
+BACKFILL = """
+UPDATE users u SET
+    user_message_count = s.user_msgs,
+    assistant_message_count = s.assistant_msgs,
+    lifetime_tokens = s.tokens,
+    lifetime_ai_cost = s.cost
+FROM (
+    SELECT user_id,
+           COUNT(*) FILTER (WHERE role = 'user') AS user_msgs,
+           COUNT(*) FILTER (WHERE role <> 'user') AS assistant_msgs,
+           COALESCE(SUM(COALESCE(prompt_tokens, 0) + COALESCE(completion_tokens, 0)), 0) AS tokens,
+           COALESCE(SUM(ai_cost), 0) AS cost
+    FROM messages
+    GROUP BY user_id
+) s
+WHERE u.telegram_id = s.user_id
+"""
+
+async def backfill_user_counters():
+    """
+    Jednorazowe przeliczenie liczników User z tabeli messages (po alembic upgrade head).
+    Najlepiej uruchomić przy zatrzymanym bocie - wiadomości zapisane w trakcie mogą zostać policzone błędnie.
+    """
+    async with engine.begin() as conn:
+        result = await conn.execute(text(BACKFILL))
+        print(f"✅ Backfilled counters for {result.rowcount} users")
+    await engine.dispose()
+
+if __name__ == "__main__":
+    asyncio.run(backfill_user_counters())
@@ -1,7 +1,10 @@
-from datetime import datetime
+from datetime import date, datetime
 from typing import Optional, List
-from sqlalchemy import BigInteger, String, Boolean, DateTime, ForeignKey, Text, Float, JSON, Table, Column, Integer
-from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
+from collections import defaultdict
+from sqlalchemy import BigInteger, String, Boolean, Date, DateTime, ForeignKey, Text, Float, JSON, Table, Column, Integer, Index, event, update, func
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship, Session
+from sqlalchemy.orm.attributes import set_committed_value
 from sqlalchemy.ext.asyncio import AsyncAttrs
 
 class Base(AsyncAttrs, DeclarativeBase):
@@ -26,6 +29,10 @@ class User(Base):
     telegram_id: Mapped[int] = mapped_column(BigInteger, primary_key=True, index=True)
     username: Mapped[Optional[str]] = mapped_column(String(255), nullable=True)
     subscription_expires_at: Mapped[Optional[datetime]] = mapped_column(DateTime(timezone=True), nullable=True)
+    # Kiedy wygasły VIP został usunięty z kanału (NULL = do obsłużenia po wygaśnięciu, zerowane przy odnowieniu)
+    vip_kicked_at: Mapped[Optional[datetime]] = mapped_column(DateTime(timezone=True), nullable=True)
+    # Persona (bot), z którą użytkownik rozmawia - przez jej bota idą broadcasty, zaproszenia i usunięcie z kanału (bez FK jak w messages)
+    persona_id: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
     credits: Mapped[int] = mapped_column(default=10)
     info: Mapped[dict] = mapped_column(JSON, default={})
     
@@ -35,6 +42,13 @@ class User(Base):
     bonus_credits: Mapped[int] = mapped_column(Integer, default=0)
     # ----------------------------
 
+    # --- LICZNIKI (aktualizowane przy każdym insercie Message) ---
+    user_message_count: Mapped[int] = mapped_column(Integer, default=0, server_default="0")
+    assistant_message_count: Mapped[int] = mapped_column(Integer, default=0, server_default="0")
+    lifetime_tokens: Mapped[int] = mapped_column(BigInteger, default=0, server_default="0")
+    lifetime_ai_cost: Mapped[float] = mapped_column(Float, default=0.0, server_default="0")
+    # ----------------------------
+
     created_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), default=datetime.utcnow)
     
     messages: Mapped[List["Message"]] = relationship("Message", back_populates="user")
@@ -58,6 +72,12 @@ class Message(Base):
     ai_cost: Mapped[Optional[float]] = mapped_column(Float, default=0.0)
     prompt_tokens: Mapped[Optional[int]] = mapped_column(Integer, default=0)
     completion_tokens: Mapped[Optional[int]] = mapped_column(Integer, default=0)
+    # Część prompt_tokens obsłużona z cache dostawcy (prompt caching)
+    cached_prompt_tokens: Mapped[Optional[int]] = mapped_column(Integer, default=0)
+    # Persona, która prowadziła rozmowę (bez FK - statystyki zostają po usunięciu persony)
+    persona_id: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
+    # message_id z Telegrama dla wiadomości przychodzących (idempotencja ponowionych update'ów)
+    tg_message_id: Mapped[Optional[int]] = mapped_column(BigInteger, nullable=True)
     timestamp: Mapped[datetime] = mapped_column(DateTime(timezone=True), default=datetime.utcnow)
     user: Mapped["User"] = relationship("User", back_populates="messages")
 
@@ -67,6 +87,7 @@ class Transaction(Base):
     user_id: Mapped[int] = mapped_column(ForeignKey("users.telegram_id"))
     amount: Mapped[float] = mapped_column(Float)
     status: Mapped[str] = mapped_column(String(20))
+    persona_id: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
     created_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), default=datetime.utcnow)
     user: Mapped["User"] = relationship("User", back_populates="transactions")
 
@@ -78,6 +99,8 @@ class Persona(Base):
     telegram_token: Mapped[Optional[str]] = mapped_column(String(255), nullable=True)
     openrouter_token: Mapped[Optional[str]] = mapped_column(String(255), nullable=True)
     ai_model: Mapped[str] = mapped_column(String(100), default="openrouter/free")
+    # Modele w kolejności failoveru (pierwszy = ai_model); puste = tylko ai_model
+    ai_models: Mapped[Optional[List[str]]] = mapped_column(JSON, nullable=True)
     timezone: Mapped[str] = mapped_column(String(50), default="America/New_York")
     private_channel_id: Mapped[Optional[str]] = mapped_column(String(255), nullable=True)
     vip_subscription_price: Mapped[int] = mapped_column(Integer, default=500)
@@ -143,7 +166,8 @@ class BroadcastLog(Base):
     id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
     broadcast_id: Mapped[int] = mapped_column(ForeignKey("broadcasts.id"))
     user_id: Mapped[int] = mapped_column(ForeignKey("users.telegram_id"))
-    status: Mapped[str] = mapped_column(String(20)) 
+    # pending / claimed / sending / sent / failed / cancelled - stan wysyłki do odbiorcy (patrz app/broadcast_engine.py)
+    status: Mapped[str] = mapped_column(String(20), default="pending")
     error_message: Mapped[Optional[str]] = mapped_column(String(255), nullable=True)
     timestamp: Mapped[datetime] = mapped_column(DateTime(timezone=True), default=datetime.utcnow)
     broadcast: Mapped["Broadcast"] = relationship("Broadcast", back_populates="logs")
@@ -159,4 +183,135 @@ class CustomRequest(Base):
     media_type: Mapped[Optional[str]] = mapped_column(String(20), nullable=True)
     price: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
     created_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), default=datetime.utcnow)
-    user: Mapped["User"] = relationship("User")
\ No newline at end of file
+    user: Mapped["User"] = relationship("User")
+
+class DailyMetrics(Base):
+    """Dzienne agregaty per persona (persona_id 0 = bez persony), utrzymywane przyrostowo przy zapisie Message/Transaction."""
+    __tablename__ = "daily_metrics"
+    day: Mapped[date] = mapped_column(Date, primary_key=True)
+    persona_id: Mapped[int] = mapped_column(Integer, primary_key=True, default=0)
+    user_messages: Mapped[int] = mapped_column(Integer, default=0, server_default="0")
+    assistant_messages: Mapped[int] = mapped_column(Integer, default=0, server_default="0")
+    prompt_tokens: Mapped[int] = mapped_column(BigInteger, default=0, server_default="0")
+    completion_tokens: Mapped[int] = mapped_column(BigInteger, default=0, server_default="0")
+    cached_prompt_tokens: Mapped[int] = mapped_column(BigInteger, default=0, server_default="0")
+    ai_cost: Mapped[float] = mapped_column(Float, default=0.0, server_default="0")
+    payments: Mapped[int] = mapped_column(Integer, default=0, server_default="0")
+    revenue: Mapped[float] = mapped_column(Float, default=0.0, server_default="0")
+    # Wiadomości użytkowników obsłużone wspólną turą AI zamiast osobnego wywołania (chat_mailbox)
+    llm_calls_saved: Mapped[int] = mapped_column(Integer, default=0, server_default="0")
+
+# --- INDEKSY POD NAJCZĘSTSZE ZAPYTANIA (migracja 0003) ---
+# (timestamp, id) - kursor podglądu czatu w panelu; prefiks obsługuje też odczyt historii do promptu
+Index("ix_messages_user_id_timestamp_id", Message.user_id, Message.timestamp.desc(), Message.id.desc())
+Index("ix_messages_user_id_role", Message.user_id, Message.role)
+Index("ix_messages_user_id_persona_id_tg_message_id", Message.user_id, Message.persona_id, Message.tg_message_id,
+      postgresql_where=Message.tg_message_id.isnot(None))
+Index("ix_transactions_user_id_status_created_at", Transaction.user_id, Transaction.status, Transaction.created_at)
+# (expires_at, telegram_id) - kursor listy wygasłych VIP-ów i filtr VIP w wyszukiwarce użytkowników
+Index("ix_users_subscription_expires_at_id", User.subscription_expires_at, User.telegram_id)
+# Kolejka sweeper'a VIP - tylko nieobsłużone subskrypcje, więc indeks nie rośnie z historią
+Index("ix_users_vip_pending_expiry", User.subscription_expires_at, User.telegram_id,
+      postgresql_where=User.vip_kicked_at.is_(None), sqlite_where=User.vip_kicked_at.is_(None))
+# Wyszukiwarka użytkowników: prefiks nazwy + kursor (nazwa, id). Collation "C" pozwala jednym indeksem
+# obsłużyć LIKE 'abc%' i sortowanie; indeks istnieje tylko w Postgresie (patrz username_sort_key)
+Index("ix_users_username_search", func.coalesce(func.lower(User.username), "").collate("C"), User.telegram_id).ddl_if(dialect="postgresql")
+Index("ix_broadcast_logs_broadcast_id_status", BroadcastLog.broadcast_id, BroadcastLog.status)
+# Jeden wiersz na odbiorcę broadcastu - gwarancja, że nikt nie dostanie wiadomości dwa razy
+Index("uq_broadcast_logs_broadcast_id_user_id", BroadcastLog.broadcast_id, BroadcastLog.user_id, unique=True)
+
+# --- LICZNIKI UŻYTKOWNIKA ---
+@event.listens_for(Session, "after_flush")
+def _update_user_counters(session, flush_context):
+    """
+    Podbija liczniki User w tej samej transakcji, w której zapisywane są nowe Message.
+    Dzięki temu limit wiadomości nie wymaga COUNT(*) po całej historii.
+    """
+    totals = defaultdict(lambda: [0, 0, 0, 0.0])
+    for obj in session.new:
+        if not isinstance(obj, Message): continue
+        t = totals[obj.user_id]
+        if obj.role == "user": t[0] += 1
+        else: t[1] += 1
+        t[2] += (obj.prompt_tokens or 0) + (obj.completion_tokens or 0)
+        t[3] += obj.ai_cost or 0.0
+    if not totals: return
+
+    conn = session.connection()
+    for user_id, (user_msgs, assistant_msgs, tokens, cost) in totals.items():
+        conn.execute(
+            update(User).where(User.telegram_id == user_id).values(
+                user_message_count=User.user_message_count + user_msgs,
+                assistant_message_count=User.assistant_message_count + assistant_msgs,
+                lifetime_tokens=User.lifetime_tokens + tokens,
+                lifetime_ai_cost=User.lifetime_ai_cost + cost,
+            )
+        )
+    session.info["_user_counter_deltas"] = totals
+
+@event.listens_for(Session, "after_flush_postexec")
+def _sync_user_counters(session, flush_context):
+    """Obiekty User w sesji dostają te same wartości liczników bez dodatkowego SELECT-a."""
+    totals = session.info.pop("_user_counter_deltas", None)
+    if not totals: return
+    for user_id, deltas in totals.items():
+        user = session.identity_map.get(session.identity_key(User, user_id))
+        if user is None: continue
+        for attr, delta in zip(("user_message_count", "assistant_message_count", "lifetime_tokens", "lifetime_ai_cost"), deltas):
+            if attr in user.__dict__:
+                set_committed_value(user, attr, (user.__dict__[attr] or 0) + delta)
+
+# --- DZIENNE METRYKI ---
+METRIC_FIELDS = ("user_messages", "assistant_messages", "prompt_tokens", "completion_tokens",
+                 "cached_prompt_tokens", "ai_cost", "payments", "revenue", "llm_calls_saved")
+
+@event.listens_for(Session, "before_flush")
+def _stamp_persona(session, flush_context, instances):
+    """Nowe Message/Transaction dostają persona_id z sesji (db.info["persona_id"] ustawia handler)."""
+    persona_id = session.info.get("persona_id")
+    if persona_id is None: return
+    for obj in session.new:
+        if isinstance(obj, (Message, Transaction)) and obj.persona_id is None:
+            obj.persona_id = persona_id
+
+def _metric_deltas(obj) -> Optional[dict]:
+    if isinstance(obj, Message):
+        return {
+            "user_messages": 1 if obj.role == "user" else 0, "assistant_messages": 0 if obj.role == "user" else 1,
+            "prompt_tokens": obj.prompt_tokens or 0, "completion_tokens": obj.completion_tokens or 0,
+            "cached_prompt_tokens": obj.cached_prompt_tokens or 0, "ai_cost": obj.ai_cost or 0.0,
+        }
+    if isinstance(obj, Transaction) and obj.status == "completed":
+        return {"payments": 1, "revenue": obj.amount or 0.0}
+    return None
+
+def upsert_daily_metrics(conn, totals):
+    """Dodaje przyrosty do wierszy daily_metrics (INSERT ... ON CONFLICT DO UPDATE, atomowo między workerami)."""
+    insert = postgresql.insert if conn.dialect.name == "postgresql" else sqlite.insert
+    table = DailyMetrics.__table__
+    # Stała kolejność kluczy - równoległe transakcje blokują wiersze w tej samej kolejności
+    for (day, persona_id), deltas in sorted(totals.items()):
+        stmt = insert(table).values(day=day, persona_id=persona_id, **deltas)
+        conn.execute(stmt.on_conflict_do_update(
+            index_elements=[table.c.day, table.c.persona_id],
+            set_={name: table.c[name] + stmt.excluded[name] for name in deltas},
+        ))
+
+@event.listens_for(Session, "after_flush")
+def _update_daily_metrics(session, flush_context):
+    """Podbija dzienne agregaty w tej samej transakcji co nowe wiadomości i płatności."""
+    totals = {}
+    for obj in session.new:
+        deltas = _metric_deltas(obj)
+        if deltas is None: continue
+        stamp = obj.timestamp if isinstance(obj, Message) else obj.created_at
+        key = ((stamp or datetime.utcnow()).date(), obj.persona_id or 0)
+        row = totals.setdefault(key, dict.fromkeys(METRIC_FIELDS, 0))
+        for name, value in deltas.items(): row[name] += value
+    # Oszczędzone wywołania (db.info["llm_calls_saved"] = (persona_id, n)) zapisywane razem z odpowiedzią tury
+    saved = session.info.pop("llm_calls_saved", None) if totals else None
+    if saved:
+        key = (datetime.utcnow().date(), saved[0] or 0)
+        totals.setdefault(key, dict.fromkeys(METRIC_FIELDS, 0))["llm_calls_saved"] += saved[1]
+    if totals:
+        upsert_daily_metrics(session.connection(), totals)
@@ -1,4 +1,5 @@
 import os
+from typing import Dict, List
 from pydantic_settings import BaseSettings
 from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 
@@ -7,6 +8,7 @@ class Settings(BaseSettings):
     WEBHOOK_URL: str
     ADMIN_USER: str
     ADMIN_PASS: str
+    ADMIN_CHAT_PAGE_SIZE: int = 100
     DATABASE_URL: str
     REDIS_URL: str
     OPENROUTER_KEY: str
@@ -15,6 +17,77 @@ class Settings(BaseSettings):
     AI_MAX_TOKENS: int = 250
     SYSTEM_PROMPT: str = "Personality"
 
+    # --- POOL POŁĄCZEŃ OPENROUTER ---
+    AI_BASE_URL: str = "https://openrouter.ai/api/v1"
+    AI_HTTP2: bool = True
+    AI_MAX_CONNECTIONS: int = 100
+    AI_MAX_KEEPALIVE_CONNECTIONS: int = 20
+    AI_KEEPALIVE_EXPIRY: float = 60.0
+    AI_TIMEOUT: float = 60.0
+    AI_STREAMING: bool = True
+
+    # --- FAILOVER MODELI (Persona.ai_models; breakery i statystyki per worker) ---
+    AI_MODEL_TIMEOUT: float = 30.0
+    AI_MODEL_TIMEOUTS: Dict[str, float] = {}
+    # Po AI_BREAKER_FAILURES błędach z rzędu model jest pomijany przez AI_BREAKER_COOLDOWN s
+    AI_BREAKER_FAILURES: int = 3
+    AI_BREAKER_COOLDOWN: float = 60.0
+    # Drugie zapytanie, gdy model nie odpowie w swoim p95 (liczonym z ostatnich AI_LATENCY_WINDOW odpowiedzi)
+    AI_HEDGE: bool = False
+    AI_HEDGE_MIN_DELAY: float = 2.0
+    AI_HEDGE_MIN_SAMPLES: int = 20
+    AI_LATENCY_WINDOW: int = 200
+
+    # --- BUDŻET KONTEKSTU (tokeny promptu) ---
+    AI_TOKENIZER: str = "cl100k_base"
+    AI_CONTEXT_TOKENS: int = 6000
+    AI_CONTEXT_TOKENS_BY_MODEL: Dict[str, int] = {}
+    AI_CATALOG_TOKENS: int = 1500
+    # Modele (prefiksy), którym wysyłamy jawne znaczniki cache_control - pozostali dostawcy cache'ują prefiks sami
+    AI_CACHE_CONTROL_MODELS: List[str] = ["anthropic/", "google/gemini"]
+
+    # --- BUFOR KONTEKSTU ROZMOWY (REDIS) ---
+    CONTEXT_CACHE_MESSAGES: int = 40
+    CONTEXT_CACHE_TTL: int = 6 * 3600
+
+    # --- KOLEJKA WEBHOOKA ---
+    UPDATE_QUEUE_MAXSIZE: int = 1000
+    UPDATE_WORKERS: int = 16
+    UPDATE_DRAIN_TIMEOUT: float = 10.0
+
+    # --- SKLEJANIE SERII WIADOMOŚCI (0 = odpowiedź od razu) ---
+    # Odpowiedź rusza po CHAT_DEBOUNCE_WINDOW s ciszy, najpóźniej CHAT_DEBOUNCE_MAX_WAIT s od pierwszej wiadomości serii
+    CHAT_DEBOUNCE_WINDOW: float = 0.0
+    CHAT_DEBOUNCE_MAX_WAIT: float = 8.0
+    # Tury AI trwające naraz w jednym workerze (model + zapis; połączenie z bazą tura trzyma tylko przy odczycie i zapisie)
+    CHAT_REPLY_CONCURRENCY: int = 64
+
+    # --- ODPOWIEDZI PRZERWANE RESTARTEM (0 = wyłączone) ---
+    # Webhook potwierdza update od razu, więc Telegram go nie ponowi - wiadomości zapisane przed padem procesu,
+    # bez odpowiedzi, podejmuje skan po starcie (nie starsze niż okno, spośród ostatnich REPLY_RECOVERY_SCAN wiadomości)
+    REPLY_RECOVERY_WINDOW: float = 3600.0
+    REPLY_RECOVERY_GRACE: float = 90.0
+    REPLY_RECOVERY_SCAN: int = 5000
+
+    # --- BROADCAST (limity Telegrama: ~30 wiadomości/s globalnie, ~1/s na czat) ---
+    BROADCAST_RATE: float = 25.0
+    BROADCAST_BURST: int = 25
+    BROADCAST_PER_CHAT_INTERVAL: float = 1.0
+    BROADCAST_SENDERS: int = 20
+    BROADCAST_MAX_RETRIES: int = 3
+    BROADCAST_LOG_CHUNK: int = 500
+    BROADCAST_FLUSH_INTERVAL: float = 2.0
+    BROADCAST_CLAIM_BATCH: int = 500
+    BROADCAST_POLL_INTERVAL: float = 5.0
+    BROADCAST_STOP_TIMEOUT: float = 10.0
+
+    # --- WYGASANIE VIP ---
+    VIP_SWEEP_BATCH: int = 200
+    VIP_SWEEP_CONCURRENCY: int = 10
+    VIP_SWEEP_MAX_SLEEP: float = 3600.0
+    # Ponowienie usunięć, które się nie udały (persona nieaktywna, błąd API)
+    VIP_SWEEP_RETRY_INTERVAL: float = 300.0
+
     class Config:
         env_file = ".env"
         extra = "ignore"
@@ -1,28 +1,36 @@
-import logging, sys, re, asyncio, random
+import logging, sys, asyncio, random
+from typing import Optional
 from datetime import datetime, timedelta
-from zoneinfo import ZoneInfo
 from contextlib import asynccontextmanager
 from fastapi import FastAPI, Request
-from aiogram import types, F
+from fastapi.responses import JSONResponse
+from aiogram import Bot, types, F
 from aiogram.types import LabeledPrice, PreCheckoutQuery, Message as TGMessage
-from aiogram.fsm.context import FSMContext
-from aiogram.fsm.state import State, StatesGroup
-from sqlalchemy import select, func
+from sqlalchemy import select, func, case
 from sqlalchemy.orm import selectinload
 from sqlalchemy.orm.attributes import flag_modified
-from openai import AsyncOpenAI
 
-from app.database.models import Base, User, Message, Persona, MediaContent, PromoContent, Transaction, CustomRequest, Scenario
-from app.database.session import settings, engine, AsyncSessionLocal
-
-from app.bot_manager import dp, init_bot, get_bot
+from app.database.models import User, Message, MediaContent, Transaction, CustomRequest
+from app.database.session import settings, AsyncSessionLocal
+
+from app.bot_manager import dp, get_bot, resolve_bot, register_webhooks, close_bots
+from app.persona_cache import get_persona, get_scenario_schedule, reload_persona_cache
+from app.catalog_cache import get_catalog, reload_catalog_cache
+from app.cache_bus import listen_cache_changes
+from app.ai_clients import get_ai_client, client_in_use, close_ai_clients
+from app.model_router import complete, persona_models
+from app.update_queue import update_queue
+from app.chat_mailbox import chat_mailbox
+from app.redis_lease import acquire_lease
+from app.broadcast_engine import broadcast_worker, stop_broadcasts
+from app.vip_sweeper import check_expired_subscriptions
+from app.context_cache import get_history
+from app.context_builder import build_context, count_tokens
+from app.control_tags import TagStreamParser, parse_control_tags, CustomRequestAction, PpvAction, PromoAction, MemoryAction
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s', handlers=[logging.StreamHandler(sys.stdout), logging.FileHandler("app_main.log")])
 logger = logging.getLogger(__name__)
 
-class ChatState(StatesGroup):
-    waiting_for_ai = State()
-
 DEFAULT_SKYE_PROMPT = """
 ROLE:
 You are Skye Carter, a 23-year-old fitness influencer and model living in Miami, Florida.
@@ -59,55 +67,61 @@ You are chatting with a fan on Telegram. Your MAIN GOAL is to build a flirty, em
 
 MEMORY_INSTRUCTIONS = "\n--- MEMORY EXTRACTION INSTRUCTIONS ---\nYour goal is to learn about the user to build a deep connection.\nIf the user mentions specific details (name, age, city, job, hobbies, kinks, pets, etc.), output a memory tag [MEM: key=value] at the start of your response."
 
-async def check_expired_subscriptions():
-    while True:
-        try:
-            bot = await get_bot()
-            if not bot:
-                await asyncio.sleep(60)
-                continue
-                
-            async with AsyncSessionLocal() as db:
-                now = datetime.utcnow()
-                expired_users = (await db.execute(select(User).where(User.subscription_expires_at < now))).scalars().all()
-                active_persona = await db.scalar(select(Persona).where(Persona.is_active == True).limit(1))
-                
-                channel_id = active_persona.private_channel_id if active_persona else None
-                
-                for u in expired_users:
-                    user_info = dict(u.info) if u.info else {}
-                    if user_info.get("vip_kicked"):
-                        continue
-                        
-                    if channel_id:
-                        try:
-                            await bot.ban_chat_member(chat_id=channel_id, user_id=u.telegram_id)
-                            await bot.unban_chat_member(chat_id=channel_id, user_id=u.telegram_id)
-                            await bot.send_message(
-                                chat_id=u.telegram_id, 
-                                text="Babe, twoja subskrypcja VIP właśnie wygasła i musiałam cię usunąć z mojego prywatnego pokoju 🥺 Strasznie mi ciebie brakuje... opłać dostęp na kolejne 30 dni, czekam na ciebie! Wpisz /vip"
-                            )
-                        except Exception as e:
-                            logger.error(f"Error kicking user {u.telegram_id}: {e}")
-                    
-                    user_info["vip_kicked"] = True
-                    u.info = user_info
-                    flag_modified(u, "info")
-                    await db.commit()
-                    
-        except Exception as e:
-            logger.error(f"Subscription checker error: {e}")
-        
-        await asyncio.sleep(3600)
 
+def _extract_cost(res) -> float:
+    """OpenRouter zwraca koszt w różnych miejscach odpowiedzi (lub ostatniego chunka streamu)."""
+    ai_cost = 0.0
+    try:
+        ai_cost = getattr(res, "cost", 0.0)
+        if not ai_cost and hasattr(res, 'model_extra') and res.model_extra:
+            ai_cost = res.model_extra.get('cost', 0.0)
+        if not ai_cost and hasattr(res.usage, 'model_extra') and res.usage.model_extra:
+            ai_cost = res.usage.model_extra.get('cost', 0.0)
+    except Exception: pass
+    return ai_cost or 0.0
+
+def _cached_tokens(usage) -> int:
+    """Tokeny promptu obsłużone z cache dostawcy (usage.prompt_tokens_details.cached_tokens)."""
+    details = getattr(usage, "prompt_tokens_details", None) if usage else None
+    if details is None: return 0
+    if isinstance(details, dict): return details.get("cached_tokens") or 0
+    return getattr(details, "cached_tokens", 0) or 0
+
+async def _stream_completion(client, model: str, messages: list):
+    """
+    Strumieniuje odpowiedź modelu. Tagi sterujące są wycinane w locie (parser przyrostowy),
+    a ich akcje zbierane i zwracane razem z tekstem - stosuje je wywołujący, gdy wiadomo,
+    która próba (failover/hedging) wygrała.
+    Zwraca (tekst bez tagów, usage, koszt, akcje).
+    """
+    parser = TagStreamParser()
+    parts, actions = [], []
+    usage = None; ai_cost = 0.0
+    stream = await client.chat.completions.create(
+        model=model,
+        messages=messages,
+        stream=True,
+        stream_options={"include_usage": True},
+        extra_body={"usage": {"include": True}}
+    )
+    async for chunk in stream:
+        if chunk.usage:
+            usage = chunk.usage
+            ai_cost = _extract_cost(chunk)
+        if not chunk.choices: continue
+        delta = chunk.choices[0].delta.content
+        if not delta: continue
+        text, closed = parser.feed(delta)
+        parts.append(text)
+        actions.extend(closed)
+    parts.append(parser.finish())
+    return "".join(parts), usage, ai_cost, actions
+
+# Handlery dostają bota i persona_id z webhooka (/webhook/{persona_id}) przez dane dispatchera
 @dp.message(F.text == "/vip")
-async def send_vip_invoice(message: TGMessage):
-    bot = await get_bot()
-    if not bot: return
-    
-    async with AsyncSessionLocal() as db:
-        active_persona = await db.scalar(select(Persona).where(Persona.is_active == True).limit(1))
-        vip_price = active_persona.vip_subscription_price if active_persona and active_persona.vip_subscription_price else 500
+async def send_vip_invoice(message: TGMessage, persona_id: int):
+    active_persona = await get_persona(persona_id)
+    vip_price = active_persona.vip_subscription_price if active_persona and active_persona.vip_subscription_price else 500
         
     await message.answer_invoice(
         title="VIP Access 💋", 
@@ -119,17 +133,18 @@ async def send_vip_invoice(message: TGMessage):
     )
 
 @dp.pre_checkout_query()
-async def process_pre_checkout(q: PreCheckoutQuery): 
-    bot = await get_bot()
-    if bot: await bot.answer_pre_checkout_query(q.id, ok=True)
+async def process_pre_checkout(q: PreCheckoutQuery, bot: Bot):
+    await bot.answer_pre_checkout_query(q.id, ok=True)
 
 @dp.message(F.successful_payment)
-async def successful_payment_handler(message: TGMessage):
-    bot = await get_bot()
+async def successful_payment_handler(message: TGMessage, bot: Bot, persona_id: int):
     payment_info = message.successful_payment
     payload = payment_info.invoice_payload
     
     async with AsyncSessionLocal() as db:
+        active_persona = await get_persona(persona_id)
+        # Przychód i wiadomości z tej sesji trafiają do metryk persony, której bot przyjął płatność
+        db.info["persona_id"] = persona_id
         txn = Transaction(id=payment_info.telegram_payment_charge_id, user_id=message.from_user.id, amount=payment_info.total_amount, status="completed")
         db.add(txn)
         
@@ -142,13 +157,9 @@ async def successful_payment_handler(message: TGMessage):
                 else:
                     user.subscription_expires_at = now + timedelta(days=30)
                 
-                user_info = dict(user.info) if user.info else {}
-                if "vip_kicked" in user_info:
-                    del user_info["vip_kicked"]
-                    user.info = user_info
-                    flag_modified(user, "info")
+                user.vip_kicked_at = None
+                user.persona_id = persona_id
                 
-                active_persona = await db.scalar(select(Persona).where(Persona.is_active == True).limit(1))
                 invite_text = "Thanks babe! You are now a VIP 💋 enjoy the ride! I'm all yours now 😈"
                 
                 if active_persona and active_persona.private_channel_id:
@@ -169,7 +180,6 @@ async def successful_payment_handler(message: TGMessage):
                 media_item = await db.get(MediaContent, media_id)
                 if media_item:
                     user = await db.get(User, message.from_user.id)
-                    active_persona = await db.scalar(select(Persona).where(Persona.is_active == True).limit(1))
                     caption = f"Here is your exclusive content 😈 ({media_item.name})"
                     
                     if user and active_persona and active_persona.ppv_multiplier:
@@ -200,33 +210,44 @@ async def successful_payment_handler(message: TGMessage):
         await db.commit()
 
 @dp.message()
-async def chat_handler(message: TGMessage, state: FSMContext):
-    current_state = await state.get_state()
-    if current_state == ChatState.waiting_for_ai.state: return
-
-    bot = await get_bot()
+async def chat_handler(message: TGMessage, bot: Bot, persona_id: int):
+    """
+    Przyjęcie wiadomości (kolejność per czat zapewnia UpdateQueue): zapis, limity, ewentualne ostrzeżenie o limicie.
+    Odpowiedź generuje skrzynka rozmowy - wiadomości wysłane w trakcie generowania trafią do jednej kolejnej tury.
+    """
     if not message.text or message.successful_payment: return
     
-    async with AsyncSessionLocal() as db:
-        active_persona = await db.scalar(
-            select(Persona).options(
-                selectinload(Persona.scenarios).selectinload(Scenario.groups)
-            ).where(Persona.is_active == True).limit(1)
-        )
-        if not active_persona or not bot: return
+    active_persona = await get_persona(persona_id)
+    if not active_persona: return
 
+    async with AsyncSessionLocal() as db:
         user_id = message.from_user.id
+        db.info["persona_id"] = active_persona.id
         try:
-            await state.set_state(ChatState.waiting_for_ai)
-            current_prompt = active_persona.system_prompt
-            current_model = active_persona.ai_model if active_persona.ai_model else settings.AI_MODEL
+            # Jedno zapytanie: użytkownik + czy ta wiadomość Telegrama już była zapisana (ponowiony update).
+            # message_id są numerowane per bot - ten sam numer u innej persony to inna wiadomość
+            seen_id = select(Message.id).where(
+                Message.user_id == user_id, Message.persona_id == persona_id, Message.tg_message_id == message.message_id
+            ).limit(1).scalar_subquery()
+            row = (await db.execute(select(User, seen_id).where(User.telegram_id == user_id))).first()
+            user, replayed_id = row if row else (None, None)
+
+            if replayed_id:
+                # Ponowione dostarczenie tego samego update'u - odpowiadamy tylko, jeśli jeszcze nie było odpowiedzi.
+                # (Webhook potwierdza update od razu, więc po padzie procesu Telegram go nie ponowi - to łapie recover_unanswered)
+                answered = await db.scalar(select(Message.id).where(
+                    Message.user_id == user_id, Message.persona_id == persona_id, Message.role != "user", Message.id > replayed_id
+                ).limit(1))
+                if answered: return
 
-            user = await db.scalar(select(User).options(selectinload(User.groups)).where(User.telegram_id == user_id))
             if not user:
-                user = User(telegram_id=user_id, username=message.from_user.first_name, info={})
-                db.add(user); await db.commit()
+                user = User(telegram_id=user_id, username=message.from_user.first_name, persona_id=persona_id, info={})
+                db.add(user); await db.flush()
+            elif user.persona_id != persona_id:
+                user.persona_id = persona_id
 
-            db.add(Message(user_id=user_id, role="user", content=message.text)); await db.commit()
+            if not replayed_id:
+                db.add(Message(user_id=user_id, role="user", content=message.text, tg_message_id=message.message_id))
 
             now = datetime.utcnow()
             is_vip = user.subscription_expires_at and user.subscription_expires_at.replace(tzinfo=None) > now
@@ -240,8 +261,18 @@ async def chat_handler(message: TGMessage, state: FSMContext):
             can_send = False
             status = ""
 
+            base_limit = active_persona.free_message_limit if active_persona.free_message_limit else 15
+            free_limit = base_limit + user.credits
+            # Licznik podbijany przy zapisie Message - bieżąca wiadomość nie jest jeszcze zapisana
+            user_msg_count = (user.user_message_count or 0) + (0 if replayed_id else 1)
+
+            # 0. Ponowiony update - limit został już naliczony
+            if replayed_id:
+                can_send = True
+                status = "replay"
+
             # 1. Zawsze najpierw schodzą bonusowe kredyty
-            if getattr(user, 'bonus_credits', 0) > 0:
+            elif getattr(user, 'bonus_credits', 0) > 0:
                 user.bonus_credits -= 1
                 can_send = True
                 status = "bonus"
@@ -259,13 +290,6 @@ async def chat_handler(message: TGMessage, state: FSMContext):
                     
             # 3. Logika dla Free
             else:
-                base_limit = active_persona.free_message_limit if active_persona.free_message_limit else 15
-                free_limit = base_limit + user.credits
-                
-                user_msg_count = await db.scalar(
-                    select(func.count(Message.id)).where(Message.user_id == user_id, Message.role == "user")
-                )
-                
                 if user_msg_count <= free_limit:
                     can_send = True
                     status = "free"
@@ -285,23 +309,73 @@ async def chat_handler(message: TGMessage, state: FSMContext):
                     await db.commit()
                     return await message.answer(warn)
 
-            user_info = ", ".join([f"{k}: {v}" for k, v in user.info.items()]) if user.info else "Unknown"
+            # --- COMMIT 1/2: użytkownik, wiadomość przychodząca i limity przed wywołaniem LLM ---
+            await db.commit()
 
-            # --- PPV INSTRUCTIONS ---
-            available_media = (await db.execute(select(MediaContent))).scalars().all()
-            if available_media:
-                media_list_str = "\n".join([f"- [PPV: {m.tag}] (Description: {m.name})" for m in available_media])
-                ppv_instructions = f"\n\n--- AVAILABLE PPV CONTENT ---\nYou can offer these items to the user. Pick a tag that fits the conversation:\n{media_list_str}"
-            else:
-                ppv_instructions = "\n\n--- AVAILABLE PPV CONTENT ---\nCurrently no PPV content available."
+        except Exception as e: 
+            logger.error(f"Error in chat_handler: {e}", exc_info=True)
+            try:
+                fallback_text = "ugh babe my signal is acting up so bad right now 😩 I'm gonna hop in the shower, text me in a little bit okay? 💋✨"
+                await db.rollback()
+                await message.answer(fallback_text)
+                db.add(Message(user_id=user_id, role="assistant", content=f"[SYSTEM FALLBACK] {fallback_text}", ai_cost=0.0))
+                await db.commit()
+            except Exception as inner_e:
+                logger.error(f"Failed to send fallback msg: {inner_e}")
+            return
 
-            # --- PROMO INSTRUCTIONS (ONLY FOR FREE USERS) ---
-            promo_instructions = ""
-            if not is_vip:
-                available_promos = (await db.execute(select(PromoContent))).scalars().all()
-                if available_promos:
-                    promo_list_str = "\n".join([f"- [PROMO: {m.tag}] (Description: {m.name})" for m in available_promos])
-                    promo_instructions = f"\n\n--- AVAILABLE PROMO CONTENT (FOR TEASING FREE USERS) ---\nSend these blurred/teasing items to make them want to buy VIP:\n{promo_list_str}"
+    chat_mailbox.post(persona_id, user_id, lambda answered: generate_reply(bot, persona_id, user_id, answered))
+
+async def generate_reply(bot: Bot, persona_id: int, user_id: int, answered: Optional[int] = None) -> Optional[int]:
+    """
+    Jedna tura AI na wszystkie wiadomości rozmowy późniejsze niż `answered` (wywoływana przez chat_mailbox).
+    Zwraca id ostatniej wiadomości użytkownika objętej tą turą.
+    """
+    active_persona = await get_persona(persona_id)
+    if not active_persona: return answered
+
+    async with AsyncSessionLocal() as db:
+        db.info["persona_id"] = active_persona.id
+        try:
+            current_prompt = active_persona.system_prompt
+            models = persona_models(active_persona)
+            # Budżet kontekstu i znaczniki cache liczone pod pierwszy model listy
+            current_model = models[0]
+
+            # Id odczytane przed historią - tura obejmuje co najmniej wiadomości do last_user_id
+            last_user_id = await db.scalar(select(func.max(Message.id)).where(
+                Message.user_id == user_id, Message.persona_id == persona_id, Message.role == "user"
+            ))
+            # Wiadomość z flagi była już w historii poprzedniej tury
+            if last_user_id is None or (answered is not None and last_user_id <= answered): return answered
+
+            # Ile wiadomości obejmuje tura: od poprzedniej tury (lub ostatniej odpowiedzi) do last_user_id
+            since = answered if answered is not None else select(func.max(Message.id)).where(
+                Message.user_id == user_id, Message.persona_id == persona_id, Message.role != "user"
+            ).scalar_subquery()
+            covered = await db.scalar(select(func.count(Message.id)).where(
+                Message.user_id == user_id, Message.persona_id == persona_id, Message.role == "user",
+                Message.id > func.coalesce(since, 0), Message.id <= last_user_id,
+            ))
+            if covered > 1: db.info["llm_calls_saved"] = (persona_id, covered - 1)
+            answered = last_user_id
+
+            user = await db.scalar(select(User).options(selectinload(User.groups)).where(User.telegram_id == user_id))
+            if not user: return answered
+            history = await get_history(db, user_id, persona_id)
+
+            now = datetime.utcnow()
+            is_vip = user.subscription_expires_at and user.subscription_expires_at.replace(tzinfo=None) > now
+            base_limit = active_persona.free_message_limit if active_persona.free_message_limit else 15
+            free_limit = base_limit + user.credits
+            user_msg_count = user.user_message_count or 0
+
+            user_info = ", ".join([f"{k}: {v}" for k, v in user.info.items()]) if user.info else "Unknown"
+
+            # --- KATALOGI PPV / PROMO (promo tylko dla darmowych użytkowników) ---
+            catalog = await get_catalog()
+            ppv_instructions = catalog.ppv_instructions
+            promo_instructions = "" if is_vip else catalog.promo_instructions
 
             start_of_month = datetime(now.year, now.month, 1)
             total_spent = await db.scalar(
@@ -351,105 +425,106 @@ async def chat_handler(message: TGMessage, state: FSMContext):
                 GOAL: Reward them for paying. Send them PPV content to unlock. Do not hold back on dirty talk.
                 """
 
+            # --- SCENARIUSZ (skompilowany harmonogram z cache persony) ---
             scenario_instruction = ""
-            try:
-                tz_str = active_persona.timezone if active_persona.timezone else "America/New_York"
-                tz = ZoneInfo(tz_str)
-                local_time = datetime.now(tz)
-                current_time_str = local_time.strftime("%H:%M")
-                
-                active_scenario = None
-                for sc in active_persona.scenarios:
-                    if not sc.is_active: continue
-                    if sc.target_type == "groups":
-                        user_group_ids = {g.id for g in user.groups}
-                        sc_group_ids = {g.id for g in sc.groups}
-                        if not user_group_ids.intersection(sc_group_ids): continue
-                    
-                    start = sc.time_start
-                    end = sc.time_end
-                    if start <= end:
-                        if start <= current_time_str <= end: active_scenario = sc; break
-                    else:
-                        if current_time_str >= start or current_time_str <= end: active_scenario = sc; break
-                            
-                if active_scenario:
-                    scenario_instruction = f"\n\n--- CURRENT SCENARIO (LOCAL TIME {current_time_str}) ---\n{active_scenario.prompt_addition}"
-            except Exception as e: logger.error(f"Scenario time check error: {e}")
-
-            system_msg = f"{current_prompt}{spiciness_instruction}{limit_warning}{scenario_instruction}{MEMORY_INSTRUCTIONS}{ppv_instructions}{promo_instructions}\n\nUSER PROFILE: {user_info}"
-            ai_messages = [{"role": "system", "content": system_msg}]
-
-            history = await db.execute(select(Message).where(Message.user_id == user_id).order_by(Message.timestamp.desc()).limit(20))
-            for msg in reversed(history.scalars().all()): ai_messages.append({"role": msg.role, "content": msg.content})
+            schedule = await get_scenario_schedule(persona_id)
+            user_group_ids = frozenset(g.id for g in user.groups) if schedule.needs_groups else frozenset()
+            local_time, active_scenario = schedule.active_for(user_group_ids)
+            if active_scenario:
+                scenario_instruction = f"\n\n--- CURRENT SCENARIO (LOCAL TIME {local_time.strftime('%H:%M')}) ---\n{active_scenario.prompt_addition}"
+
+            # Kolejność od najstabilniejszego: persona i katalogi są wspólne dla wszystkich (prefiks w cache dostawcy),
+            # poziom pikanterii dzieli użytkowników na kilka grup, reszta jest indywidualna
+            segments = [
+                ("persona", current_prompt), ("memory", MEMORY_INSTRUCTIONS), ("ppv_catalog", ppv_instructions),
+                ("promo_catalog", promo_instructions), ("spiciness", spiciness_instruction), ("scenario", scenario_instruction),
+                ("limit_warning", limit_warning), ("user_profile", f"\n\nUSER PROFILE: {user_info}"),
+            ]
+            ai_messages, context_report = build_context(
+                current_model, segments, history,
+                truncatable=("ppv_catalog", "promo_catalog"), cache_until="promo_catalog",
+            )
+            logger.info(f"Context for {user_id}: {context_report}")
+
+            # Odczyty skończone - połączenie wraca do puli na czas odpowiedzi modelu, zapis tury to nowa transakcja
+            # (user odpięty od sesji, żeby rollback go nie wygasił)
+            db.expunge(user)
+            await db.rollback()
 
             await bot.send_chat_action(chat_id=user_id, action="typing")
             
-            or_token = active_persona.openrouter_token if active_persona.openrouter_token else settings.OPENROUTER_KEY
-            local_ai_client = AsyncOpenAI(api_key=or_token, base_url="https://openrouter.ai/api/v1")
-
-            res = await local_ai_client.chat.completions.create(
-                model=current_model, 
-                messages=ai_messages,
-                extra_body={"usage": {"include": True}} 
-            )
-            ai_text = res.choices[0].message.content or ""
-            final_text = ai_text
+            ppv_tag = promo_tag = None
+            custom_added = False
+            mem_updates = {}
+
+            def apply_action(action):
+                """Efekty tagów zwycięskiej próby, stosowane po odpowiedzi modelu (pierwszy PPV/promo wygrywa)."""
+                nonlocal ppv_tag, promo_tag, custom_added
+                if isinstance(action, CustomRequestAction):
+                    if not custom_added:
+                        custom_added = True
+                        db.add(CustomRequest(user_id=user_id, description=action.description))
+                elif isinstance(action, MemoryAction):
+                    mem_updates[action.key] = action.value
+                elif isinstance(action, PpvAction):
+                    if ppv_tag is None: ppv_tag = action.tag
+                elif isinstance(action, PromoAction):
+                    if promo_tag is None: promo_tag = action.tag
+
+            async def ask(model: str):
+                """Jedna próba modelu. Akcje zbierane osobno, bo przy failoverze/hedgingu liczy się tylko zwycięska próba."""
+                if settings.AI_STREAMING:
+                    return await _stream_completion(local_ai_client, model, ai_messages)
+                res = await local_ai_client.chat.completions.create(
+                    model=model,
+                    messages=ai_messages,
+                    extra_body={"usage": {"include": True}}
+                )
+                text, actions = parse_control_tags(res.choices[0].message.content or "")
+                return text, res.usage, _extract_cost(res), actions
 
-            p_tokens = res.usage.prompt_tokens if res.usage else 0
-            c_tokens = res.usage.completion_tokens if res.usage else 0
-            ai_cost = 0.0
-            try:
-                ai_cost = getattr(res, "cost", 0.0)
-                if not ai_cost and hasattr(res, 'model_extra') and res.model_extra:
-                    ai_cost = res.model_extra.get('cost', 0.0)
-                if not ai_cost and hasattr(res.usage, 'model_extra') and res.usage.model_extra:
-                    ai_cost = res.usage.model_extra.get('cost', 0.0)
-            except Exception: pass
-            cost_kwargs = {"ai_cost": ai_cost, "prompt_tokens": p_tokens, "completion_tokens": c_tokens}
-
-            custom_match = re.search(r"\[CUSTOM_REQ:\s*(.*?)\]", ai_text, re.IGNORECASE)
-            if custom_match:
-                req_desc = custom_match.group(1).strip()
-                final_text = final_text.replace(custom_match.group(0), "").strip()
-                db.add(CustomRequest(user_id=user_id, description=req_desc))
-                await db.commit()
+            # Klient nie zostanie zamknięty w trakcie odpowiedzi, nawet gdy przeładowanie person wycofa jego klucz
+            async with client_in_use(get_ai_client(active_persona.openrouter_token)) as local_ai_client:
+                answered_by, (final_text, usage, ai_cost, actions) = await complete(models, ask)
+            if answered_by != current_model: logger.info(f"Reply for {user_id} served by fallback model {answered_by}")
+            for action in actions: apply_action(action)
 
-            ppv_match = re.search(r"\[PPV:\s*(.*?)\]", ai_text, re.IGNORECASE)
-            promo_match = re.search(r"\[PROMO:\s*(.*?)\]", ai_text, re.IGNORECASE)
+            p_tokens = usage.prompt_tokens if usage else 0
+            c_tokens = usage.completion_tokens if usage else 0
+            cached_tokens = _cached_tokens(usage)
 
-            matches = re.findall(r"\[MEM:\s*(.*?)=(.*?)\]", ai_text)
-            if matches:
+            if mem_updates:
                 info = dict(user.info)
-                for k, v in matches:
-                    if k.strip() and v.strip(): info[k.strip().lower()] = v.strip()
-                    final_text = final_text.replace(f"[MEM: {k}={v}]", "").replace(f"[MEM:{k}={v}]", "").replace(f"[MEM: {k} = {v}]", "")
+                info.update(mem_updates)
                 user.info = info
-                flag_modified(user, "info"); await db.commit()
+                flag_modified(user, "info")
+                db.add(user)
+
+            # --- COMMIT 2/2: wynik AI (odpowiedź, oferty, custom request, pamięć) w jednej transakcji ---
+
+            cost_kwargs = {"ai_cost": ai_cost, "prompt_tokens": p_tokens, "completion_tokens": c_tokens, "cached_prompt_tokens": cached_tokens}
+            media_item = catalog.media.get(ppv_tag) if ppv_tag else None
+            promo_item = catalog.promos.get(promo_tag) if promo_tag else None
 
-            if ppv_match:
-                tag = ppv_match.group(1).strip().lower()
-                final_text = final_text.replace(ppv_match.group(0), "").strip()
-                media_item = await db.scalar(select(MediaContent).where(MediaContent.tag == tag))
+            if ppv_tag:
+                tag = ppv_tag
                 if media_item:
                     final_text = " ".join(final_text.split())
                     if final_text:
-                        await message.answer(final_text)
+                        await bot.send_message(chat_id=user_id, text=final_text)
                         db.add(Message(user_id=user_id, role="assistant", content=final_text, **cost_kwargs))
                     
                     await bot.send_invoice(chat_id=user_id, title=f"Unlock Content 🔒", description=f"Exclusive private media: {media_item.name}", payload=f"ppv_{media_item.id}", currency="XTR", prices=[LabeledPrice(label="Unlock", amount=media_item.price)], provider_token="")
                     db.add(Message(user_id=user_id, role="assistant", content=f"[OFFERED PPV: {tag}]", ai_cost=0.0))
                     await db.commit()
-                    return
+                    return answered
 
-            elif promo_match:
-                tag = promo_match.group(1).strip().lower()
-                final_text = final_text.replace(promo_match.group(0), "").strip()
-                promo_item = await db.scalar(select(PromoContent).where(PromoContent.tag == tag))
+            elif promo_tag:
+                tag = promo_tag
                 if promo_item:
                     final_text = " ".join(final_text.split())
                     if final_text:
-                        await message.answer(final_text)
+                        await bot.send_message(chat_id=user_id, text=final_text)
                         db.add(Message(user_id=user_id, role="assistant", content=final_text, **cost_kwargs))
                         
                     caption = "Want to see the uncensored version? 😈 Unlock my VIP room now! 👉 /vip"
@@ -463,78 +538,155 @@ async def chat_handler(message: TGMessage, state: FSMContext):
 
                     db.add(Message(user_id=user_id, role="assistant", content=f"[SENT PROMO: {tag}]", ai_cost=0.0))
                     await db.commit()
-                    return
+                    return answered
 
             final_text = " ".join(final_text.split())
-            if final_text:
-                db.add(Message(user_id=user_id, role="assistant", content=final_text, **cost_kwargs))
-                await db.commit()
+            if final_text: db.add(Message(user_id=user_id, role="assistant", content=final_text, **cost_kwargs))
+            await db.commit()
+            if not final_text: return answered
+            
+            word_count = len(final_text.split())
+            
+            if total_spent >= 5000:
+                base_delay = random.uniform(0.5, 1.5)
+                typing_time = word_count * random.uniform(0.05, 0.1)
+                total_delay = min(base_delay + typing_time, 5.0) 
                 
-                word_count = len(final_text.split())
+            elif is_vip:
+                base_delay = random.uniform(1.5, 3.0)
+                typing_time = word_count * random.uniform(0.1, 0.2)
+                total_delay = min(base_delay + typing_time, 10.0) 
                 
-                if total_spent >= 5000:
-                    base_delay = random.uniform(0.5, 1.5)
-                    typing_time = word_count * random.uniform(0.05, 0.1)
-                    total_delay = min(base_delay + typing_time, 5.0) 
-                    
-                elif is_vip:
-                    base_delay = random.uniform(1.5, 3.0)
-                    typing_time = word_count * random.uniform(0.1, 0.2)
-                    total_delay = min(base_delay + typing_time, 10.0) 
-                    
-                else:
-                    typing_time = word_count * random.uniform(0.1, 0.2)
-                    if random.random() < 0.20:
-                        base_delay = random.uniform(60.0, 180.0) 
-                        total_delay = base_delay + typing_time
-                    else:
-                        base_delay = random.uniform(2.0, 5.0)
-                        total_delay = min(base_delay + typing_time, 12.0)
-
-                if total_delay > 15.0:
-                    typing_duration = min(typing_time + 2.0, 8.0)
-                    silent_wait = total_delay - typing_duration
-                    await asyncio.sleep(silent_wait) 
-                    await bot.send_chat_action(chat_id=user_id, action="typing")
-                    await asyncio.sleep(typing_duration) 
+            else:
+                typing_time = word_count * random.uniform(0.1, 0.2)
+                if random.random() < 0.20:
+                    base_delay = random.uniform(60.0, 180.0) 
+                    total_delay = base_delay + typing_time
                 else:
-                    await bot.send_chat_action(chat_id=user_id, action="typing")
-                    await asyncio.sleep(total_delay)
-                
-                await message.answer(final_text)
+                    base_delay = random.uniform(2.0, 5.0)
+                    total_delay = min(base_delay + typing_time, 12.0)
+
+            if total_delay > 15.0:
+                typing_duration = min(typing_time + 2.0, 8.0)
+                silent_wait = total_delay - typing_duration
+                await asyncio.sleep(silent_wait) 
+                await bot.send_chat_action(chat_id=user_id, action="typing")
+                await asyncio.sleep(typing_duration) 
+            else:
+                await bot.send_chat_action(chat_id=user_id, action="typing")
+                await asyncio.sleep(total_delay)
             
+            await bot.send_message(chat_id=user_id, text=final_text)
+        
         except Exception as e: 
-            logger.error(f"Error in chat_handler: {e}", exc_info=True)
+            logger.error(f"Error in generate_reply: {e}", exc_info=True)
             try:
                 fallback_text = "ugh babe my signal is acting up so bad right now 😩 I'm gonna hop in the shower, text me in a little bit okay? 💋✨"
-                await message.answer(fallback_text)
+                await db.rollback()
+                await bot.send_message(chat_id=user_id, text=fallback_text)
                 db.add(Message(user_id=user_id, role="assistant", content=f"[SYSTEM FALLBACK] {fallback_text}", ai_cost=0.0))
                 await db.commit()
             except Exception as inner_e:
                 logger.error(f"Failed to send fallback msg: {inner_e}")
-        finally: 
-            await state.clear()
+    return answered
+
+async def recover_unanswered():
+    """
+    Po starcie: rozmowy, w których ostatnia wiadomość użytkownika (zapisana przed padem procesu) nie dostała odpowiedzi.
+    Skan rusza po REPLY_RECOVERY_GRACE - tury żywych workerów zdążą się zapisać - i tylko w jednym procesie naraz.
+    """
+    if settings.REPLY_RECOVERY_WINDOW <= 0: return
+    await asyncio.sleep(settings.REPLY_RECOVERY_GRACE)
+    try:
+        if not await acquire_lease("reply:recovery", int(settings.REPLY_RECOVERY_GRACE)): return
+        now = datetime.utcnow()
+        # Ostatnie wiadomości po kluczu głównym (tani skan od końca), zamiast filtrowania całej tabeli po czasie
+        recent = select(Message.id, Message.user_id, Message.persona_id, Message.role, Message.timestamp) \
+            .order_by(Message.id.desc()).limit(settings.REPLY_RECOVERY_SCAN).subquery()
+        last_user = func.max(case((recent.c.role == "user", recent.c.id)))
+        last_reply = func.coalesce(func.max(case((recent.c.role != "user", recent.c.id))), 0)
+        async with AsyncSessionLocal() as db:
+            rows = (await db.execute(
+                select(recent.c.user_id, recent.c.persona_id, last_user)
+                .where(recent.c.persona_id.isnot(None), recent.c.timestamp >= now - timedelta(seconds=settings.REPLY_RECOVERY_WINDOW))
+                .group_by(recent.c.user_id, recent.c.persona_id)
+                .having(last_user > last_reply, func.max(recent.c.timestamp) < now - timedelta(seconds=settings.REPLY_RECOVERY_GRACE))
+            )).all()
+    except Exception as e:
+        logger.error(f"Reply recovery scan failed: {e}")
+        return
+
+    recovered = 0
+    for user_id, persona_id, last_user_id in rows:
+        bot = await get_bot(persona_id)
+        if bot is None: continue
+
+        async def reply(answered, bot=bot, persona_id=persona_id, user_id=user_id, last_user_id=last_user_id):
+            # Odpowiedź mogła powstać po skanie (np. użytkownik napisał ponownie) - wtedy nie dublujemy
+            if answered is None:
+                async with AsyncSessionLocal() as db:
+                    replied = await db.scalar(select(Message.id).where(
+                        Message.user_id == user_id, Message.persona_id == persona_id, Message.role != "user", Message.id > last_user_id
+                    ).limit(1))
+                if replied: return last_user_id
+            return await generate_reply(bot, persona_id, user_id, answered)
+
+        chat_mailbox.post(persona_id, user_id, reply)
+        recovered += 1
+    if recovered: logger.warning(f"Reply recovery: answering {recovered} conversations interrupted by a restart")
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    async with engine.begin() as conn: await conn.run_sync(Base.metadata.create_all)
-    await init_bot()
+    # Schemat bazy zarządzany jest migracjami: alembic upgrade head (patrz alembic.ini)
+    await reload_persona_cache()
+    await register_webhooks()
+    await reload_catalog_cache()
+    # Pierwsze użycie tiktoken pobiera plik BPE - robimy to poza pętlą zdarzeń, przed ruchem
+    await asyncio.to_thread(count_tokens, "warmup")
     
     task = asyncio.create_task(check_expired_subscriptions())
+    cache_listener = asyncio.create_task(listen_cache_changes())
+    broadcasts = asyncio.create_task(broadcast_worker())
+    update_queue.start()
+    recovery = asyncio.create_task(recover_unanswered())
     
     yield
+    recovery.cancel()
+    await update_queue.drain(timeout=settings.UPDATE_DRAIN_TIMEOUT)
+    await chat_mailbox.drain(timeout=settings.UPDATE_DRAIN_TIMEOUT)
+    broadcasts.cancel()
+    await stop_broadcasts(timeout=settings.BROADCAST_STOP_TIMEOUT)
     task.cancel()
-    bot_instance = await get_bot()
-    if bot_instance: await bot_instance.session.close()
+    cache_listener.cancel()
+    await close_bots()
+    await close_ai_clients()
 
 app = FastAPI(lifespan=lifespan)
 from app.web.admin_routes import router as admin_router
 app.include_router(admin_router, prefix="/admin")
 
+@app.post("/webhook/{persona_id}")
+async def webhook(persona_id: int, request: Request):
+    secret = request.headers.get("X-Telegram-Bot-Api-Secret-Token")
+    # Bez secret_token to nie Telegram (np. podrobiony successful_payment)
+    if secret is None:
+        return JSONResponse({"ok": False}, status_code=403)
+    # Po zmianie tokena update'y w drodze do starego tokena obsługuje stary bot (rozpoznany po secret_token)
+    bot_instance = resolve_bot(persona_id, secret)
+    # Persona jeszcze nieznana temu workerowi (hot-add) lub pełna kolejka = 503, Telegram ponowi dostarczenie później
+    if not bot_instance:
+        return JSONResponse({"ok": False}, status_code=503)
+    update = types.Update(**await request.json())
+    if not update_queue.put(bot_instance, persona_id, update):
+        return JSONResponse({"ok": False}, status_code=503)
+    return {"ok": True}
+
 @app.post("/webhook")
-async def webhook(request: Request):
-    bot_instance = await get_bot()
-    if bot_instance: 
-        update = types.Update(**await request.json())
-        asyncio.create_task(dp.feed_update(bot=bot_instance, update=update))
-    return {"ok": True}
\ No newline at end of file
+async def legacy_webhook(request: Request):
+    """Stary adres z czasów jednego bota - update'y w drodze podczas wdrożenia trafiają do persony domyślnej."""
+    persona = await get_persona()
+    if not persona: return {"ok": True}
+    # Stary webhook był bez secret_token - 503, Telegram dostarczy update ponownie na nowy adres po rejestracji webhooków
+    if "X-Telegram-Bot-Api-Secret-Token" not in request.headers:
+        return JSONResponse({"ok": False}, status_code=503)
+    return await webhook(persona.id, request)
\ No newline at end of file
@@ -0,0 +1,164 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional, Set, Tuple
+from openai import AuthenticationError, PermissionDeniedError
+
+from app.database.session import settings
+from app.database.models import Persona
+
+logger = logging.getLogger(__name__)
+
+# Próba odpowiedzi jednym modelem: call(model) -> wynik
+Attempt = Callable[[str], Awaitable[Any]]
+
+def persona_models(persona: Persona) -> List[str]:
+    """Modele persony w kolejności failoveru (bez listy - pojedynczy ai_model lub domyślny z .env)."""
+    return list(persona.ai_models or []) or [persona.ai_model or settings.AI_MODEL]
+
+def model_timeout(model: str) -> float:
+    return settings.AI_MODEL_TIMEOUTS.get(model, settings.AI_MODEL_TIMEOUT)
+
+class _ModelHealth:
+    """Circuit breaker i statystyki jednego modelu (stan per worker)."""
+    __slots__ = ("model", "consecutive", "open_until", "probing", "calls", "failures", "timeouts",
+                 "hedges", "hedge_wins", "latencies", "last_error")
+
+    def __init__(self, model: str):
+        self.model = model
+        self.consecutive = 0
+        self.open_until = 0.0
+        # Po cooldownie przepuszczamy jedną próbę (half-open), reszta idzie do kolejnych modeli
+        self.probing = False
+        self.calls = self.failures = self.timeouts = self.hedges = self.hedge_wins = 0
+        self.latencies: Deque[float] = deque(maxlen=settings.AI_LATENCY_WINDOW)
+        self.last_error: Optional[str] = None
+
+    def state(self, now: float) -> str:
+        if self.consecutive < settings.AI_BREAKER_FAILURES: return "closed"
+        return "open" if now < self.open_until else "half-open"
+
+    def available(self, now: float) -> bool:
+        state = self.state(now)
+        return state == "closed" or (state == "half-open" and not self.probing)
+
+    def percentile(self, q: float) -> Optional[float]:
+        if not self.latencies: return None
+        ordered = sorted(self.latencies)
+        return ordered[min(int(len(ordered) * q), len(ordered) - 1)]
+
+    def hedge_delay(self) -> Optional[float]:
+        """Po ilu sekundach wysłać drugie zapytanie (p95 opóźnienia modelu); None = za mało próbek."""
+        if len(self.latencies) < settings.AI_HEDGE_MIN_SAMPLES: return None
+        return max(self.percentile(0.95), settings.AI_HEDGE_MIN_DELAY)
+
+    def record_success(self, latency: float):
+        self.consecutive = 0
+        self.latencies.append(latency)
+
+    def record_failure(self, error: BaseException, timed_out: bool):
+        self.failures += 1
+        self.consecutive += 1
+        if timed_out: self.timeouts += 1
+        self.last_error = f"{type(error).__name__}: {error}"[:200]
+        if self.consecutive >= settings.AI_BREAKER_FAILURES:
+            if self.consecutive == settings.AI_BREAKER_FAILURES or self.probing:
+                logger.warning(f"AI model {self.model} circuit open for {settings.AI_BREAKER_COOLDOWN:.0f}s after {self.consecutive} failures: {self.last_error}")
+            self.open_until = time.monotonic() + settings.AI_BREAKER_COOLDOWN
+
+_health: Dict[str, _ModelHealth] = {}
+
+def _get_health(model: str) -> _ModelHealth:
+    health = _health.get(model)
+    if health is None:
+        health = _health[model] = _ModelHealth(model)
+    return health
+
+def _is_model_failure(error: BaseException) -> bool:
+    """Zły klucz API persony to nie awaria modelu - nie otwiera breakera i nie przełącza na inne modele."""
+    return not isinstance(error, (AuthenticationError, PermissionDeniedError))
+
+async def _attempt(model: str, call: Attempt):
+    health = _get_health(model)
+    half_open = health.state(time.monotonic()) == "half-open"
+    if half_open: health.probing = True
+    health.calls += 1
+    start = time.monotonic()
+    try:
+        result = await asyncio.wait_for(call(model), timeout=model_timeout(model))
+    except asyncio.CancelledError:
+        # Przegrany wyścig hedgingu - to nie awaria modelu
+        raise
+    except Exception as e:
+        if _is_model_failure(e): health.record_failure(e, isinstance(e, asyncio.TimeoutError))
+        raise
+    finally:
+        if half_open: health.probing = False
+    health.record_success(time.monotonic() - start)
+    return result
+
+async def complete(models: List[str], call: Attempt) -> Tuple[str, Any]:
+    """
+    Odpowiedź pierwszego działającego modelu z listy (failover w kolejności, z pominięciem otwartych breakerów).
+    Przy AI_HEDGE: gdy model nie odpowie w swoim p95, równolegle rusza drugie zapytanie (kolejny model lub ten sam)
+    i wygrywa szybsze. Zwraca (model, wynik); gdy zawiodą wszystkie - wyjątek ostatniej próby.
+    """
+    now = time.monotonic()
+    # Wszystkie breakery otwarte - i tak próbujemy po kolei, zamiast od razu odpowiadać awaryjnie
+    queue = [m for m in models if _get_health(m).available(now)] or list(models)
+    running: Dict[asyncio.Task, str] = {}
+    hedge_tasks: Set[asyncio.Task] = set()
+    hedged = False
+    last_error: Optional[BaseException] = None
+    try:
+        while True:
+            if not running:
+                if not queue: raise last_error or RuntimeError("No AI model configured")
+                model = queue.pop(0)
+                if last_error is not None: logger.warning(f"AI failover to {model} after {type(last_error).__name__}: {last_error}")
+                running[asyncio.create_task(_attempt(model, call))] = model
+            delay = None
+            if settings.AI_HEDGE and not hedged and len(running) == 1:
+                delay = _get_health(next(iter(running.values()))).hedge_delay()
+            done, _ = await asyncio.wait(running, timeout=delay, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                # Wolniej niż p95 - drugie zapytanie, jedno na turę
+                hedged = True
+                model = queue.pop(0) if queue else next(iter(running.values()))
+                _get_health(model).hedges += 1
+                task = asyncio.create_task(_attempt(model, call))
+                running[task] = model
+                hedge_tasks.add(task)
+                continue
+            for task in done:
+                model = running.pop(task)
+                error = task.exception()
+                if error is None:
+                    if task in hedge_tasks: _get_health(model).hedge_wins += 1
+                    return model, task.result()
+                if not _is_model_failure(error): raise error
+                last_error = error
+    finally:
+        for task in running: task.cancel()
+
+def model_health() -> List[dict]:
+    """Stan breakerów i opóźnienia modeli w tym workerze (panel admina)."""
+    now = time.monotonic()
+    rows = []
+    for health in sorted(_health.values(), key=lambda h: h.model):
+        p50, p95 = health.percentile(0.5), health.percentile(0.95)
+        rows.append({
+            "model": health.model,
+            "state": health.state(now),
+            "calls": health.calls,
+            "failures": health.failures,
+            "timeouts": health.timeouts,
+            "hedges": health.hedges,
+            "hedge_wins": health.hedge_wins,
+            "p50": round(p50, 2) if p50 is not None else None,
+            "p95": round(p95, 2) if p95 is not None else None,
+            "retry_in": max(0, round(health.open_until - now)) if health.state(now) == "open" else 0,
+            "last_error": health.last_error,
+        })
+    return rows
@@ -0,0 +1,64 @@
+import asyncio
+import logging
+from typing import Dict, List, Optional
+from sqlalchemy import select
+from sqlalchemy.orm import selectinload
+
+from app.database.session import AsyncSessionLocal
+from app.database.models import Persona, Scenario
+from app.bot_manager import sync_bots
+from app.ai_clients import retire_unused_clients
+from app.cache_bus import register_cache, publish_change
+from app.scenario_schedule import ScenarioSchedule, EMPTY_SCHEDULE
+
+logger = logging.getLogger(__name__)
+
+# Snapshoty aktywnych person (odłączone od sesji, ze scenariuszami i grupami), klucz = persona_id
+_personas: Dict[int, Persona] = {}
+_schedules: Dict[int, ScenarioSchedule] = {}
+_loaded = False
+_lock = asyncio.Lock()
+
+async def _load_active_personas() -> List[Persona]:
+    async with AsyncSessionLocal() as db:
+        return (await db.execute(
+            select(Persona).options(
+                selectinload(Persona.scenarios).selectinload(Scenario.groups)
+            ).where(Persona.is_active == True).order_by(Persona.id)
+        )).scalars().all()
+
+async def reload_persona_cache():
+    """Ładuje aktywne persony z bazy, kompiluje ich harmonogramy scenariuszy i dopasowuje rejestr botów."""
+    global _personas, _schedules, _loaded
+    async with _lock:
+        personas = await _load_active_personas()
+        _schedules = {p.id: ScenarioSchedule(p.scenarios, p.timezone) for p in personas}
+        _personas = {p.id: p for p in personas}
+        _loaded = True
+        sync_bots(personas)
+        retire_unused_clients(p.openrouter_token for p in personas)
+    logger.info(f"Persona cache reloaded: {', '.join(p.name for p in personas) or 'NO ACTIVE PERSONA'}")
+
+register_cache("persona", reload_persona_cache)
+
+async def get_persona(persona_id: Optional[int] = None) -> Optional[Persona]:
+    """
+    Snapshot aktywnej persony bez odpytywania bazy (poza pierwszym wywołaniem).
+    Bez persona_id - persona domyślna (najstarsza aktywna), np. dla użytkowników bez przypisanej persony.
+    """
+    if not _loaded:
+        await reload_persona_cache()
+    if persona_id is None:
+        return _personas[min(_personas)] if _personas else None
+    return _personas.get(persona_id)
+
+async def get_scenario_schedule(persona_id: int) -> ScenarioSchedule:
+    """Skompilowany harmonogram scenariuszy persony (przebudowywany razem ze snapshotem)."""
+    if not _loaded:
+        await reload_persona_cache()
+    return _schedules.get(persona_id, EMPTY_SCHEDULE)
+
+async def notify_persona_changed():
+    """Przeładowuje lokalny snapshot i powiadamia pozostałe workery przez Redis pub/sub."""
+    await reload_persona_cache()
+    await publish_change("persona")
@@ -0,0 +1,19 @@
+import uuid
+
+from app.bot_manager import redis
+
+# Lease w Redisie: klucz z identyfikatorem procesu-właściciela i TTL. Właściciel go odświeża,
+# a po padnięciu procesu lease wygasa sam. Odświeżenie i zwolnienie tylko przez właściciela (skrypty Lua).
+instance_id = uuid.uuid4().hex
+_REFRESH_LEASE = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('expire', KEYS[1], ARGV[2]) else return 0 end"
+_RELEASE_LEASE = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('del', KEYS[1]) else return 0 end"
+
+async def acquire_lease(key: str, ttl: int) -> bool:
+    return bool(await redis.set(key, instance_id, nx=True, ex=ttl))
+
+async def refresh_lease(key: str, ttl: int) -> bool:
+    """False = lease wygasł lub przejął go inny proces."""
+    return bool(await redis.eval(_REFRESH_LEASE, 1, key, instance_id, ttl))
+
+async def release_lease(key: str):
+    await redis.eval(_RELEASE_LEASE, 1, key, instance_id)
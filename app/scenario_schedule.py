@@ -0,0 +1,79 @@
+import logging
+from bisect import bisect_right
+from datetime import datetime
+from typing import FrozenSet, List, NamedTuple, Optional, Tuple
+from zoneinfo import ZoneInfo
+
+logger = logging.getLogger(__name__)
+
+MINUTES_PER_DAY = 24 * 60
+DEFAULT_TIMEZONE = "America/New_York"
+
+class ScheduledScenario(NamedTuple):
+    priority: int                       # kolejność scenariusza w personie - pierwszy pasujący wygrywa
+    title: str
+    prompt_addition: str
+    group_ids: Optional[FrozenSet[int]]  # None = scenariusz dla wszystkich
+
+def _minute_of_day(hhmm: str) -> int:
+    hours, minutes = hhmm.strip().split(":")
+    value = int(hours) * 60 + int(minutes)
+    if not 0 <= value < MINUTES_PER_DAY: raise ValueError(hhmm)
+    return value
+
+class ScenarioSchedule:
+    """
+    Skompilowany harmonogram scenariuszy persony.
+    Doba podzielona jest na przedziały minut, w których zbiór aktywnych scenariuszy się nie zmienia;
+    wyszukiwanie to bisect po granicach przedziałów + sprawdzenie kilku kandydatów (zwykle 0-1).
+    Okna są domknięte z obu stron (jak dawne porównanie "HH:MM"), okno przez północ (22:00-02:00) dzielone jest na dwa.
+    """
+
+    def __init__(self, scenarios=(), timezone: Optional[str] = None):
+        try:
+            self.tz = ZoneInfo(timezone or DEFAULT_TIMEZONE)
+        except Exception as e:
+            logger.error(f"Invalid persona timezone {timezone!r}, using {DEFAULT_TIMEZONE}: {e}")
+            self.tz = ZoneInfo(DEFAULT_TIMEZONE)
+        # (początek, koniec włącznie, scenariusz)
+        intervals: List[Tuple[int, int, ScheduledScenario]] = []
+        for priority, sc in enumerate(scenarios):
+            if not sc.is_active: continue
+            try:
+                start, end = _minute_of_day(sc.time_start), _minute_of_day(sc.time_end)
+            except (ValueError, AttributeError):
+                logger.error(f"Scenario '{sc.title}' has invalid time window {sc.time_start}-{sc.time_end}, skipped")
+                continue
+            group_ids = frozenset(g.id for g in sc.groups) if sc.target_type == "groups" else None
+            entry = ScheduledScenario(priority, sc.title, sc.prompt_addition, group_ids)
+            if start <= end:
+                intervals.append((start, end, entry))
+            else:
+                intervals.append((start, MINUTES_PER_DAY - 1, entry))
+                intervals.append((0, end, entry))
+
+        points = sorted({0} | {s for s, _, _ in intervals} | {e + 1 for _, e, _ in intervals if e + 1 < MINUTES_PER_DAY})
+        self._starts: List[int] = points
+        self._candidates: List[Tuple[ScheduledScenario, ...]] = []
+        for i, point in enumerate(points):
+            # Przedział [point, następny punkt) leży w całości w każdym oknie, które zawiera point
+            active = {entry for s, e, entry in intervals if s <= point <= e}
+            self._candidates.append(tuple(sorted(active)))
+        self.needs_groups = any(entry.group_ids is not None for _, _, entry in intervals)
+
+    def find(self, minute: int, user_group_ids: FrozenSet[int] = frozenset()) -> Optional[ScheduledScenario]:
+        """Scenariusz aktywny w danej minucie doby dla użytkownika z podanymi grupami."""
+        for entry in self._candidates[bisect_right(self._starts, minute) - 1]:
+            if entry.group_ids is None or entry.group_ids & user_group_ids:
+                return entry
+        return None
+
+    def local_time(self, now: Optional[datetime] = None) -> datetime:
+        return (now or datetime.now(self.tz)).astimezone(self.tz)
+
+    def active_for(self, user_group_ids: FrozenSet[int] = frozenset(), now: Optional[datetime] = None):
+        """Zwraca (lokalny czas, scenariusz lub None) dla bieżącej chwili w strefie persony."""
+        local = self.local_time(now)
+        return local, self.find(local.hour * 60 + local.minute, user_group_ids)
+
+EMPTY_SCHEDULE = ScenarioSchedule()
@@ -0,0 +1,125 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Deque, Dict, List, Optional, Tuple
+from aiogram import Bot, types
+
+from app.database.session import settings
+from app.bot_manager import dp
+
+logger = logging.getLogger(__name__)
+
+# (klucz czatu, bot, persona, update, czas przyjęcia)
+QueueItem = Tuple[int, Bot, int, types.Update, float]
+
+def _chat_key(update: types.Update) -> int:
+    """
+    Klucz kolejności - id czatu, a gdy go brak, id nadawcy lub update_id.
+    Bez persony: czat prywatny ma to samo id u każdego bota, a wiersz users (limity, liczniki) jest wspólny.
+    """
+    event = update.event if update.event_type != "unknown" else None
+    chat = getattr(event, "chat", None)
+    if chat is not None: return chat.id
+    from_user = getattr(event, "from_user", None)
+    if from_user is not None: return from_user.id
+    return update.update_id
+
+class UpdateQueue:
+    """
+    Ograniczona kolejka update'ów z webhooka obsługiwana przez stałą pulę workerów.
+    Update'y jednego czatu przetwarzane są po kolei (także między botami różnych person), różne czaty równolegle.
+    """
+    def __init__(self, maxsize: int, workers: int):
+        self.maxsize = maxsize
+        self.worker_count = workers
+        self._queue: asyncio.Queue = asyncio.Queue()
+        # Czaty w trakcie obsługi -> update'y czekające na swoją kolej
+        self._inflight: Dict[int, Deque[QueueItem]] = {}
+        self._workers: List[asyncio.Task] = []
+        self._pending = 0
+        self._idle: Optional[asyncio.Event] = None
+        self._accepting = False
+        # --- STATYSTYKI ---
+        self.processed = 0
+        self.rejected = 0
+        self.failed = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+    def start(self):
+        self._idle = asyncio.Event(); self._idle.set()
+        self._accepting = True
+        self._workers = [asyncio.create_task(self._worker(i)) for i in range(self.worker_count)]
+        logger.info(f"Update queue started: {self.worker_count} workers, max {self.maxsize} pending")
+
+    def put(self, bot: Bot, persona_id: int, update: types.Update) -> bool:
+        """Przyjmuje update bez czekania. False = kolejka pełna (webhook odpowiada 503, Telegram ponowi)."""
+        if not self._accepting or self._pending >= self.maxsize:
+            self.rejected += 1
+            return False
+        self._pending += 1
+        self._idle.clear()
+        self._queue.put_nowait((_chat_key(update), bot, persona_id, update, time.monotonic()))
+        return True
+
+    async def _handle(self, item: QueueItem):
+        _, bot, persona_id, update, enqueued_at = item
+        wait = time.monotonic() - enqueued_at
+        self._wait_total += wait
+        self._wait_max = max(self._wait_max, wait)
+        try:
+            await dp.feed_update(bot=bot, update=update, persona_id=persona_id)
+        except Exception as e:
+            self.failed += 1
+            logger.error(f"Update {update.update_id} failed: {e}", exc_info=True)
+        finally:
+            self.processed += 1
+            self._pending -= 1
+            if self._pending == 0: self._idle.set()
+
+    async def _worker(self, n: int):
+        while True:
+            item = await self._queue.get()
+            key = item[0]
+            if key in self._inflight:
+                # Inny worker obsługuje już ten czat - zachowujemy kolejność
+                self._inflight[key].append(item)
+                continue
+            backlog: Deque[QueueItem] = deque()
+            self._inflight[key] = backlog
+            try:
+                await self._handle(item)
+                while backlog:
+                    await self._handle(backlog.popleft())
+            finally:
+                del self._inflight[key]
+
+    async def drain(self, timeout: float):
+        """Przestaje przyjmować update'y i czeka (maks. timeout s) na dokończenie kolejki."""
+        self._accepting = False
+        if self._idle is not None and self._pending:
+            logger.info(f"Draining update queue ({self._pending} pending)...")
+            try:
+                await asyncio.wait_for(self._idle.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                logger.warning(f"Update queue drain timed out, {self._pending} updates dropped")
+        for w in self._workers: w.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    def stats(self) -> dict:
+        return {
+            "depth": self._pending,
+            "queued": self._queue.qsize(),
+            "active_chats": len(self._inflight),
+            "workers": self.worker_count,
+            "max_size": self.maxsize,
+            "processed": self.processed,
+            "rejected": self.rejected,
+            "failed": self.failed,
+            "avg_wait_ms": round(self._wait_total / self.processed * 1000, 1) if self.processed else 0.0,
+            "max_wait_ms": round(self._wait_max * 1000, 1),
+        }
+
+update_queue = UpdateQueue(maxsize=settings.UPDATE_QUEUE_MAXSIZE, workers=settings.UPDATE_WORKERS)
@@ -0,0 +1,120 @@
+import asyncio
+import logging
+from datetime import datetime
+from typing import List, Optional, Tuple
+
+from sqlalchemy import select, update, func, tuple_
+
+from app.database.models import User
+from app.database.session import settings, AsyncSessionLocal
+from app.bot_manager import get_bot
+from app.persona_cache import get_persona
+from app.broadcast_engine import bot_bucket
+
+logger = logging.getLogger(__name__)
+
+EXPIRED_TEXT = "Babe, twoja subskrypcja VIP właśnie wygasła i musiałam cię usunąć z mojego prywatnego pokoju 🥺 Strasznie mi ciebie brakuje... opłać dostęp na kolejne 30 dni, czekam na ciebie! Wpisz /vip"
+
+def _pending_expiry(now: datetime):
+    """Wygasłe subskrypcje, których jeszcze nie obsłużyliśmy (indeks częściowy ix_users_vip_pending_expiry)."""
+    return (User.vip_kicked_at.is_(None), User.subscription_expires_at < now)
+
+async def _kick(persona_id: Optional[int], user_id: int) -> bool:
+    """
+    Usuwa użytkownika z prywatnego kanału persony, z którą rozmawia, i wysyła wiadomość od jej bota.
+    False = użytkownik nie został usunięty (persona nieaktywna, błąd API) - zostaje do ponowienia.
+    """
+    bot, persona = await get_bot(persona_id), await get_persona(persona_id)
+    if not bot or not persona:
+        logger.warning(f"VIP sweeper: persona {persona_id} of user {user_id} is inactive, kick postponed")
+        return False
+    # Persona bez kanału - nie ma czego odbierać
+    if not persona.private_channel_id: return True
+    channel_id = persona.private_channel_id
+    # Limiter bota wspólny z broadcastami - razem nie przekraczają limitu Telegrama
+    bucket = bot_bucket(bot)
+    try:
+        for call in (
+            lambda: bot.ban_chat_member(chat_id=channel_id, user_id=user_id),
+            lambda: bot.unban_chat_member(chat_id=channel_id, user_id=user_id),
+        ):
+            await bucket.acquire()
+            await call()
+    except Exception as e:
+        logger.error(f"Error kicking user {user_id}: {e}")
+        return False
+    try:
+        # Zablokowany bot nie cofa usunięcia z kanału
+        await bucket.acquire()
+        await bot.send_message(chat_id=user_id, text=EXPIRED_TEXT)
+    except Exception as e:
+        logger.error(f"Error notifying kicked user {user_id}: {e}")
+    return True
+
+async def sweep_expired() -> Tuple[int, int]:
+    """
+    Obsługuje wygasłe subskrypcje paczkami po VIP_SWEEP_BATCH (kursor po (expires_at, telegram_id)):
+    usunięcie z kanału równolegle pod limiterem, potem jeden commit na paczkę.
+    Oznaczani są tylko faktycznie usunięci. Zwraca (obsłużeni, pozostawieni do ponowienia).
+    """
+    now = datetime.utcnow()
+    limit = asyncio.Semaphore(settings.VIP_SWEEP_CONCURRENCY)
+    cursor: Optional[Tuple[datetime, int]] = None
+    handled = postponed = 0
+
+    async def kick(persona_id: Optional[int], user_id: int) -> bool:
+        async with limit:
+            return await _kick(persona_id, user_id)
+
+    while True:
+        query = select(User.telegram_id, User.subscription_expires_at, User.persona_id).where(*_pending_expiry(now))
+        if cursor:
+            query = query.where(tuple_(User.subscription_expires_at, User.telegram_id) > tuple_(*cursor))
+        async with AsyncSessionLocal() as db:
+            rows: List[Tuple[int, datetime, Optional[int]]] = (await db.execute(
+                query.order_by(User.subscription_expires_at, User.telegram_id).limit(settings.VIP_SWEEP_BATCH)
+            )).all()
+        if not rows: return handled, postponed
+        cursor = (rows[-1][1], rows[-1][0])
+
+        kicked = await asyncio.gather(*(kick(persona_id, user_id) for user_id, _, persona_id in rows))
+        ids = [user_id for (user_id, _, _), ok in zip(rows, kicked) if ok]
+        postponed += len(rows) - len(ids)
+        if not ids: continue
+
+        # Warunek na datę chroni przed nadpisaniem odnowienia opłaconego w trakcie paczki
+        async with AsyncSessionLocal() as db:
+            await db.execute(update(User).where(User.telegram_id.in_(ids), *_pending_expiry(now)).values(vip_kicked_at=now))
+            await db.commit()
+        handled += len(ids)
+
+async def _next_due() -> datetime:
+    """Najbliższe przyszłe wygaśnięcie (zaległe, nieudane usunięcia ponawia VIP_SWEEP_RETRY_INTERVAL)."""
+    async with AsyncSessionLocal() as db:
+        return await db.scalar(select(func.min(User.subscription_expires_at)).where(
+            User.vip_kicked_at.is_(None), User.subscription_expires_at >= datetime.utcnow()
+        ))
+
+async def check_expired_subscriptions():
+    """Pętla w tle: obsługuje wygasłe subskrypcje i śpi do najbliższego terminu (nie dłużej niż VIP_SWEEP_MAX_SLEEP)."""
+    while True:
+        delay = settings.VIP_SWEEP_MAX_SLEEP
+        try:
+            if not await get_bot():
+                await asyncio.sleep(60)
+                continue
+
+            handled, postponed = await sweep_expired()
+            if handled: logger.info(f"VIP sweeper: {handled} expired subscriptions handled")
+            if postponed:
+                logger.warning(f"VIP sweeper: {postponed} expired users not removed yet, retrying in {settings.VIP_SWEEP_RETRY_INTERVAL:.0f}s")
+                delay = min(delay, settings.VIP_SWEEP_RETRY_INTERVAL)
+
+            next_due = await _next_due()
+            if next_due:
+                seconds = (next_due.replace(tzinfo=None) - datetime.utcnow()).total_seconds() + 1
+                delay = min(delay, max(seconds, 1.0))
+        except Exception as e:
+            logger.error(f"Subscription checker error: {e}")
+
+        await asyncio.sleep(delay)
@@ -1,21 +1,26 @@
 import secrets
-import asyncio
 import logging
 from datetime import datetime
 from typing import List, Optional
-from fastapi import APIRouter, Depends, HTTPException, Form, Request, BackgroundTasks
-from fastapi.responses import HTMLResponse, RedirectResponse
+from fastapi import APIRouter, Depends, HTTPException, Form, Request
+from fastapi.responses import HTMLResponse, RedirectResponse, StreamingResponse
 from fastapi.security import HTTPBasic, HTTPBasicCredentials
 from fastapi.templating import Jinja2Templates
 
-from sqlalchemy import select, func, desc, update, case 
+from sqlalchemy import select, func, desc, update, case, insert, literal, tuple_
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import selectinload
 from aiogram.types import LabeledPrice
 
-from app.database.models import User, Message, Persona, Group, Broadcast, BroadcastLog, MediaContent, PromoContent, CustomRequest, Transaction, Scenario
-from app.database.session import get_db, settings, AsyncSessionLocal 
-from app.bot_manager import init_bot, get_bot
+from app.database.models import user_groups, User, Message, Persona, Group, Broadcast, BroadcastLog, MediaContent, PromoContent, CustomRequest, Scenario, DailyMetrics
+from app.database.session import get_db, settings
+from app.bot_manager import get_bot, persona_token, register_webhook, swap_webhook, unregister_webhook
+from app.persona_cache import get_persona, notify_persona_changed
+from app.catalog_cache import notify_catalog_changed
+from app.update_queue import update_queue
+from app.chat_mailbox import chat_mailbox
+from app.broadcast_engine import wake_broadcast_worker
+from app.model_router import model_health, persona_models
 
 logger = logging.getLogger(__name__)
 
@@ -32,32 +37,62 @@ def auth(credentials: HTTPBasicCredentials = Depends(security)):
 @router.get("/", response_class=HTMLResponse)
 @router.get("/users", response_class=HTMLResponse)
 async def dashboard(request: Request, db: AsyncSession = Depends(get_db), user=Depends(auth)):
-    users = (await db.execute(select(User).order_by(desc(User.created_at)))).scalars().all()
-    
     now = datetime.utcnow()
-    vip_users = len([u for u in users if u.subscription_expires_at and u.subscription_expires_at.replace(tzinfo=None) > now])
-    
-    total_ai_cost = await db.scalar(select(func.sum(Message.ai_cost))) or 0.0
-    total_revenue = await db.scalar(select(func.sum(Transaction.amount)).where(Transaction.status == "completed")) or 0.0
+    total_users = await db.scalar(select(func.count(User.telegram_id)))
+    vip_users = await db.scalar(select(func.count(User.telegram_id)).where(User.subscription_expires_at > now))
+    # Sumy z dziennych agregatów (daily_metrics) - bez skanowania messages i transactions
+    total_ai_cost, total_revenue = (await db.execute(
+        select(func.coalesce(func.sum(DailyMetrics.ai_cost), 0.0), func.coalesce(func.sum(DailyMetrics.revenue), 0.0))
+    )).one()
+    recent_users = (await db.execute(select(User).order_by(desc(User.created_at)).limit(15))).scalars().all()
     
-    costs = await db.execute(select(Message.user_id, func.sum(Message.ai_cost)).group_by(Message.user_id))
-    cost_map = {row[0]: row[1] or 0.0 for row in costs.all()}
-    
-    for u in users:
-        u.total_cost = round(cost_map.get(u.telegram_id, 0.0), 4)
+    for u in recent_users:
+        u.total_cost = round(u.lifetime_ai_cost or 0.0, 4)
 
     return templates.TemplateResponse("dashboard.html", {
-        "request": request, "total_users": len(users), "vip_users": vip_users, 
-        "recent_users": users[:15], "username": user, 
+        "request": request, "total_users": total_users, "vip_users": vip_users, 
+        "recent_users": recent_users, "username": user, 
         "total_ai_cost": round(total_ai_cost, 4), "total_revenue": round(total_revenue, 2)
     })
 
+@router.get("/queue")
+async def queue_stats(user=Depends(auth)):
+    return {**update_queue.stats(), "mailbox": chat_mailbox.stats()}
+
+async def _chat_page(db: AsyncSession, user_id: int, before_ts: Optional[datetime] = None, before_id: Optional[int] = None):
+    """
+    Strona historii czatu (od najstarszej) starsza niż kursor (timestamp, id) - keyset po indeksie
+    ix_messages_user_id_timestamp_id. Zwraca (wiadomości, kursor następnej strony lub None).
+    """
+    query = select(Message).where(Message.user_id == user_id)
+    if before_ts is not None and before_id is not None:
+        query = query.where(tuple_(Message.timestamp, Message.id) < tuple_(before_ts, before_id))
+    rows = (await db.execute(
+        query.order_by(Message.timestamp.desc(), Message.id.desc()).limit(settings.ADMIN_CHAT_PAGE_SIZE + 1)
+    )).scalars().all()
+    has_more = len(rows) > settings.ADMIN_CHAT_PAGE_SIZE
+    rows = rows[:settings.ADMIN_CHAT_PAGE_SIZE][::-1]
+    cursor = {"before_ts": rows[0].timestamp.isoformat(), "before_id": rows[0].id} if has_more else None
+    return rows, cursor
+
 @router.get("/chat/{user_id}", response_class=HTMLResponse)
 async def chat_viewer(request: Request, user_id: int, db: AsyncSession = Depends(get_db), user=Depends(auth)):
     chat_user = await db.get(User, user_id)
     if not chat_user: raise HTTPException(status_code=404)
-    msgs = (await db.execute(select(Message).where(Message.user_id == user_id).order_by(Message.timestamp))).scalars().all()
-    return templates.TemplateResponse("chat_viewer.html", {"request": request, "chat_user": chat_user, "messages": msgs, "username": user})
+    msgs, cursor = await _chat_page(db, user_id)
+    # Strumieniowy render - starsze strony dociąga przeglądarka z /api/chat/{user_id}/messages
+    page = templates.get_template("chat_viewer.html").generate(
+        request=request, chat_user=chat_user, messages=msgs, cursor=cursor, username=user
+    )
+    return StreamingResponse(page, media_type="text/html")
+
+@router.get("/api/chat/{user_id}/messages")
+async def chat_messages_page(user_id: int, before_ts: datetime, before_id: int, db: AsyncSession = Depends(get_db), user=Depends(auth)):
+    msgs, cursor = await _chat_page(db, user_id, before_ts, before_id)
+    return {
+        "messages": [{"id": m.id, "role": m.role, "content": m.content, "time": m.timestamp.strftime('%H:%M')} for m in msgs],
+        "next": cursor,
+    }
 
 @router.post("/users/{user_id}/add_credits")
 async def add_user_credits(user_id: int, amount: int = Form(...), db: AsyncSession = Depends(get_db), user=Depends(auth)):
@@ -67,10 +102,76 @@ async def add_user_credits(user_id: int, amount: int = Form(...), db: AsyncSessi
         await db.commit()
     return RedirectResponse(url=f"/admin/chat/{user_id}", status_code=303)
 
+# --- WYSZUKIWARKA UŻYTKOWNIKÓW ---
+def username_sort_key(db: AsyncSession):
+    """Klucz sortowania/wyszukiwania po nazwie; w Postgresie z collation "C" jak indeks ix_users_username_search."""
+    key = func.coalesce(func.lower(User.username), "")
+    return key.collate("C") if db.get_bind().dialect.name == "postgresql" else key
+
+def _user_row(u: User, now: datetime) -> dict:
+    expires = u.subscription_expires_at.replace(tzinfo=None) if u.subscription_expires_at else None
+    return {
+        "telegram_id": u.telegram_id, "username": u.username,
+        "is_vip": bool(expires and expires > now),
+        "subscription_expires_at": expires.strftime('%Y-%m-%d %H:%M') if expires else None,
+        "days_expired": (now - expires).days if expires and expires < now else None,
+        "created_at": u.created_at.strftime('%Y-%m-%d') if u.created_at else None,
+    }
+
+async def search_users(db: AsyncSession, q: Optional[str] = None, status: Optional[str] = None,
+                       group_id: Optional[int] = None, exclude_group_id: Optional[int] = None,
+                       after: Optional[str] = None, after_id: Optional[int] = None, limit: int = 50):
+    """
+    Strona użytkowników z kursorem (klucz sortowania, telegram_id).
+    status: vip / expired / free; lista wygasłych sortowana od ostatnio wygasłych, pozostałe po nazwie.
+    Zwraca (użytkownicy, kursor następnej strony lub None).
+    """
+    now = datetime.utcnow()
+    limit = max(1, min(limit, 200))
+    query = select(User)
+    if q and q.strip():
+        query = query.where(username_sort_key(db).startswith(q.strip().lower(), autoescape=True))
+    if status == "vip": query = query.where(User.subscription_expires_at > now)
+    elif status == "expired": query = query.where(User.subscription_expires_at < now)
+    elif status == "free": query = query.where(User.subscription_expires_at.is_(None))
+    if group_id is not None:
+        query = query.where(User.telegram_id.in_(select(user_groups.c.user_id).where(user_groups.c.group_id == group_id)))
+    if exclude_group_id is not None:
+        query = query.where(User.telegram_id.not_in(select(user_groups.c.user_id).where(user_groups.c.group_id == exclude_group_id)))
+
+    if status == "expired":
+        if after is not None and after_id is not None:
+            query = query.where(tuple_(User.subscription_expires_at, User.telegram_id) < tuple_(datetime.fromisoformat(after), after_id))
+        query = query.order_by(User.subscription_expires_at.desc(), User.telegram_id.desc())
+    else:
+        key = username_sort_key(db)
+        if after is not None and after_id is not None:
+            query = query.where(tuple_(key, User.telegram_id) > tuple_(after, after_id))
+        query = query.order_by(key, User.telegram_id)
+
+    users = (await db.execute(query.limit(limit + 1))).scalars().all()
+    cursor = None
+    if len(users) > limit:
+        users = users[:limit]
+        last = users[-1]
+        value = last.subscription_expires_at.isoformat() if status == "expired" else (last.username or "").lower()
+        cursor = {"after": value, "after_id": last.telegram_id}
+    return users, cursor
+
+@router.get("/api/users")
+async def users_api(q: Optional[str] = None, status: Optional[str] = None, group_id: Optional[int] = None,
+                    exclude_group_id: Optional[int] = None, after: Optional[str] = None, after_id: Optional[int] = None,
+                    limit: int = 50, db: AsyncSession = Depends(get_db), user=Depends(auth)):
+    users, cursor = await search_users(db, q, status, group_id, exclude_group_id, after, after_id, limit)
+    now = datetime.utcnow()
+    return {"users": [_user_row(u, now) for u in users], "next": cursor}
+
 # --- GROUPS ---
 @router.get("/groups", response_class=HTMLResponse)
 async def list_groups(request: Request, db: AsyncSession = Depends(get_db), user=Depends(auth)):
-    groups = (await db.execute(select(Group).options(selectinload(Group.users)))).scalars().all()
+    groups = (await db.execute(select(Group))).scalars().all()
+    counts = dict((await db.execute(select(user_groups.c.group_id, func.count()).group_by(user_groups.c.group_id))).all())
+    for g in groups: g.member_count = counts.get(g.id, 0)
     return templates.TemplateResponse("groups.html", {"request": request, "groups": groups, "username": user})
 
 @router.post("/groups/create")
@@ -80,10 +181,11 @@ async def create_group(name: str = Form(...), description: str = Form(None), db:
 
 @router.get("/groups/{group_id}", response_class=HTMLResponse)
 async def edit_group(request: Request, group_id: int, db: AsyncSession = Depends(get_db), user=Depends(auth)):
-    group = await db.get(Group, group_id, options=[selectinload(Group.users)])
+    group = await db.get(Group, group_id)
     if not group: raise HTTPException(status_code=404)
-    all_users = (await db.execute(select(User).order_by(User.username))).scalars().all()
-    return templates.TemplateResponse("group_edit.html", {"request": request, "group": group, "all_users": all_users, "username": user})
+    # Członkowie i lista do dodania ładowane stronami z /api/users
+    member_count = await db.scalar(select(func.count()).select_from(user_groups).where(user_groups.c.group_id == group_id))
+    return templates.TemplateResponse("group_edit.html", {"request": request, "group": group, "member_count": member_count, "username": user})
 
 @router.post("/groups/{group_id}/update")
 async def update_group(group_id: int, name: str = Form(...), description: str = Form(None), db: AsyncSession = Depends(get_db), user=Depends(auth)):
@@ -99,43 +201,55 @@ async def delete_group(group_id: int, db: AsyncSession = Depends(get_db), user=D
 
 @router.post("/groups/{group_id}/add_user")
 async def add_user_to_group(group_id: int, user_id: int = Form(...), db: AsyncSession = Depends(get_db), user=Depends(auth)):
-    group = await db.get(Group, group_id, options=[selectinload(Group.users)])
-    user_obj = await db.get(User, user_id)
-    if group and user_obj and user_obj not in group.users: group.users.append(user_obj); await db.commit()
+    exists = await db.scalar(select(func.count()).select_from(user_groups).where(user_groups.c.group_id == group_id, user_groups.c.user_id == user_id))
+    if not exists and await db.get(Group, group_id) and await db.get(User, user_id):
+        await db.execute(insert(user_groups).values(group_id=group_id, user_id=user_id)); await db.commit()
     return RedirectResponse(url=f"/admin/groups/{group_id}", status_code=303)
 
 @router.post("/groups/{group_id}/remove_user")
 async def remove_user_from_group(group_id: int, user_id: int = Form(...), db: AsyncSession = Depends(get_db), user=Depends(auth)):
-    group = await db.get(Group, group_id, options=[selectinload(Group.users)])
-    user_obj = await db.get(User, user_id)
-    if group and user_obj and user_obj in group.users: group.users.remove(user_obj); await db.commit()
+    await db.execute(user_groups.delete().where(user_groups.c.group_id == group_id, user_groups.c.user_id == user_id)); await db.commit()
     return RedirectResponse(url=f"/admin/groups/{group_id}", status_code=303)
 
 # --- PERSONAS ---
+def _parse_models(text: str) -> List[str]:
+    """Lista modeli z formularza (jeden na linię lub po przecinku), bez pustych i duplikatów, z zachowaniem kolejności."""
+    models = [m.strip() for m in (text or "").replace(",", "\n").splitlines() if m.strip()]
+    return list(dict.fromkeys(models)) or [settings.AI_MODEL]
+
 @router.get("/personas", response_class=HTMLResponse)
 async def personas_list(request: Request, db: AsyncSession = Depends(get_db), user=Depends(auth)):
     personas = (await db.execute(select(Persona).order_by(Persona.id))).scalars().all()
-    msg_count = await db.scalar(select(func.count(Message.id)))
-    total_cost = await db.scalar(select(func.sum(Message.ai_cost))) or 0.0
+    stats = {row.persona_id: row for row in (await db.execute(
+        select(DailyMetrics.persona_id,
+               func.sum(DailyMetrics.user_messages + DailyMetrics.assistant_messages).label("msgs"),
+               func.sum(DailyMetrics.ai_cost).label("cost"),
+               func.sum(DailyMetrics.llm_calls_saved).label("saved"))
+        .group_by(DailyMetrics.persona_id)
+    )).all()}
     for p in personas:
-        p.stats_msgs = msg_count if p.is_active else 0
-        p.stats_cost = round(total_cost, 4) if p.is_active else 0.0
-    return templates.TemplateResponse("personas.html", {"request": request, "personas": personas, "username": user})
+        row = stats.get(p.id)
+        p.stats_msgs = row.msgs if row else 0
+        p.stats_cost = round(row.cost or 0.0, 4) if row else 0.0
+        p.stats_saved = (row.saved or 0) if row else 0
+        p.models = persona_models(p)
+    return templates.TemplateResponse("personas.html", {"request": request, "personas": personas, "model_health": model_health(), "username": user})
 
 @router.post("/personas/create")
 async def create_persona(
     name: str = Form(...), system_prompt: str = Form(...), 
     telegram_token: str = Form(None), openrouter_token: str = Form(None), 
-    ai_model: str = Form("openrouter/free"), timezone: str = Form("America/New_York"),
+    ai_models: str = Form("openrouter/free"), timezone: str = Form("America/New_York"),
     db: AsyncSession = Depends(get_db), user=Depends(auth)
 ):
+    models = _parse_models(ai_models)
     t_token = telegram_token.strip() if telegram_token and telegram_token.strip() else None
     o_token = openrouter_token.strip() if openrouter_token and openrouter_token.strip() else None
     tz = timezone.strip() if timezone and timezone.strip() else "America/New_York"
     
     db.add(Persona(
         name=name, system_prompt=system_prompt, telegram_token=t_token, 
-        openrouter_token=o_token, ai_model=ai_model, timezone=tz, is_active=False
+        openrouter_token=o_token, ai_model=models[0], ai_models=models, timezone=tz, is_active=False
     ))
     await db.commit()
     return RedirectResponse(url="/admin/personas", status_code=303)
@@ -155,7 +269,7 @@ async def edit_persona_page(request: Request, persona_id: int, db: AsyncSession
 async def update_persona(
     persona_id: int, name: str = Form(...), system_prompt: str = Form(...), 
     telegram_token: str = Form(None), openrouter_token: str = Form(None), 
-    ai_model: str = Form(...), timezone: str = Form("America/New_York"),
+    ai_models: str = Form(...), timezone: str = Form("America/New_York"),
     private_channel_id: str = Form(None), vip_subscription_price: int = Form(500), 
     free_message_limit: int = Form(15), 
     vip_daily_limit: int = Form(50), ppv_multiplier: int = Form(10), 
@@ -163,9 +277,12 @@ async def update_persona(
 ):
     persona = await db.get(Persona, persona_id)
     if persona:
+        old_token = persona_token(persona)
         persona.name = name
         persona.system_prompt = system_prompt
-        persona.ai_model = ai_model
+        # Pierwszy model listy zostaje w ai_model (budżet kontekstu, wyświetlanie)
+        persona.ai_models = _parse_models(ai_models)
+        persona.ai_model = persona.ai_models[0]
         persona.telegram_token = telegram_token.strip() if telegram_token and telegram_token.strip() else None
         persona.openrouter_token = openrouter_token.strip() if openrouter_token and openrouter_token.strip() else None
         persona.timezone = timezone.strip()
@@ -175,27 +292,30 @@ async def update_persona(
         persona.vip_daily_limit = vip_daily_limit
         persona.ppv_multiplier = ppv_multiplier
         await db.commit()
-        if persona.is_active: await init_bot()
+        # Prompt, model, limity: tylko odświeżenie snapshotu (bot zostaje ten sam, bez wywołań do Telegrama).
+        # Nowy token: podmiana bota w rejestrze i webhooka bez kasowania oczekujących update'ów.
+        await notify_persona_changed()
+        if persona.is_active and persona_token(persona) != old_token: await swap_webhook(persona_id)
     return RedirectResponse(url="/admin/personas", status_code=303)
 
 @router.post("/personas/{persona_id}/activate")
 async def activate_persona(persona_id: int, db: AsyncSession = Depends(get_db), user=Depends(auth)):
-    await db.execute(update(Persona).values(is_active=False))
+    # Każda aktywna persona ma własnego bota i webhook /webhook/{persona_id} - pozostałe działają dalej
     await db.execute(update(Persona).where(Persona.id == persona_id).values(is_active=True))
-    await db.commit(); await init_bot()
+    await db.commit(); await notify_persona_changed(); await register_webhook(persona_id)
     return RedirectResponse(url="/admin/personas", status_code=303)
 
 @router.post("/personas/{persona_id}/deactivate")
 async def deactivate_persona(persona_id: int, db: AsyncSession = Depends(get_db), user=Depends(auth)):
     persona = await db.get(Persona, persona_id)
-    if persona: persona.is_active = False; await db.commit(); await init_bot()
+    if persona: persona.is_active = False; await db.commit(); await unregister_webhook(persona_id); await notify_persona_changed()
     return RedirectResponse(url="/admin/personas", status_code=303)
 
 @router.post("/personas/{persona_id}/delete")
 async def delete_persona(persona_id: int, db: AsyncSession = Depends(get_db), user=Depends(auth)):
     persona = await db.get(Persona, persona_id)
     if persona:
-        if persona.is_active: persona.is_active = False; await db.commit(); await init_bot()
+        if persona.is_active: persona.is_active = False; await db.commit(); await unregister_webhook(persona_id); await notify_persona_changed()
         await db.delete(persona); await db.commit()
     return RedirectResponse(url="/admin/personas", status_code=303)
 
@@ -219,6 +339,7 @@ async def create_scenario(
                 
     db.add(new_scenario)
     await db.commit()
+    await notify_persona_changed()
     return RedirectResponse(url=f"/admin/personas/{persona_id}", status_code=303)
 
 @router.post("/personas/{persona_id}/scenarios/{scenario_id}/toggle")
@@ -227,6 +348,7 @@ async def toggle_scenario(persona_id: int, scenario_id: int, db: AsyncSession =
     if scenario and scenario.persona_id == persona_id:
         scenario.is_active = not scenario.is_active
         await db.commit()
+        await notify_persona_changed()
     return RedirectResponse(url=f"/admin/personas/{persona_id}", status_code=303)
 
 @router.post("/personas/{persona_id}/scenarios/{scenario_id}/delete")
@@ -235,6 +357,7 @@ async def delete_scenario(persona_id: int, scenario_id: int, db: AsyncSession =
     if scenario and scenario.persona_id == persona_id:
         await db.delete(scenario)
         await db.commit()
+        await notify_persona_changed()
     return RedirectResponse(url=f"/admin/personas/{persona_id}", status_code=303)
 
 # --- BROADCAST SYSTEM ---
@@ -245,56 +368,94 @@ async def broadcast_page(request: Request, db: AsyncSession = Depends(get_db), u
     media_items = (await db.execute(select(MediaContent).order_by(desc(MediaContent.created_at)))).scalars().all()
     return templates.TemplateResponse("broadcast.html", {"request": request, "groups": groups, "history": history, "media_items": media_items, "username": user})
 
+# Filtry raportu broadcastu -> stany wierszy broadcast_logs
+LOG_STATUS_FILTERS = {"queued": ("pending", "claimed", "sending"), "sent": ("sent",), "failed": ("failed",), "cancelled": ("cancelled",)}
+
+async def broadcast_logs_page(db: AsyncSession, broadcast_id: int, status: Optional[str] = None,
+                              after_id: Optional[int] = None, limit: int = 50):
+    """Strona odbiorców broadcastu z kursorem po id wiersza. Zwraca (wiersze, kursor następnej strony lub None)."""
+    limit = max(1, min(limit, 200))
+    query = select(BroadcastLog.id, BroadcastLog.user_id, BroadcastLog.status, BroadcastLog.error_message, BroadcastLog.timestamp, User.username) \
+        .join(User, User.telegram_id == BroadcastLog.user_id, isouter=True).where(BroadcastLog.broadcast_id == broadcast_id)
+    if status in LOG_STATUS_FILTERS: query = query.where(BroadcastLog.status.in_(LOG_STATUS_FILTERS[status]))
+    if after_id is not None: query = query.where(BroadcastLog.id > after_id)
+    rows = (await db.execute(query.order_by(BroadcastLog.id).limit(limit + 1))).all()
+    cursor = rows[limit - 1].id if len(rows) > limit else None
+    return [{
+        "user_id": r.user_id, "username": r.username, "status": r.status, "error_message": r.error_message,
+        "timestamp": r.timestamp.strftime('%H:%M:%S') if r.timestamp else None,
+    } for r in rows[:limit]], cursor
+
 @router.get("/broadcast/{broadcast_id}", response_class=HTMLResponse)
-async def broadcast_details(request: Request, broadcast_id: int, db: AsyncSession = Depends(get_db), user=Depends(auth)):
+async def broadcast_details(request: Request, broadcast_id: int, status: Optional[str] = None, db: AsyncSession = Depends(get_db), user=Depends(auth)):
     broadcast = await db.get(Broadcast, broadcast_id)
     if not broadcast: raise HTTPException(status_code=404)
-    logs = (await db.execute(select(BroadcastLog).options(selectinload(BroadcastLog.user)).where(BroadcastLog.broadcast_id == broadcast_id).order_by(BroadcastLog.status))).scalars().all()
-    return templates.TemplateResponse("broadcast_details.html", {"request": request, "broadcast": broadcast, "logs": logs, "username": user})
-
-async def background_send_task(broadcast_id: int, user_ids: List[int]):
-    bot = await get_bot()
-    if not bot: return
-    async with AsyncSessionLocal() as db:
-        broadcast = await db.get(Broadcast, broadcast_id)
-        if not broadcast: return
-        media_item = await db.get(MediaContent, broadcast.media_id) if broadcast.media_id else None
-        
-        success_count = 0; fail_count = 0
-        for uid in user_ids:
-            try:
-                if broadcast.message_content and broadcast.message_content.strip(): await bot.send_message(chat_id=uid, text=broadcast.message_content)
-                if media_item: await bot.send_invoice(chat_id=uid, title=f"Unlock: {media_item.name} 🔒", description="Exclusive private content. Pay to unlock immediately.", payload=f"ppv_{media_item.id}", currency="XTR", prices=[LabeledPrice(label="Unlock Content", amount=media_item.price)], provider_token="")
-                success_count += 1
-                db.add(BroadcastLog(broadcast_id=broadcast.id, user_id=uid, status="sent"))
-                await asyncio.sleep(0.05)
-            except Exception as e:
-                fail_count += 1
-                db.add(BroadcastLog(broadcast_id=broadcast.id, user_id=uid, status="failed", error_message=str(e)[:250]))
-        
-        broadcast.status = "completed"; broadcast.success_count = success_count; broadcast.fail_count = fail_count; await db.commit()
+    # Liczniki per stan w SQL (indeks broadcast_id, status) - strona nie rośnie z liczbą odbiorców
+    by_status = dict((await db.execute(
+        select(BroadcastLog.status, func.count()).where(BroadcastLog.broadcast_id == broadcast_id).group_by(BroadcastLog.status)
+    )).all())
+    counts = {name: sum(by_status.get(s, 0) for s in states) for name, states in LOG_STATUS_FILTERS.items()}
+    status = status if status in LOG_STATUS_FILTERS else None
+    logs, cursor = await broadcast_logs_page(db, broadcast_id, status)
+    return templates.TemplateResponse("broadcast_details.html", {
+        "request": request, "broadcast": broadcast, "logs": logs, "cursor": cursor, "counts": counts, "status": status, "username": user,
+    })
+
+@router.get("/api/broadcast/{broadcast_id}/logs")
+async def broadcast_logs_api(broadcast_id: int, status: Optional[str] = None, after_id: Optional[int] = None, limit: int = 50,
+                             db: AsyncSession = Depends(get_db), user=Depends(auth)):
+    logs, cursor = await broadcast_logs_page(db, broadcast_id, status, after_id, limit)
+    return {"logs": logs, "next": cursor}
 
 @router.post("/broadcast/send")
-async def send_broadcast(request: Request, background_tasks: BackgroundTasks, target_type: str = Form(...), group_ids: List[int] = Form(default=[]), message_text: str = Form(...), media_id: Optional[int] = Form(None), db: AsyncSession = Depends(get_db), user=Depends(auth)):
+async def send_broadcast(request: Request, target_type: str = Form(...), group_ids: List[int] = Form(default=[]), message_text: str = Form(...), media_id: Optional[int] = Form(None), db: AsyncSession = Depends(get_db), user=Depends(auth)):
     try:
-        target_users_ids = set()
-        if target_type == "all": target_users_ids = set((await db.execute(select(User.telegram_id))).scalars().all())
+        if target_type == "all": audience = select(User.telegram_id)
         elif target_type == "groups":
             if not group_ids: return HTMLResponse("<h1>Error</h1><p>Check at least one group.</p><a href='/admin/broadcast'>Go back</a>", status_code=400)
-            for gid in group_ids:
-                group = await db.get(Group, gid, options=[selectinload(Group.users)])
-                if group:
-                    for u in group.users: target_users_ids.add(u.telegram_id)
-        
-        if not target_users_ids: return HTMLResponse("<h1>Error</h1><p>No users found.</p><a href='/admin/broadcast'>Go back</a>", status_code=400)
-
-        new_broadcast = Broadcast(message_content=message_text, target_type=target_type, media_id=media_id, total_recipients=len(target_users_ids), status="processing")
-        db.add(new_broadcast); await db.commit(); await db.refresh(new_broadcast)
-        background_tasks.add_task(background_send_task, new_broadcast.id, list(target_users_ids))
+            audience = select(user_groups.c.user_id).where(user_groups.c.group_id.in_(group_ids)).distinct()
+        else: audience = None
+
+        new_broadcast = Broadcast(message_content=message_text, target_type=target_type, media_id=media_id, total_recipients=0, status="processing")
+        db.add(new_broadcast); await db.flush()
+        # Odbiorcy trafiają do broadcast_logs jednym INSERT ... SELECT - lista ID nie przechodzi przez aplikację
+        total = 0
+        if audience is not None:
+            audience = audience.subquery()
+            total = (await db.execute(insert(BroadcastLog).from_select(
+                ["broadcast_id", "user_id", "status", "timestamp"],
+                select(literal(new_broadcast.id), audience.c[0], literal("pending"), literal(datetime.utcnow())),
+            ))).rowcount
+        if not total:
+            await db.rollback()
+            return HTMLResponse("<h1>Error</h1><p>No users found.</p><a href='/admin/broadcast'>Go back</a>", status_code=400)
+        new_broadcast.total_recipients = total
+        await db.commit()
+        wake_broadcast_worker()
         
         return RedirectResponse(url=f"/admin/broadcast/{new_broadcast.id}", status_code=303)
     except Exception as e: return HTMLResponse(f"<h1>Crash!</h1><p>Database Error: {e}</p>", status_code=500)
 
+@router.post("/broadcast/{broadcast_id}/pause")
+async def pause_broadcast(broadcast_id: int, db: AsyncSession = Depends(get_db), user=Depends(auth)):
+    await db.execute(update(Broadcast).where(Broadcast.id == broadcast_id, Broadcast.status == "processing").values(status="paused")); await db.commit()
+    return RedirectResponse(url=f"/admin/broadcast/{broadcast_id}", status_code=303)
+
+@router.post("/broadcast/{broadcast_id}/resume")
+async def resume_broadcast(broadcast_id: int, db: AsyncSession = Depends(get_db), user=Depends(auth)):
+    await db.execute(update(Broadcast).where(Broadcast.id == broadcast_id, Broadcast.status == "paused").values(status="processing")); await db.commit()
+    wake_broadcast_worker()
+    return RedirectResponse(url=f"/admin/broadcast/{broadcast_id}", status_code=303)
+
+@router.post("/broadcast/{broadcast_id}/cancel")
+async def cancel_broadcast(broadcast_id: int, db: AsyncSession = Depends(get_db), user=Depends(auth)):
+    res = await db.execute(update(Broadcast).where(Broadcast.id == broadcast_id, Broadcast.status.in_(["processing", "paused"])).values(status="cancelled"))
+    if res.rowcount:
+        # "claimed" też - nadawca sprawdza stan tuż przed wysyłką i pominie anulowany wiersz
+        await db.execute(update(BroadcastLog).where(BroadcastLog.broadcast_id == broadcast_id, BroadcastLog.status.in_(("pending", "claimed"))).values(status="cancelled"))
+    await db.commit()
+    return RedirectResponse(url=f"/admin/broadcast/{broadcast_id}", status_code=303)
+
 # --- PPV & CUSTOM ---
 @router.get("/media", response_class=HTMLResponse)
 async def media_list(request: Request, db: AsyncSession = Depends(get_db), user=Depends(auth)):
@@ -304,12 +465,14 @@ async def media_list(request: Request, db: AsyncSession = Depends(get_db), user=
 @router.post("/media/create")
 async def create_media(tag: str = Form(...), name: str = Form(...), file_id: str = Form(...), media_type: str = Form(...), price: int = Form(...), db: AsyncSession = Depends(get_db), user=Depends(auth)):
     db.add(MediaContent(tag=tag.strip().lower().replace(" ", "_"), name=name, file_id=file_id.strip(), media_type=media_type, price=price)); await db.commit()
+    await notify_catalog_changed()
     return RedirectResponse(url="/admin/media", status_code=303)
 
 @router.post("/media/{media_id}/delete")
 async def delete_media(media_id: int, db: AsyncSession = Depends(get_db), user=Depends(auth)):
     item = await db.get(MediaContent, media_id)
     if item: await db.delete(item); await db.commit()
+    await notify_catalog_changed()
     return RedirectResponse(url="/admin/media", status_code=303)
 
 # --- PROMO CONTENT ---
@@ -322,12 +485,14 @@ async def promo_list(request: Request, db: AsyncSession = Depends(get_db), user=
 async def create_promo(tag: str = Form(...), name: str = Form(...), file_id: str = Form(...), media_type: str = Form(...), db: AsyncSession = Depends(get_db), user=Depends(auth)):
     db.add(PromoContent(tag=tag.strip().lower().replace(" ", "_"), name=name, file_id=file_id.strip(), media_type=media_type))
     await db.commit()
+    await notify_catalog_changed()
     return RedirectResponse(url="/admin/promo", status_code=303)
 
 @router.post("/promo/{promo_id}/delete")
 async def delete_promo(promo_id: int, db: AsyncSession = Depends(get_db), user=Depends(auth)):
     item = await db.get(PromoContent, promo_id)
     if item: await db.delete(item); await db.commit()
+    await notify_catalog_changed()
     return RedirectResponse(url="/admin/promo", status_code=303)
 
 @router.get("/customs", response_class=HTMLResponse)
@@ -341,7 +506,8 @@ async def fulfill_custom_request(req_id: int, file_id: str = Form(...), media_ty
     if not req or req.status != "pending": return RedirectResponse(url="/admin/customs", status_code=303)
     req.file_id = file_id.strip(); req.media_type = media_type; req.price = price; req.status = "fulfilled"; await db.commit()
     
-    bot = await get_bot()
+    customer = await db.get(User, req.user_id)
+    bot = await get_bot(customer.persona_id if customer else None)
     if bot: await bot.send_invoice(chat_id=req.user_id, title="Your Custom Content 🔥", description=f"You requested: {req.description[:60]}...", payload=f"custom_{req.id}", currency="XTR", prices=[LabeledPrice(label="Unlock Custom", amount=price)], provider_token="")
     return RedirectResponse(url="/admin/customs", status_code=303)
 
@@ -355,24 +521,25 @@ async def reject_custom_request(req_id: int, db: AsyncSession = Depends(get_db),
 @router.get("/expired_vips", response_class=HTMLResponse)
 async def expired_vips_list(request: Request, db: AsyncSession = Depends(get_db), user=Depends(auth)):
     now = datetime.utcnow()
-    expired_users = (await db.execute(
-        select(User).where(User.subscription_expires_at < now).order_by(desc(User.subscription_expires_at))
-    )).scalars().all()
-    
-    for u in expired_users:
-        u.days_expired = (now - u.subscription_expires_at.replace(tzinfo=None)).days
-        
-    return templates.TemplateResponse("expired_vips.html", {"request": request, "expired_users": expired_users, "username": user})
+    # Pierwsza strona renderowana od razu, kolejne z /api/users?status=expired
+    expired_users, cursor = await search_users(db, status="expired")
+    expired_count = await db.scalar(select(func.count(User.telegram_id)).where(User.subscription_expires_at < now))
+    return templates.TemplateResponse("expired_vips.html", {
+        "request": request, "expired_users": [_user_row(u, now) for u in expired_users], "cursor": cursor,
+        "expired_count": expired_count, "username": user,
+    })
 
 @router.post("/expired_vips/{user_id}/renew")
 async def send_renewal_invite(user_id: int, message_text: str = Form(...), db: AsyncSession = Depends(get_db), user=Depends(auth)):
-    bot = await get_bot()
+    # Zaproszenie wysyła bot persony, z którą użytkownik rozmawiał
+    customer = await db.get(User, user_id)
+    persona_id = customer.persona_id if customer else None
+    bot = await get_bot(persona_id)
     if not bot:
         return RedirectResponse(url="/admin/expired_vips", status_code=303)
         
-    async with AsyncSessionLocal() as session:
-        active_persona = await session.scalar(select(Persona).where(Persona.is_active == True).limit(1))
-        vip_price = active_persona.vip_subscription_price if active_persona else 500
+    active_persona = await get_persona(persona_id)
+    vip_price = active_persona.vip_subscription_price if active_persona else 500
         
     try:
         if message_text.strip():
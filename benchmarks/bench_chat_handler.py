@@ -0,0 +1,111 @@
+"""
+Benchmark chat_handler: liczba commitów i czas obsługi jednej wiadomości.
+Telegram i OpenRouter są zastąpione atrapami, baza jest prawdziwa.
+
+Uruchomienie (domyślnie plik SQLite, wymaga aiosqlite):
+    python -m benchmarks.bench_chat_handler
+Albo na testowej bazie Postgres:
+    BENCH_DATABASE_URL=postgresql+asyncpg://... python -m benchmarks.bench_chat_handler
+"""
+import asyncio
+import os
+import statistics
+import tempfile
+import time
+from types import SimpleNamespace as NS
+
+_db_file = os.path.join(tempfile.gettempdir(), "bench_chat_handler.db")
+os.environ["DATABASE_URL"] = os.environ.get("BENCH_DATABASE_URL", f"sqlite+aiosqlite:///{_db_file}")
+for key, value in {"BOT_TOKEN": "123456:bench", "WEBHOOK_URL": "https://bench.local", "ADMIN_USER": "bench",
+                   "ADMIN_PASS": "bench", "REDIS_URL": "redis://localhost:6379", "OPENROUTER_KEY": "bench"}.items():
+    os.environ.setdefault(key, value)
+
+from aiogram import Bot
+from aiogram.types import Message as TGMessage
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+import app.main as main
+import app.bot_manager as bot_manager
+from app.database.models import Base, Persona, MediaContent
+from app.database.session import engine, AsyncSessionLocal
+from app.persona_cache import reload_persona_cache, get_persona
+
+REPLY = "[MEM: city=Austin] omg babe you're so sweet 💋 wanna see what i wore at the beach today? [PPV: red_bikini]"
+
+class FakeBot(Bot):
+    """Bot, który nie wysyła nic do Telegrama - tylko liczy wywołania."""
+    calls = 0
+    async def __call__(self, method, request_timeout=None):
+        FakeBot.calls += 1
+        return True
+
+class FakeAI:
+    """Atrapa klienta OpenAI (zwykła odpowiedź albo strumień)."""
+    def __init__(self):
+        self.chat = NS(completions=NS(create=self.create))
+
+    async def create(self, stream=False, **kwargs):
+        usage = NS(prompt_tokens=1200, completion_tokens=40, prompt_tokens_details=NS(cached_tokens=1024), model_extra={"cost": 0.0004})
+        if not stream:
+            return NS(choices=[NS(message=NS(content=REPLY))], usage=usage, model_extra={})
+        async def chunks():
+            for i in range(0, len(REPLY), 6):
+                yield NS(usage=None, choices=[NS(delta=NS(content=REPLY[i:i + 6]))])
+            yield NS(usage=usage, choices=[], model_extra={})
+        return chunks()
+
+commits = 0
+def _count_commit(session):
+    global commits
+    commits += 1
+
+async def _no_delay(delay, *args, **kwargs):
+    await _real_sleep(0)
+
+_real_sleep = asyncio.sleep
+
+async def setup():
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.drop_all)
+        await conn.run_sync(Base.metadata.create_all)
+    async with AsyncSessionLocal() as db:
+        db.add(Persona(name="Bench", system_prompt=main.DEFAULT_SKYE_PROMPT, ai_model="bench/model", is_active=True, free_message_limit=1000))
+        db.add(MediaContent(tag="red_bikini", name="Red bikini set", file_id="file", media_type="photo", price=250))
+        await db.commit()
+    await reload_persona_cache()
+    return await get_persona()
+
+async def run(messages: int = 200, users: int = 20):
+    global commits
+    persona = await setup()
+    bot = FakeBot(token=os.environ["BOT_TOKEN"])
+    bot_manager._bots[persona.id] = bot
+    main.get_ai_client = lambda token=None: FakeAI()
+    main.asyncio.sleep = _no_delay
+    event.listen(Session, "after_commit", _count_commit)
+
+    per_message_commits, durations = [], []
+    for i in range(messages):
+        uid = 1000 + i % users
+        msg = TGMessage.model_validate({
+            "message_id": i + 1, "date": 0, "text": f"hey babe #{i}",
+            "chat": {"id": uid, "type": "private"}, "from": {"id": uid, "is_bot": False, "first_name": f"fan{uid}"},
+        }).as_(bot)
+        commits = 0
+        start = time.perf_counter()
+        await main.chat_handler(msg, bot, persona.id)
+        await main.chat_mailbox.drain(timeout=60)
+        durations.append((time.perf_counter() - start) * 1000)
+        per_message_commits.append(commits)
+
+    event.remove(Session, "after_commit", _count_commit)
+    main.asyncio.sleep = _real_sleep
+    print(f"messages:            {messages} ({users} users, streaming={main.settings.AI_STREAMING})")
+    print(f"commits / message:   avg {statistics.mean(per_message_commits):.2f}, max {max(per_message_commits)}")
+    print(f"handler time (ms):   p50 {statistics.median(durations):.2f}, p95 {statistics.quantiles(durations, n=20)[-1]:.2f}")
+    print(f"telegram API calls:  {FakeBot.calls}")
+    await engine.dispose()
+
+if __name__ == "__main__":
+    asyncio.run(run())
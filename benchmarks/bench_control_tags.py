@@ -0,0 +1,62 @@
+"""
+Mikro-benchmark parsowania tagów sterujących w odpowiedziach modelu.
+Porównuje dawny łańcuch re.search/str.replace z parse_control_tags i TagStreamParser.
+
+Uruchomienie: python -m benchmarks.bench_control_tags
+"""
+import random
+import re
+import timeit
+
+from app.control_tags import TagStreamParser, parse_control_tags
+
+WORDS = "babe hun cutie miami beach sunset gym tonight private room vip unlock wanna see more 😈 💋 ✨".split()
+TAGS = ["[MEM: name=John]", "[MEM:city = Austin]", "[PPV: red_bikini]", "[PROMO: blur_shower]", "[CUSTOM_REQ: video in white linen shirt]"]
+
+def make_reply(tokens: int, seed: int = 0) -> str:
+    """Sztuczna odpowiedź ~tokens tokenów (1 słowo ~ 1.3 tokena) z kilkoma tagami."""
+    rnd = random.Random(seed)
+    words = [rnd.choice(WORDS) for _ in range(int(tokens / 1.3))]
+    for tag in TAGS:
+        words.insert(rnd.randrange(len(words)), tag)
+    return " ".join(words)
+
+def legacy_parse(ai_text: str):
+    """Dawna logika z chat_handler (przed jednoprzebiegowym parserem)."""
+    final_text = ai_text
+    custom_match = re.search(r"\[CUSTOM_REQ:\s*(.*?)\]", ai_text, re.IGNORECASE)
+    if custom_match:
+        final_text = final_text.replace(custom_match.group(0), "").strip()
+    ppv_match = re.search(r"\[PPV:\s*(.*?)\]", ai_text, re.IGNORECASE)
+    promo_match = re.search(r"\[PROMO:\s*(.*?)\]", ai_text, re.IGNORECASE)
+    info = {}
+    for k, v in re.findall(r"\[MEM:\s*(.*?)=(.*?)\]", ai_text):
+        if k.strip() and v.strip(): info[k.strip().lower()] = v.strip()
+        final_text = final_text.replace(f"[MEM: {k}={v}]", "").replace(f"[MEM:{k}={v}]", "").replace(f"[MEM: {k} = {v}]", "")
+    if ppv_match:
+        final_text = final_text.replace(ppv_match.group(0), "").strip()
+    elif promo_match:
+        final_text = final_text.replace(promo_match.group(0), "").strip()
+    return " ".join(final_text.split()), info
+
+def stream_parse(ai_text: str, chunk_size: int = 4):
+    parser = TagStreamParser()
+    parts, actions = [], []
+    for i in range(0, len(ai_text), chunk_size):
+        text, acts = parser.feed(ai_text[i:i + chunk_size])
+        parts.append(text); actions.extend(acts)
+    parts.append(parser.finish())
+    return " ".join("".join(parts).split()), actions
+
+def main():
+    number = 2000
+    print(f"{'tokens':>7} {'legacy us':>10} {'single us':>10} {'stream us':>10} {'speedup':>8}")
+    for tokens in (250, 500, 1000, 2000):
+        reply = make_reply(tokens)
+        legacy = timeit.timeit(lambda: legacy_parse(reply), number=number) / number * 1e6
+        single = timeit.timeit(lambda: parse_control_tags(reply), number=number) / number * 1e6
+        stream = timeit.timeit(lambda: stream_parse(reply), number=number // 10) / (number // 10) * 1e6
+        print(f"{tokens:>7} {legacy:>10.1f} {single:>10.1f} {stream:>10.1f} {legacy / single:>7.2f}x")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,187 @@
+"""baseline schema
+
+Schemat bazy w postaci, w jakiej tworzył go wcześniej Base.metadata.create_all.
+Istniejącą bazę produkcyjną oznaczamy jednorazowo: alembic stamp 0001_baseline
+
+Revision ID: 0001_baseline
+Revises:
+Create Date: 2026-10-17 07:23:42.974415
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision: str = '0001_baseline'
+down_revision: Union[str, Sequence[str], None] = None
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table('groups',
+    sa.Column('id', sa.Integer(), autoincrement=True, nullable=False),
+    sa.Column('name', sa.String(length=100), nullable=False),
+    sa.Column('description', sa.String(length=255), nullable=True),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('name')
+    )
+    op.create_table('media_content',
+    sa.Column('id', sa.Integer(), autoincrement=True, nullable=False),
+    sa.Column('tag', sa.String(length=50), nullable=False),
+    sa.Column('name', sa.String(length=100), nullable=False),
+    sa.Column('file_id', sa.String(length=255), nullable=False),
+    sa.Column('media_type', sa.String(length=20), nullable=False),
+    sa.Column('price', sa.Integer(), nullable=False),
+    sa.Column('created_at', sa.DateTime(timezone=True), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_media_content_tag'), 'media_content', ['tag'], unique=True)
+    op.create_table('personas',
+    sa.Column('id', sa.Integer(), autoincrement=True, nullable=False),
+    sa.Column('name', sa.String(length=100), nullable=False),
+    sa.Column('system_prompt', sa.Text(), nullable=False),
+    sa.Column('telegram_token', sa.String(length=255), nullable=True),
+    sa.Column('openrouter_token', sa.String(length=255), nullable=True),
+    sa.Column('ai_model', sa.String(length=100), nullable=False),
+    sa.Column('timezone', sa.String(length=50), nullable=False),
+    sa.Column('private_channel_id', sa.String(length=255), nullable=True),
+    sa.Column('vip_subscription_price', sa.Integer(), nullable=False),
+    sa.Column('free_message_limit', sa.Integer(), nullable=False),
+    sa.Column('vip_daily_limit', sa.Integer(), nullable=False),
+    sa.Column('ppv_multiplier', sa.Integer(), nullable=False),
+    sa.Column('is_active', sa.Boolean(), nullable=False),
+    sa.Column('created_at', sa.DateTime(timezone=True), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_table('promo_content',
+    sa.Column('id', sa.Integer(), autoincrement=True, nullable=False),
+    sa.Column('tag', sa.String(length=50), nullable=False),
+    sa.Column('name', sa.String(length=100), nullable=False),
+    sa.Column('file_id', sa.String(length=255), nullable=False),
+    sa.Column('media_type', sa.String(length=20), nullable=False),
+    sa.Column('created_at', sa.DateTime(timezone=True), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_promo_content_tag'), 'promo_content', ['tag'], unique=True)
+    op.create_table('users',
+    sa.Column('telegram_id', sa.BigInteger(), nullable=False),
+    sa.Column('username', sa.String(length=255), nullable=True),
+    sa.Column('subscription_expires_at', sa.DateTime(timezone=True), nullable=True),
+    sa.Column('credits', sa.Integer(), nullable=False),
+    sa.Column('info', sa.JSON(), nullable=False),
+    sa.Column('vip_messages_used_today', sa.Integer(), nullable=False),
+    sa.Column('last_message_date', sa.String(length=20), nullable=True),
+    sa.Column('bonus_credits', sa.Integer(), nullable=False),
+    sa.Column('created_at', sa.DateTime(timezone=True), nullable=False),
+    sa.PrimaryKeyConstraint('telegram_id')
+    )
+    op.create_index(op.f('ix_users_telegram_id'), 'users', ['telegram_id'], unique=False)
+    op.create_table('broadcasts',
+    sa.Column('id', sa.Integer(), autoincrement=True, nullable=False),
+    sa.Column('message_content', sa.Text(), nullable=False),
+    sa.Column('target_type', sa.String(length=50), nullable=False),
+    sa.Column('media_id', sa.Integer(), nullable=True),
+    sa.Column('created_at', sa.DateTime(timezone=True), nullable=False),
+    sa.Column('status', sa.String(length=20), nullable=False),
+    sa.Column('total_recipients', sa.Integer(), nullable=False),
+    sa.Column('success_count', sa.Integer(), nullable=False),
+    sa.Column('fail_count', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['media_id'], ['media_content.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_table('custom_requests',
+    sa.Column('id', sa.Integer(), autoincrement=True, nullable=False),
+    sa.Column('user_id', sa.BigInteger(), nullable=False),
+    sa.Column('description', sa.Text(), nullable=False),
+    sa.Column('status', sa.String(length=20), nullable=False),
+    sa.Column('file_id', sa.String(length=255), nullable=True),
+    sa.Column('media_type', sa.String(length=20), nullable=True),
+    sa.Column('price', sa.Integer(), nullable=True),
+    sa.Column('created_at', sa.DateTime(timezone=True), nullable=False),
+    sa.ForeignKeyConstraint(['user_id'], ['users.telegram_id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_table('messages',
+    sa.Column('id', sa.Integer(), autoincrement=True, nullable=False),
+    sa.Column('user_id', sa.BigInteger(), nullable=False),
+    sa.Column('role', sa.String(length=20), nullable=False),
+    sa.Column('content', sa.Text(), nullable=False),
+    sa.Column('ai_cost', sa.Float(), nullable=True),
+    sa.Column('prompt_tokens', sa.Integer(), nullable=True),
+    sa.Column('completion_tokens', sa.Integer(), nullable=True),
+    sa.Column('timestamp', sa.DateTime(timezone=True), nullable=False),
+    sa.ForeignKeyConstraint(['user_id'], ['users.telegram_id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_messages_user_id'), 'messages', ['user_id'], unique=False)
+    op.create_table('scenarios',
+    sa.Column('id', sa.Integer(), autoincrement=True, nullable=False),
+    sa.Column('persona_id', sa.Integer(), nullable=False),
+    sa.Column('title', sa.String(length=100), nullable=False),
+    sa.Column('prompt_addition', sa.Text(), nullable=False),
+    sa.Column('time_start', sa.String(length=5), nullable=False),
+    sa.Column('time_end', sa.String(length=5), nullable=False),
+    sa.Column('is_active', sa.Boolean(), nullable=False),
+    sa.Column('target_type', sa.String(length=50), nullable=False),
+    sa.ForeignKeyConstraint(['persona_id'], ['personas.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_table('transactions',
+    sa.Column('id', sa.String(), nullable=False),
+    sa.Column('user_id', sa.BigInteger(), nullable=False),
+    sa.Column('amount', sa.Float(), nullable=False),
+    sa.Column('status', sa.String(length=20), nullable=False),
+    sa.Column('created_at', sa.DateTime(timezone=True), nullable=False),
+    sa.ForeignKeyConstraint(['user_id'], ['users.telegram_id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_table('user_groups',
+    sa.Column('user_id', sa.BigInteger(), nullable=False),
+    sa.Column('group_id', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['group_id'], ['groups.id'], ondelete='CASCADE'),
+    sa.ForeignKeyConstraint(['user_id'], ['users.telegram_id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('user_id', 'group_id')
+    )
+    op.create_table('broadcast_logs',
+    sa.Column('id', sa.Integer(), autoincrement=True, nullable=False),
+    sa.Column('broadcast_id', sa.Integer(), nullable=False),
+    sa.Column('user_id', sa.BigInteger(), nullable=False),
+    sa.Column('status', sa.String(length=20), nullable=False),
+    sa.Column('error_message', sa.String(length=255), nullable=True),
+    sa.Column('timestamp', sa.DateTime(timezone=True), nullable=False),
+    sa.ForeignKeyConstraint(['broadcast_id'], ['broadcasts.id'], ),
+    sa.ForeignKeyConstraint(['user_id'], ['users.telegram_id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_table('scenario_groups',
+    sa.Column('scenario_id', sa.Integer(), nullable=False),
+    sa.Column('group_id', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['group_id'], ['groups.id'], ondelete='CASCADE'),
+    sa.ForeignKeyConstraint(['scenario_id'], ['scenarios.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('scenario_id', 'group_id')
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_table('scenario_groups')
+    op.drop_table('broadcast_logs')
+    op.drop_table('user_groups')
+    op.drop_table('transactions')
+    op.drop_table('scenarios')
+    op.drop_index(op.f('ix_messages_user_id'), table_name='messages')
+    op.drop_table('messages')
+    op.drop_table('custom_requests')
+    op.drop_table('broadcasts')
+    op.drop_index(op.f('ix_users_telegram_id'), table_name='users')
+    op.drop_table('users')
+    op.drop_index(op.f('ix_promo_content_tag'), table_name='promo_content')
+    op.drop_table('promo_content')
+    op.drop_table('personas')
+    op.drop_index(op.f('ix_media_content_tag'), table_name='media_content')
+    op.drop_table('media_content')
+    op.drop_table('groups')
@@ -0,0 +1,47 @@
+"""user counters and telegram message id
+
+Kolumny liczników User (user-006) i Message.tg_message_id (idempotencja, user-007).
+Wartości liczników dla istniejących użytkowników: python -m app.database.backfill_counters
+
+Revision ID: 0002_user_counters
+Revises: 0001_baseline
+Create Date: 2026-10-17 07:30:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision: str = '0002_user_counters'
+down_revision: Union[str, Sequence[str], None] = '0001_baseline'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+USER_COLUMNS = [
+    sa.Column('user_message_count', sa.Integer(), server_default='0', nullable=False),
+    sa.Column('assistant_message_count', sa.Integer(), server_default='0', nullable=False),
+    sa.Column('lifetime_tokens', sa.BigInteger(), server_default='0', nullable=False),
+    sa.Column('lifetime_ai_cost', sa.Float(), server_default='0', nullable=False),
+]
+
+def _existing_columns(table: str) -> set:
+    return {c['name'] for c in sa.inspect(op.get_bind()).get_columns(table)}
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # Kolumny mogły zostać już dodane ręcznie starszą wersją backfill_counters
+    user_cols = _existing_columns('users')
+    for column in USER_COLUMNS:
+        if column.name not in user_cols:
+            op.add_column('users', column)
+    if 'tg_message_id' not in _existing_columns('messages'):
+        op.add_column('messages', sa.Column('tg_message_id', sa.BigInteger(), nullable=True))
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_column('messages', 'tg_message_id')
+    for column in reversed(USER_COLUMNS):
+        op.drop_column('users', column.name)
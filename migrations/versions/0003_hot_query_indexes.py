@@ -0,0 +1,45 @@
+"""indexes for hot query shapes
+
+Indeksy tworzone są przez CREATE INDEX CONCURRENTLY poza transakcją migracji,
+więc nie blokują zapisu do dużych tabel na produkcji.
+Jeśli budowa indeksu zostanie przerwana, Postgres zostawia go jako INVALID -
+IF NOT EXISTS by go pominął, dlatego przed ponowieniem trzeba go usunąć (DROP INDEX CONCURRENTLY).
+
+Revision ID: 0003_hot_query_indexes
+Revises: 0002_user_counters
+Create Date: 2026-10-17 07:40:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision: str = '0003_hot_query_indexes'
+down_revision: Union[str, Sequence[str], None] = '0002_user_counters'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# (nazwa, tabela, kolumny, dodatkowe opcje)
+INDEXES = [
+    ('ix_messages_user_id_timestamp', 'messages', ['user_id', sa.text('"timestamp" DESC')], {}),
+    ('ix_messages_user_id_role', 'messages', ['user_id', 'role'], {}),
+    ('ix_messages_user_id_tg_message_id', 'messages', ['user_id', 'tg_message_id'], {'postgresql_where': sa.text('tg_message_id IS NOT NULL')}),
+    ('ix_transactions_user_id_status_created_at', 'transactions', ['user_id', 'status', 'created_at'], {}),
+    ('ix_users_subscription_expires_at', 'users', ['subscription_expires_at'], {}),
+    ('ix_broadcast_logs_broadcast_id_status', 'broadcast_logs', ['broadcast_id', 'status'], {}),
+]
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    with op.get_context().autocommit_block():
+        for name, table, columns, kw in INDEXES:
+            op.create_index(name, table, columns, postgresql_concurrently=True, if_not_exists=True, **kw)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    with op.get_context().autocommit_block():
+        for name, table, _, _ in reversed(INDEXES):
+            op.drop_index(name, table_name=table, postgresql_concurrently=True, if_exists=True)
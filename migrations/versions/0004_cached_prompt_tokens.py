@@ -0,0 +1,29 @@
+"""message cached prompt tokens
+
+Message.cached_prompt_tokens - część prompt_tokens obsłużona z cache promptu dostawcy.
+
+Revision ID: 0004_cached_prompt_tokens
+Revises: 0003_hot_query_indexes
+Create Date: 2026-10-17 08:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision: str = '0004_cached_prompt_tokens'
+down_revision: Union[str, Sequence[str], None] = '0003_hot_query_indexes'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('messages', sa.Column('cached_prompt_tokens', sa.Integer(), nullable=True))
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_column('messages', 'cached_prompt_tokens')
@@ -0,0 +1,33 @@
+"""broadcast recipient state
+
+broadcast_logs staje się tabelą stanu odbiorców (pending/sending/sent/failed/cancelled):
+unikalny wiersz na (broadcast_id, user_id), tworzony przy zakładaniu broadcastu.
+
+Revision ID: 0005_broadcast_recipients
+Revises: 0004_cached_prompt_tokens
+Create Date: 2026-10-17 08:20:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision: str = '0005_broadcast_recipients'
+down_revision: Union[str, Sequence[str], None] = '0004_cached_prompt_tokens'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    with op.get_context().autocommit_block():
+        op.create_index('uq_broadcast_logs_broadcast_id_user_id', 'broadcast_logs', ['broadcast_id', 'user_id'],
+                        unique=True, postgresql_concurrently=True, if_not_exists=True)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    with op.get_context().autocommit_block():
+        op.drop_index('uq_broadcast_logs_broadcast_id_user_id', table_name='broadcast_logs', postgresql_concurrently=True, if_exists=True)
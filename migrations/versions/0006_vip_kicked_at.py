@@ -0,0 +1,43 @@
+"""users.vip_kicked_at
+
+Kolumna vip_kicked_at zastępuje flagę info["vip_kicked"]; dotychczasowe flagi są przenoszone
+(dokładny czas usunięcia z kanału nie był zapisywany - przyjmujemy datę wygaśnięcia).
+Indeks częściowy obejmuje tylko nieobsłużone subskrypcje.
+
+Revision ID: 0006_vip_kicked_at
+Revises: 0005_broadcast_recipients
+Create Date: 2026-10-17 08:40:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision: str = '0006_vip_kicked_at'
+down_revision: Union[str, Sequence[str], None] = '0005_broadcast_recipients'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('users', sa.Column('vip_kicked_at', sa.DateTime(timezone=True), nullable=True))
+    if op.get_bind().dialect.name == 'postgresql':
+        kicked = "(info::jsonb ->> 'vip_kicked') = 'true'"
+    else:
+        kicked = "json_extract(info, '$.vip_kicked') = 1"
+    op.execute(f"UPDATE users SET vip_kicked_at = COALESCE(subscription_expires_at, CURRENT_TIMESTAMP) WHERE {kicked}")
+
+    with op.get_context().autocommit_block():
+        op.create_index('ix_users_vip_pending_expiry', 'users', ['subscription_expires_at', 'telegram_id'],
+                        postgresql_where=sa.text('vip_kicked_at IS NULL'), sqlite_where=sa.text('vip_kicked_at IS NULL'),
+                        postgresql_concurrently=True, if_not_exists=True)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    with op.get_context().autocommit_block():
+        op.drop_index('ix_users_vip_pending_expiry', table_name='users', postgresql_concurrently=True, if_exists=True)
+    op.drop_column('users', 'vip_kicked_at')
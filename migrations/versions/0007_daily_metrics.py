@@ -0,0 +1,64 @@
+"""daily metrics rollup
+
+Tabela daily_metrics (dzienne agregaty per persona) oraz persona_id w messages i transactions.
+Historia jest przeliczana jednorazowo i przypisywana aktywnej personie
+(wcześniej panel tak właśnie prezentował wszystkie statystyki).
+
+Revision ID: 0007_daily_metrics
+Revises: 0006_vip_kicked_at
+Create Date: 2026-10-17 09:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision: str = '0007_daily_metrics'
+down_revision: Union[str, Sequence[str], None] = '0006_vip_kicked_at'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+ACTIVE_PERSONA = "COALESCE((SELECT id FROM personas WHERE is_active = true ORDER BY id LIMIT 1), 0)"
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('messages', sa.Column('persona_id', sa.Integer(), nullable=True))
+    op.add_column('transactions', sa.Column('persona_id', sa.Integer(), nullable=True))
+    op.create_table('daily_metrics',
+    sa.Column('day', sa.Date(), nullable=False),
+    sa.Column('persona_id', sa.Integer(), nullable=False),
+    sa.Column('user_messages', sa.Integer(), server_default='0', nullable=False),
+    sa.Column('assistant_messages', sa.Integer(), server_default='0', nullable=False),
+    sa.Column('prompt_tokens', sa.BigInteger(), server_default='0', nullable=False),
+    sa.Column('completion_tokens', sa.BigInteger(), server_default='0', nullable=False),
+    sa.Column('cached_prompt_tokens', sa.BigInteger(), server_default='0', nullable=False),
+    sa.Column('ai_cost', sa.Float(), server_default='0', nullable=False),
+    sa.Column('payments', sa.Integer(), server_default='0', nullable=False),
+    sa.Column('revenue', sa.Float(), server_default='0', nullable=False),
+    sa.PrimaryKeyConstraint('day', 'persona_id')
+    )
+
+    op.execute(f"""
+        INSERT INTO daily_metrics (day, persona_id, user_messages, assistant_messages, prompt_tokens, completion_tokens, cached_prompt_tokens, ai_cost)
+        SELECT date("timestamp"), {ACTIVE_PERSONA},
+               SUM(CASE WHEN role = 'user' THEN 1 ELSE 0 END), SUM(CASE WHEN role = 'user' THEN 0 ELSE 1 END),
+               COALESCE(SUM(prompt_tokens), 0), COALESCE(SUM(completion_tokens), 0),
+               COALESCE(SUM(cached_prompt_tokens), 0), COALESCE(SUM(ai_cost), 0)
+        FROM messages GROUP BY date("timestamp")
+    """)
+    op.execute(f"""
+        INSERT INTO daily_metrics (day, persona_id, payments, revenue)
+        SELECT date(created_at), {ACTIVE_PERSONA}, COUNT(*), COALESCE(SUM(amount), 0)
+        FROM transactions WHERE status = 'completed' GROUP BY date(created_at)
+        ON CONFLICT (day, persona_id) DO UPDATE SET payments = excluded.payments, revenue = excluded.revenue
+    """)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_table('daily_metrics')
+    op.drop_column('transactions', 'persona_id')
+    op.drop_column('messages', 'persona_id')
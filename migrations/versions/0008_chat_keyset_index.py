@@ -0,0 +1,36 @@
+"""messages (user_id, timestamp, id) index
+
+Kursor podglądu czatu w panelu to (timestamp, id); nowy indeks zastępuje ix_messages_user_id_timestamp
+(ten sam prefiks, więc odczyt historii do promptu dalej z niego korzysta).
+
+Revision ID: 0008_chat_keyset_index
+Revises: 0007_daily_metrics
+Create Date: 2026-10-17 09:20:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision: str = '0008_chat_keyset_index'
+down_revision: Union[str, Sequence[str], None] = '0007_daily_metrics'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    with op.get_context().autocommit_block():
+        op.create_index('ix_messages_user_id_timestamp_id', 'messages', ['user_id', sa.text('"timestamp" DESC'), sa.text('id DESC')],
+                        postgresql_concurrently=True, if_not_exists=True)
+        op.drop_index('ix_messages_user_id_timestamp', table_name='messages', postgresql_concurrently=True, if_exists=True)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    with op.get_context().autocommit_block():
+        op.create_index('ix_messages_user_id_timestamp', 'messages', ['user_id', sa.text('"timestamp" DESC')],
+                        postgresql_concurrently=True, if_not_exists=True)
+        op.drop_index('ix_messages_user_id_timestamp_id', table_name='messages', postgresql_concurrently=True, if_exists=True)
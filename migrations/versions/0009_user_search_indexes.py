@@ -0,0 +1,40 @@
+"""user search indexes
+
+ix_users_username_search - prefiks nazwy użytkownika i kursor (nazwa, id) w wyszukiwarce panelu (tylko Postgres).
+ix_users_subscription_expires_at_id zastępuje indeks jednokolumnowy (ten sam prefiks + kursor po id).
+
+Revision ID: 0009_user_search_indexes
+Revises: 0008_chat_keyset_index
+Create Date: 2026-10-17 09:40:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision: str = '0009_user_search_indexes'
+down_revision: Union[str, Sequence[str], None] = '0008_chat_keyset_index'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    with op.get_context().autocommit_block():
+        if op.get_bind().dialect.name == 'postgresql':
+            op.create_index('ix_users_username_search', 'users', [sa.text("(COALESCE(lower(username), '') COLLATE \"C\")"), 'telegram_id'],
+                            postgresql_concurrently=True, if_not_exists=True)
+        op.create_index('ix_users_subscription_expires_at_id', 'users', ['subscription_expires_at', 'telegram_id'],
+                        postgresql_concurrently=True, if_not_exists=True)
+        op.drop_index('ix_users_subscription_expires_at', table_name='users', postgresql_concurrently=True, if_exists=True)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    with op.get_context().autocommit_block():
+        op.create_index('ix_users_subscription_expires_at', 'users', ['subscription_expires_at'],
+                        postgresql_concurrently=True, if_not_exists=True)
+        op.drop_index('ix_users_subscription_expires_at_id', table_name='users', postgresql_concurrently=True, if_exists=True)
+        op.drop_index('ix_users_username_search', table_name='users', postgresql_concurrently=True, if_exists=True)
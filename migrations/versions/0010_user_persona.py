@@ -0,0 +1,66 @@
+"""users.persona_id
+
+Persona (bot), z którą rozmawia użytkownik - przy wielu aktywnych botach wiadomości wychodzące
+muszą iść przez bota, którego użytkownik uruchomił. Wypełniana personą z ostatniej wiadomości.
+
+Historia rozmów jest teraz filtrowana po messages.persona_id, więc wiadomości sprzed 0007 (persona_id NULL)
+dostają personę aktywną w chwili migracji - tak jak 0007 przypisał jej dzienne agregaty.
+Downgrade nie cofa tego przypisania (kolumna zostaje z 0007).
+Backfill idzie paczkami po BATCH_SIZE wierszy poza transakcją migracji (autocommit_block).
+
+Revision ID: 0010_user_persona
+Revises: 0009_user_search_indexes
+Create Date: 2026-10-17 11:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision: str = '0010_user_persona'
+down_revision: Union[str, Sequence[str], None] = '0009_user_search_indexes'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# Wiersze aktualizowane paczkami po zakresie klucza, każda paczka w osobnej transakcji (autocommit) -
+# bez długich blokad i jednej wielkiej transakcji na produkcyjnych tabelach. Przerwany backfill można ponowić.
+BATCH_SIZE = 10000
+
+def _existing_columns(table: str) -> set:
+    return {c['name'] for c in sa.inspect(op.get_bind()).get_columns(table)}
+
+def _backfill(table: str, key: str, assignment: str, **params) -> None:
+    bind = op.get_bind()
+    last = bind.execute(sa.text(f"SELECT min({key}) - 1 FROM {table}")).scalar()
+    while last is not None:
+        upper = bind.execute(sa.text(
+            f"SELECT max({key}) FROM (SELECT {key} FROM {table} WHERE {key} > :last ORDER BY {key} LIMIT :n) AS batch"
+        ), {"last": last, "n": BATCH_SIZE}).scalar()
+        if upper is None: break
+        bind.execute(sa.text(
+            f"UPDATE {table} SET persona_id = {assignment} WHERE persona_id IS NULL AND {key} > :last AND {key} <= :upper"
+        ), {"last": last, "upper": upper, **params})
+        last = upper
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # Kolumna mogła zostać dodana przez przerwany wcześniej backfill
+    if 'persona_id' not in _existing_columns('users'):
+        op.add_column('users', sa.Column('persona_id', sa.Integer(), nullable=True))
+    with op.get_context().autocommit_block():
+        active_persona = op.get_bind().execute(sa.text("SELECT id FROM personas WHERE is_active = true ORDER BY id LIMIT 1")).scalar()
+        if active_persona is not None:
+            _backfill('messages', 'id', ':persona', persona=active_persona)
+        _backfill('users', 'telegram_id', """(
+            SELECT m.persona_id FROM messages m
+            WHERE m.user_id = users.telegram_id AND m.persona_id > 0
+            ORDER BY m."timestamp" DESC, m.id DESC LIMIT 1
+        )""")
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_column('users', 'persona_id')
@@ -0,0 +1,30 @@
+"""daily_metrics.llm_calls_saved
+
+Liczba wiadomości użytkowników obsłużonych wspólną turą AI (sklejanie serii w chat_mailbox)
+zamiast osobnego wywołania modelu - per persona i dzień.
+
+Revision ID: 0011_llm_calls_saved
+Revises: 0010_user_persona
+Create Date: 2026-10-17 14:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision: str = '0011_llm_calls_saved'
+down_revision: Union[str, Sequence[str], None] = '0010_user_persona'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('daily_metrics', sa.Column('llm_calls_saved', sa.Integer(), server_default='0', nullable=False))
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_column('daily_metrics', 'llm_calls_saved')
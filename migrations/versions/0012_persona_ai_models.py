@@ -0,0 +1,35 @@
+"""personas.ai_models
+
+Lista modeli persony w kolejności failoveru - awaria jednego endpointu (np. 404 "No endpoints found")
+przełącza odpowiedzi na kolejny model zamiast wysyłać wszystkim tekst awaryjny. Wypełniana dotychczasowym ai_model.
+
+Revision ID: 0012_persona_ai_models
+Revises: 0011_llm_calls_saved
+Create Date: 2026-10-17 15:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision: str = '0012_persona_ai_models'
+down_revision: Union[str, Sequence[str], None] = '0011_llm_calls_saved'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('personas', sa.Column('ai_models', sa.JSON(), nullable=True))
+    personas = sa.table('personas', sa.column('id', sa.Integer()), sa.column('ai_model', sa.String()), sa.column('ai_models', sa.JSON()))
+    bind = op.get_bind()
+    for persona_id, ai_model in bind.execute(sa.select(personas.c.id, personas.c.ai_model)).all():
+        if ai_model:
+            bind.execute(personas.update().where(personas.c.id == persona_id).values(ai_models=[ai_model]))
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_column('personas', 'ai_models')
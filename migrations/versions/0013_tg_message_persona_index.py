@@ -0,0 +1,36 @@
+"""messages (user_id, persona_id, tg_message_id) index
+
+message_id Telegrama jest numerowany per bot, więc wykrywanie ponowionych update'ów porównuje też personę.
+Nowy indeks zastępuje ix_messages_user_id_tg_message_id.
+
+Revision ID: 0013_tg_message_persona_index
+Revises: 0012_persona_ai_models
+Create Date: 2026-10-17 16:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision: str = '0013_tg_message_persona_index'
+down_revision: Union[str, Sequence[str], None] = '0012_persona_ai_models'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    with op.get_context().autocommit_block():
+        op.create_index('ix_messages_user_id_persona_id_tg_message_id', 'messages', ['user_id', 'persona_id', 'tg_message_id'],
+                        postgresql_where=sa.text('tg_message_id IS NOT NULL'), postgresql_concurrently=True, if_not_exists=True)
+        op.drop_index('ix_messages_user_id_tg_message_id', table_name='messages', postgresql_concurrently=True, if_exists=True)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    with op.get_context().autocommit_block():
+        op.create_index('ix_messages_user_id_tg_message_id', 'messages', ['user_id', 'tg_message_id'],
+                        postgresql_where=sa.text('tg_message_id IS NOT NULL'), postgresql_concurrently=True, if_not_exists=True)
+        op.drop_index('ix_messages_user_id_persona_id_tg_message_id', table_name='messages', postgresql_concurrently=True, if_exists=True)
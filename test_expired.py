@@ -2,7 +2,6 @@ import asyncio
 from datetime import datetime, timedelta
 from app.database.session import AsyncSessionLocal
 from app.database.models import User
-from sqlalchemy.orm.attributes import flag_modified
 
 async def make_me_expired_vip():
     # TU WPISZ SWÓJ TELEGRAM ID (musisz mieć już wysłaną jakąś wiadomość do bota)
@@ -19,12 +18,9 @@ async def make_me_expired_vip():
         past_date = datetime.utcnow() - timedelta(days=5)
         user.subscription_expires_at = past_date
         
-        # 2. Dodajemy flagę "vip_kicked", żeby auto-kicker z main.py nie próbował 
-        #    Cię teraz w kółko wyrzucać z kanału podczas Twoich testów panelu
-        user_info = dict(user.info) if user.info else {}
-        user_info["vip_kicked"] = True
-        user.info = user_info
-        flag_modified(user, "info")
+        # 2. Oznaczamy VIP-a jako już usuniętego, żeby sweeper (app/vip_sweeper.py) nie próbował 
+        #    Cię teraz wyrzucać z kanału podczas Twoich testów panelu
+        user.vip_kicked_at = datetime.utcnow()
         
         await db.commit()
         print(f"✅ Sukces! Użytkownik {user.username or MY_TELEGRAM_ID} wygasł 5 dni temu.")
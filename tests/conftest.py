@@ -0,0 +1,13 @@
+import os
+
+# Settings wymaga tych zmiennych przy imporcie app.database.session - w testach wystarczą atrapy
+for name, value in {
+    "BOT_TOKEN": "123:test",
+    "WEBHOOK_URL": "https://example.invalid",
+    "ADMIN_USER": "admin",
+    "ADMIN_PASS": "admin",
+    "DATABASE_URL": "sqlite+aiosqlite://",
+    "REDIS_URL": "redis://localhost:6379/0",
+    "OPENROUTER_KEY": "test",
+}.items():
+    os.environ.setdefault(name, value)
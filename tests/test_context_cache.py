@@ -0,0 +1,79 @@
+import asyncio
+
+import pytest
+
+fakeredis = pytest.importorskip("fakeredis")
+pytest.importorskip("aiosqlite")
+
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.pool import StaticPool
+
+import app.context_cache as context_cache
+from app.database.models import Base, Message, User
+
+USER_ID, PERSONA_ID = 1001, 7
+
+@pytest.fixture
+def env(monkeypatch):
+    monkeypatch.setattr(context_cache, "redis", fakeredis.aioredis.FakeRedis())
+    engine = create_async_engine("sqlite+aiosqlite://", poolclass=StaticPool)
+
+    async def setup():
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+        async with sessions() as db:
+            db.add(User(telegram_id=USER_ID))
+            await db.commit()
+
+    sessions = async_sessionmaker(engine, expire_on_commit=False)
+    asyncio.run(setup())
+    yield sessions
+    asyncio.run(engine.dispose())
+
+async def add_message(sessions, role, content):
+    async with sessions() as db:
+        db.add(Message(user_id=USER_ID, persona_id=PERSONA_ID, role=role, content=content))
+        await db.commit()
+    await context_cache._wait_pending((USER_ID, PERSONA_ID))
+
+async def history(sessions):
+    async with sessions() as db:
+        return [m["content"] for m in await context_cache.get_history(db, USER_ID, PERSONA_ID)]
+
+def test_miss_fills_buffer_and_commits_append(env):
+    async def run():
+        await add_message(env, "user", "msg1")
+        await add_message(env, "assistant", "reply1")
+        assert await history(env) == ["msg1", "reply1"]
+        assert await context_cache.redis.llen(context_cache._key((USER_ID, PERSONA_ID))) == 2
+        await add_message(env, "user", "msg2")
+        assert await history(env) == ["msg1", "reply1", "msg2"]
+    asyncio.run(run())
+
+@pytest.mark.parametrize("push_before_fill", [True, False])
+def test_message_committed_during_fill_is_not_lost(env, push_before_fill):
+    async def run():
+        await add_message(env, "user", "msg1")
+        await add_message(env, "assistant", "reply1")
+        conversation = (USER_ID, PERSONA_ID)
+
+        async with env() as db:
+            execute = db.execute
+
+            async def execute_then_commit(*args, **kwargs):
+                # msg2 trafia do bazy po odczycie historii, a przed odbudową bufora
+                result = await execute(*args, **kwargs)
+                async with env() as other:
+                    other.add(Message(user_id=USER_ID, persona_id=PERSONA_ID, role="user", content="msg2"))
+                    await other.commit()
+                if push_before_fill:
+                    await context_cache._wait_pending(conversation)
+                return result
+
+            db.execute = execute_then_commit
+            first = [m["content"] for m in await context_cache.get_history(db, USER_ID, PERSONA_ID)]
+        await context_cache._wait_pending(conversation)
+
+        assert first == ["msg1", "reply1"]
+        assert await history(env) == ["msg1", "reply1", "msg2"]
+    asyncio.run(run())
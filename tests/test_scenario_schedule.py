@@ -0,0 +1,109 @@
+import random
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+import pytest
+
+from app.scenario_schedule import MINUTES_PER_DAY, ScenarioSchedule
+
+def scenario(title, start, end, is_active=True, groups=None):
+    return SimpleNamespace(
+        title=title, prompt_addition=f"{title} prompt", time_start=start, time_end=end, is_active=is_active,
+        target_type="groups" if groups is not None else "all", groups=[SimpleNamespace(id=g) for g in groups or []],
+    )
+
+def hhmm(minute: int) -> str:
+    return f"{minute // 60:02d}:{minute % 60:02d}"
+
+def legacy_find(scenarios, current_time_str, user_group_ids):
+    """Dawna pętla z chat_handler (porównanie napisów "HH:MM", pierwszy pasujący wygrywa)."""
+    for sc in scenarios:
+        if not sc.is_active: continue
+        if sc.target_type == "groups":
+            if not set(user_group_ids).intersection({g.id for g in sc.groups}): continue
+        start, end = sc.time_start, sc.time_end
+        if start <= end:
+            if start <= current_time_str <= end: return sc
+        else:
+            if current_time_str >= start or current_time_str <= end: return sc
+    return None
+
+def title(entry):
+    return entry.title if entry else None
+
+def test_empty_schedule():
+    schedule = ScenarioSchedule()
+    assert schedule.find(0) is None
+    assert schedule.find(MINUTES_PER_DAY - 1) is None
+    assert not schedule.needs_groups
+
+def test_window_bounds_are_inclusive():
+    schedule = ScenarioSchedule([scenario("morning", "08:00", "09:30")])
+    assert schedule.find(8 * 60 - 1) is None
+    assert title(schedule.find(8 * 60)) == "morning"
+    assert title(schedule.find(9 * 60 + 30)) == "morning"
+    assert schedule.find(9 * 60 + 31) is None
+
+def test_overlap_resolved_by_persona_order():
+    schedule = ScenarioSchedule([scenario("evening", "18:00", "23:00"), scenario("dinner", "19:00", "20:00")])
+    assert title(schedule.find(18 * 60)) == "evening"
+    assert title(schedule.find(19 * 60 + 30)) == "evening"
+    # Odwrotna kolejność - węższe okno wygrywa tylko we własnym przedziale
+    schedule = ScenarioSchedule([scenario("dinner", "19:00", "20:00"), scenario("evening", "18:00", "23:00")])
+    assert title(schedule.find(18 * 60 + 59)) == "evening"
+    assert title(schedule.find(19 * 60 + 30)) == "dinner"
+    assert title(schedule.find(20 * 60 + 1)) == "evening"
+
+def test_window_crossing_midnight():
+    schedule = ScenarioSchedule([scenario("night", "22:00", "02:00")])
+    assert schedule.find(21 * 60 + 59) is None
+    assert title(schedule.find(22 * 60)) == "night"
+    assert title(schedule.find(MINUTES_PER_DAY - 1)) == "night"
+    assert title(schedule.find(0)) == "night"
+    assert title(schedule.find(2 * 60)) == "night"
+    assert schedule.find(2 * 60 + 1) is None
+
+def test_overlap_across_midnight():
+    schedule = ScenarioSchedule([scenario("late", "23:30", "00:30"), scenario("night", "22:00", "06:00")])
+    assert title(schedule.find(22 * 60 + 15)) == "night"
+    assert title(schedule.find(23 * 60 + 45)) == "late"
+    assert title(schedule.find(0)) == "late"
+    assert title(schedule.find(31)) == "night"
+    assert schedule.find(6 * 60 + 1) is None
+
+def test_group_targeting_falls_through_to_next_scenario():
+    schedule = ScenarioSchedule([scenario("whales", "00:00", "23:59", groups=[7]), scenario("everyone", "00:00", "23:59")])
+    assert schedule.needs_groups
+    assert title(schedule.find(600, frozenset({7, 8}))) == "whales"
+    assert title(schedule.find(600, frozenset({8}))) == "everyone"
+    assert title(schedule.find(600)) == "everyone"
+
+def test_inactive_and_invalid_windows_are_skipped():
+    schedule = ScenarioSchedule([
+        scenario("off", "00:00", "23:59", is_active=False), scenario("broken", "25:00", "26:00"),
+        scenario("garbage", "noon", "dusk"), scenario("on", "10:00", "11:00"),
+    ])
+    assert schedule.find(5 * 60) is None
+    assert title(schedule.find(10 * 60 + 30)) == "on"
+
+def test_active_for_uses_persona_timezone():
+    schedule = ScenarioSchedule([scenario("night", "22:00", "02:00")], "Europe/Warsaw")
+    local, entry = schedule.active_for(now=datetime(2026, 1, 15, 22, 30, tzinfo=timezone.utc))
+    assert (local.hour, local.minute) == (23, 30)
+    assert title(entry) == "night"
+
+def test_invalid_timezone_falls_back_to_default():
+    assert ScenarioSchedule([], "Mars/Olympus").tz.key == "America/New_York"
+
+@pytest.mark.parametrize("seed", range(20))
+def test_parity_with_legacy_loop(seed):
+    rng = random.Random(seed)
+    scenarios = []
+    for i in range(rng.randint(1, 8)):
+        start, end = rng.randrange(MINUTES_PER_DAY), rng.randrange(MINUTES_PER_DAY)
+        groups = rng.sample(range(1, 5), rng.randint(1, 2)) if rng.random() < 0.3 else None
+        scenarios.append(scenario(f"s{i}", hhmm(start), hhmm(end), is_active=rng.random() < 0.9, groups=groups))
+    schedule = ScenarioSchedule(scenarios)
+    for user_groups in (frozenset(), frozenset({1}), frozenset({2, 3})):
+        for minute in range(MINUTES_PER_DAY):
+            assert title(schedule.find(minute, user_groups)) == title(legacy_find(scenarios, hhmm(minute), user_groups)), (minute, user_groups)